@@ -5,13 +5,13 @@ Usa Perplexity Sonar per cercare sul web.
 """
 
 import os
-import json
 import time
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 import anthropic
 from supabase import create_client
 import requests
+from json_extract import extract_json
 
 load_dotenv()
 
@@ -73,32 +73,6 @@ def search_perplexity(query):
         return None
 
 
-def extract_json(text):
-    """Estrae JSON da una stringa"""
-    text = text.replace("```json", "").replace("```", "").strip()
-    try:
-        return json.loads(text)
-    except:
-        pass
-    start = text.find("{")
-    if start < 0:
-        return None
-    depth = 0
-    end = start
-    for i in range(start, len(text)):
-        if text[i] == "{":
-            depth += 1
-        elif text[i] == "}":
-            depth -= 1
-            if depth == 0:
-                end = i + 1
-                break
-    try:
-        return json.loads(text[start:end])
-    except:
-        return None
-
-
 def analyze_discoveries(search_results):
     """Analizza i risultati con Claude"""
     combined = "\n\n---\n\n".join([
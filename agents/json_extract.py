@@ -0,0 +1,132 @@
+"""
+brAIn JSON extract — estrae il primo valore JSON dalla risposta di un LLM.
+
+Una sola passata sul testo, consapevole di stringhe ed escape (le graffe dentro
+i valori non rompono piu' il bilanciamento), decodifica con orjson se presente
+e ripara i difetti tipici: virgole finali e risposte troncate da max_tokens
+(si scarta l'ultimo elemento incompleto e si chiudono le parentesi aperte).
+
+La stessa implementazione e' inclusa in deploy-agents/agents_runner.py, che
+viene deployato come file singolo.
+"""
+
+import re
+import json
+import collections
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _DECODE_ERRORS = (orjson.JSONDecodeError, ValueError)
+except ImportError:
+    _loads = json.loads
+    _DECODE_ERRORS = (ValueError,)
+
+_JSON_TOKENS = re.compile(r'[{}\[\]"\\,]')
+_JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+_CLOSERS = {"{": "}", "[": "]"}
+# Prose con molte parentesi prima del JSON: oltre questi tentativi si rinuncia
+_MAX_CANDIDATES = 8
+
+extract_stats = collections.Counter()
+
+
+def _scan(text, start):
+    """Cammina da text[start] ('{' o '[') fino alla chiusura bilanciata.
+
+    Ritorna (end, None) se il valore e' completo, altrimenti (None, cut) dove cut
+    e' (posizione, pila aperta) dell'ultima virgola utile per troncare.
+    """
+    stack = []
+    in_string = False
+    skip = -1
+    cut_array = cut_any = None
+    for m in _JSON_TOKENS.finditer(text, start):
+        i = m.start()
+        if i == skip:
+            continue
+        c = m.group()
+        if in_string:
+            if c == "\\":
+                skip = i + 1
+            elif c == '"':
+                in_string = False
+            continue
+        if c == '"':
+            in_string = True
+        elif c == "{" or c == "[":
+            stack.append(c)
+        elif c == "}" or c == "]":
+            if not stack or _CLOSERS[stack[-1]] != c:
+                return None, cut_array or cut_any
+            stack.pop()
+            if not stack:
+                return i + 1, None
+        elif c == "," and stack:
+            cut_any = (i, tuple(stack))
+            if stack[-1] == "[":
+                cut_array = (i, tuple(stack))
+    return None, cut_array or cut_any
+
+
+def _strip_trailing_commas(s):
+    """Toglie le virgole prima di } o ], solo fuori dalle stringhe."""
+    out = []
+    pos = 0
+    for m in _JSON_STRING.finditer(s):
+        out.append(_TRAILING_COMMA.sub(r"\1", s[pos:m.start()]))
+        out.append(m.group())
+        pos = m.end()
+    out.append(_TRAILING_COMMA.sub(r"\1", s[pos:]))
+    return "".join(out)
+
+
+def _decode(s):
+    try:
+        return _loads(s), True
+    except _DECODE_ERRORS:
+        pass
+    try:
+        return _loads(_strip_trailing_commas(s)), True
+    except _DECODE_ERRORS:
+        return None, False
+
+
+def extract_json(text, arrays=False):
+    """Primo oggetto JSON nel testo (anche array con arrays=True), riparato se possibile.
+
+    None se non c'e' niente di valido.
+    """
+    if not text:
+        return None
+    stripped = text.strip()
+    if stripped[:1] == "{" or (arrays and stripped[:1] == "["):
+        try:
+            result = _loads(stripped)
+            extract_stats["direct"] += 1
+            return result
+        except _DECODE_ERRORS:
+            pass
+
+    start = -1
+    for _ in range(_MAX_CANDIDATES):
+        candidates = [p for p in (text.find("{", start + 1), text.find("[", start + 1) if arrays else -1) if p >= 0]
+        if not candidates:
+            break
+        start = min(candidates)
+        end, cut = _scan(text, start)
+        if end is not None:
+            result, ok = _decode(text[start:end])
+            if ok:
+                extract_stats["scanned"] += 1
+                return result
+            continue
+        if cut is not None:
+            pos, stack = cut
+            result, ok = _decode(text[start:pos] + "".join(_CLOSERS[c] for c in reversed(stack)))
+            if ok:
+                extract_stats["repaired_truncated"] += 1
+                return result
+    extract_stats["failed"] += 1
+    return None
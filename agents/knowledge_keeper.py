@@ -10,6 +10,7 @@ from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 import anthropic
 from supabase import create_client
+from json_extract import extract_json
 
 load_dotenv()
 
@@ -43,36 +44,6 @@ def get_recent_logs(hours=24):
         return []
 
 
-def extract_json(text):
-    """Estrae JSON da una stringa, anche se contiene testo extra"""
-    text = text.replace("```json", "").replace("```", "").strip()
-    
-    try:
-        return json.loads(text)
-    except:
-        pass
-    
-    start = text.find("{")
-    if start < 0:
-        return None
-    
-    depth = 0
-    end = start
-    for i in range(start, len(text)):
-        if text[i] == "{":
-            depth += 1
-        elif text[i] == "}":
-            depth -= 1
-            if depth == 0:
-                end = i + 1
-                break
-    
-    try:
-        return json.loads(text[start:end])
-    except:
-        return None
-
-
 def analyze_logs(logs):
     if not logs:
         print("Nessun log da analizzare.")
@@ -4,11 +4,11 @@ Layer 2 — Genera soluzioni SOLO per i problemi approvati da Mirco.
 """
 
 import os
-import json
 import time
 from dotenv import load_dotenv
 import anthropic
 from supabase import create_client
+from json_extract import extract_json
 
 load_dotenv()
 
@@ -53,31 +53,6 @@ def get_approved_problems():
         return []
 
 
-def extract_json(text):
-    text = text.replace("```json", "").replace("```", "").strip()
-    try:
-        return json.loads(text)
-    except:
-        pass
-    start = text.find("{")
-    if start < 0:
-        return None
-    depth = 0
-    end = start
-    for i in range(start, len(text)):
-        if text[i] == "{":
-            depth += 1
-        elif text[i] == "}":
-            depth -= 1
-            if depth == 0:
-                end = i + 1
-                break
-    try:
-        return json.loads(text[start:end])
-    except:
-        return None
-
-
 def normalize_complexity(value):
     v = str(value).lower().strip()
     if "low" in v:
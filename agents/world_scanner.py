@@ -12,6 +12,7 @@ from dotenv import load_dotenv
 import anthropic
 from supabase import create_client
 import requests
+from json_extract import extract_json
 
 load_dotenv()
 
@@ -183,31 +184,6 @@ def search_perplexity(query):
         return None
 
 
-def extract_json(text):
-    text = text.replace("```json", "").replace("```", "").strip()
-    try:
-        return json.loads(text)
-    except:
-        pass
-    start = text.find("{")
-    if start < 0:
-        return None
-    depth = 0
-    end = start
-    for i in range(start, len(text)):
-        if text[i] == "{":
-            depth += 1
-        elif text[i] == "}":
-            depth -= 1
-            if depth == 0:
-                end = i + 1
-                break
-    try:
-        return json.loads(text[start:end])
-    except:
-        return None
-
-
 def calculate_weighted_score(problem):
     score = 0
     for param, weight in WEIGHTS.items():
@@ -0,0 +1,4 @@
+"""
+brAIn bench — strumenti offline per misurare e riprodurre i servizi.
+Non fa parte delle immagini Cloud Run: ogni Dockerfile copia solo il proprio file.
+"""
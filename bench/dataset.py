@@ -0,0 +1,167 @@
+"""
+brAIn bench — dataset sintetico deterministico con le dimensioni di produzione a regime.
+
+Default: 10k problemi, 100k righe di agent_logs, soluzioni con score per una parte
+dei problemi, fonti, lezioni e config. Generato dal seed, quindi due versioni del
+codice misurate con lo stesso seed vedono gli stessi dati (timestamp relativi a now).
+
+    python -m bench.dataset --problems 10000 --logs 100000 --out bench/fixtures/dataset.json.gz
+"""
+
+import os
+import gzip
+import json
+import random
+import argparse
+from datetime import datetime, timezone, timedelta
+
+SECTORS = [
+    "food", "health", "finance", "education", "legal",
+    "ecommerce", "hr", "real_estate", "sustainability",
+    "cybersecurity", "entertainment", "logistics",
+]
+
+AGENTS = [
+    ("world_scanner", "scan_v2", "claude-haiku-4-5-20251001"),
+    ("solution_architect", "research", "claude-haiku-4-5-20251001"),
+    ("solution_architect", "generate_unconstrained", "claude-sonnet-4-5-20250514"),
+    ("solution_architect", "assess_feasibility", "claude-haiku-4-5-20251001"),
+    ("knowledge_keeper", "analyze_logs", "claude-haiku-4-5-20251001"),
+    ("capability_scout", "analyze_discoveries", "claude-haiku-4-5-20251001"),
+    ("command_center", "chat", "claude-haiku-4-5-20251001"),
+    ("brain_god", "chat", "claude-opus-4-6"),
+]
+
+WORDS = ("costi inventario ritardi pagamenti clienti fornitori turni resi frodi recensioni "
+         "affitti manutenzione spedizioni rifiuti imballaggi password contratti tutoraggio").split()
+
+
+def _ts(now, rng, days):
+    return (now - timedelta(seconds=rng.randint(0, days * 86400))).isoformat()
+
+
+def build(problems=10000, logs=100000, solved_ratio=0.3, approved_unsolved=5, seed=42, now=None):
+    """Ritorna {tabella: [righe]} con id sequenziali e timestamp negli ultimi 30 giorni."""
+    rng = random.Random(seed)
+    now = now or datetime.now(timezone.utc)
+    tables = {name: [] for name in (
+        "problems", "solutions", "solution_scores", "agent_logs", "agent_events",
+        "scan_sources", "org_config", "org_knowledge", "capability_log")}
+
+    for i in range(1, 31):
+        tables["scan_sources"].append({
+            "id": i, "name": f"Fonte {i}", "url": f"https://source{i}.example.org",
+            "category": rng.choice(["news", "forum", "research", "social"]),
+            "sectors": json.dumps(rng.sample(SECTORS, 3)),
+            "relevance_score": round(rng.uniform(0.2, 0.95), 4),
+            "problems_found": rng.randint(0, 200), "avg_problem_score": round(rng.uniform(0.3, 0.8), 4),
+            "status": "active" if i <= 25 else "paused", "last_scanned": _ts(now, rng, 7),
+        })
+
+    solved = set(rng.sample(range(1, problems + 1), int(problems * solved_ratio)))
+    unsolved = [i for i in range(1, problems + 1) if i not in solved]
+    approved = set(rng.sample(unsolved, min(approved_unsolved, len(unsolved))))
+    for i in range(1, problems + 1):
+        sector = rng.choice(SECTORS)
+        score = round(rng.uniform(0.2, 0.95), 4)
+        status = "approved" if i in approved else ("approved" if i in solved and rng.random() < 0.5 else rng.choice(["new", "new", "rejected"]))
+        title = f"{' '.join(rng.sample(WORDS, 4))} #{i}"
+        tables["problems"].append({
+            "id": i, "title": title, "description": " ".join(rng.choices(WORDS, k=40)),
+            "domain": sector, "sector": sector, "geographic_scope": rng.choice(["global", "national", "regional"]),
+            "top_markets": json.dumps(rng.sample(["IT", "US", "UK", "DE", "FR", "ES"], 3)),
+            "market_size": round(rng.random(), 3), "willingness_to_pay": round(rng.random(), 3),
+            "urgency": rng.choice(["low", "medium", "high", "critical"]), "competition_gap": round(rng.random(), 3),
+            "ai_solvability": round(rng.random(), 3), "time_to_market": round(rng.random(), 3),
+            "recurring_potential": round(rng.random(), 3), "weighted_score": score, "score": score,
+            "who_is_affected": " ".join(rng.choices(WORDS, k=12)),
+            "real_world_example": " ".join(rng.choices(WORDS, k=25)),
+            "why_it_matters": " ".join(rng.choices(WORDS, k=15)),
+            "fingerprint": f"fp{i:08x}", "source_id": rng.randint(1, 30),
+            "status": status, "created_by": "world_scanner_v2", "created_at": _ts(now, rng, 30),
+        })
+
+    sol_id = 0
+    for pid in sorted(solved):
+        for _ in range(3):
+            sol_id += 1
+            tables["solutions"].append({
+                "id": sol_id, "problem_id": pid, "title": f"Soluzione {sol_id}",
+                "description": " ".join(rng.choices(WORDS, k=30)),
+                "approach": json.dumps({"value_proposition": "risparmia tempo", "target_segment": "PMI",
+                    "revenue_model": "subscription", "recommended_mvp": "bot Telegram",
+                    "existing_competitors": ["A", "B"]}, ensure_ascii=False),
+                "sector": "", "sub_sector": "", "status": "proposed",
+                "created_by": "solution_architect_v2", "created_at": _ts(now, rng, 30),
+            })
+            feas, impact = round(rng.random(), 4), round(rng.random(), 4)
+            tables["solution_scores"].append({
+                "id": sol_id, "solution_id": sol_id, "feasibility_score": feas, "impact_score": impact,
+                "cost_estimate": "80 euro/mese", "complexity": rng.choice(["low", "medium", "high"]),
+                "time_to_market": "3 settimane", "nocode_compatible": rng.random() < 0.6,
+                "overall_score": round((feas + impact) / 2, 4),
+                "notes": json.dumps({"novelty": 0.6, "opportunity": 0.7, "defensibility": 0.5}),
+                "scored_by": "solution_architect_v2",
+            })
+
+    for i in range(1, logs + 1):
+        agent_id, action, model = rng.choice(AGENTS)
+        failed = rng.random() < 0.03
+        tin, tout = rng.randint(300, 12000), rng.randint(50, 3000)
+        tables["agent_logs"].append({
+            "id": i, "agent_id": agent_id, "action": action, "layer": 2,
+            "input_summary": " ".join(rng.choices(WORDS, k=8)), "output_summary": None if failed else " ".join(rng.choices(WORDS, k=20)),
+            "model_used": model, "tokens_input": 0 if failed else tin, "tokens_output": 0 if failed else tout,
+            "cost_usd": 0 if failed else round((tin * 1 + tout * 5) / 1e6, 6),
+            "duration_ms": rng.randint(400, 40000), "status": "error" if failed else "success",
+            "error": "RateLimitError: 429" if failed else None, "retries": rng.choice([0, 0, 0, 1]),
+            "circuit_state": "closed", "created_at": _ts(now, rng, 30),
+        })
+
+    for i in range(1, 201):
+        tables["org_knowledge"].append({
+            "id": i, "title": f"Lezione {i}", "content": " ".join(rng.choices(WORDS, k=30)),
+            "category": rng.choice(["process", "technical", "strategic", "cost", "performance"]),
+            "source": "knowledge_keeper_v1", "created_at": _ts(now, rng, 30),
+        })
+    for i in range(1, 301):
+        tables["agent_events"].append({
+            "id": i, "event_type": rng.choice(["high_score_problem", "batch_scan_complete", "problem_approved"]),
+            "source_agent": "world_scanner", "target_agent": "solution_architect",
+            "payload": json.dumps({"problem_id": rng.randint(1, problems)}), "priority": "normal",
+            "status": "pending" if i > 290 else "done", "created_at": _ts(now, rng, 30),
+        })
+    for i in range(1, 51):
+        tables["capability_log"].append({
+            "id": i, "tool_name": f"Tool {i}", "category": "ai_model", "description": "strumento",
+            "potential_impact": "medio", "cost": "free", "status": "discovered", "created_at": _ts(now, rng, 30),
+        })
+    tables["org_config"].append({"id": 1, "key": "telegram_user_id", "value": json.dumps(1)})
+    return tables
+
+
+def save(tables, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(tables, f, ensure_ascii=False)
+
+
+def load(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera il dataset sintetico del benchmark")
+    parser.add_argument("--problems", type=int, default=10000)
+    parser.add_argument("--logs", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="bench/fixtures/dataset.json.gz")
+    args = parser.parse_args()
+    tables = build(args.problems, args.logs, seed=args.seed)
+    save(tables, args.out)
+    print({name: len(rows) for name, rows in tables.items()})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+brAIn bench — fake offline di Claude e Perplexity/Telegram/GitHub (Supabase: bench.memdb).
+
+A differenza delle cassette di bench.replay i fake generano risposte
+plausibili per qualunque input, con latenza configurabile, e contano ogni
+round trip: servono al benchmark end-to-end (bench.run) su dataset grandi.
+"""
+
+import re
+import json
+import time
+import base64
+import threading
+import collections
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from bench.replay import HttpResponse, AsyncSession, MessageStream, wait_log_sink
+
+
+def estimate_tokens(obj):
+    """Stima grezza dei token (4 caratteri ~ 1 token), uguale per tutte le versioni confrontate."""
+    if isinstance(obj, str):
+        return max(1, len(obj) // 4)
+    return max(1, len(json.dumps(obj, ensure_ascii=False, default=str)) // 4)
+
+
+class Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.busy_ms = 0.0
+
+    def add(self, key, tokens_in=0, tokens_out=0, busy_ms=0.0):
+        with self._lock:
+            self.calls[key] += 1
+            self.tokens_in += tokens_in
+            self.tokens_out += tokens_out
+            self.busy_ms += busy_ms
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+def _sleep(ms):
+    if ms > 0:
+        time.sleep(ms / 1000)
+
+
+# ---------------------------------------------------------------- Claude
+
+class Block:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class FakeMessage:
+    def __init__(self, model, blocks, stop_reason, tokens_in, tokens_out):
+        self.model = model
+        self.content = blocks
+        self.stop_reason = stop_reason
+        self.usage = Block(input_tokens=tokens_in, output_tokens=tokens_out,
+            cache_creation_input_tokens=0, cache_read_input_tokens=0)
+
+
+class FakeClaude:
+    """Risponde in base al system prompt del servizio: JSON per gli agenti, testo per le chat.
+
+    Con tools=[...] (brain_god) la prima risposta chiede un tool, la seconda chiude il turno.
+    Con tool_choice forzato (output strutturato degli agenti) risponde con quel tool;
+    per i tool *_item (re-request di un solo elemento) con il primo elemento dell'array.
+    """
+
+    def __init__(self, module, latency_ms=300, ms_per_output_token=0.0):
+        self.module = module
+        self.latency_ms = latency_ms
+        self.ms_per_output_token = ms_per_output_token
+        self.stats = Counters()
+        self.messages = self
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def create(self, model, system="", messages=None, max_tokens=1024, tools=None, tool_choice=None, _stream=False, **kwargs):
+        messages = messages or []
+        tokens_in = estimate_tokens(system) + estimate_tokens(messages) + (estimate_tokens(tools) if tools else 0)
+        blocks, stop_reason = self._reply(system, messages, tools)
+        forced = (tool_choice or {}).get("name")
+        if forced and blocks[0].type == "text":
+            data = json.loads(blocks[0].text)
+            if forced.endswith("_item"):
+                data = next(v[0] for v in data.values() if isinstance(v, list) and v)
+            blocks, stop_reason = [Block(type="tool_use", id=f"toolu_{self._next()}", name=forced, input=data)], "tool_use"
+        tokens_out = sum(estimate_tokens(getattr(b, "text", None) or getattr(b, "input", "")) for b in blocks)
+        tokens_out = min(tokens_out, max_tokens)
+        busy = self.latency_ms + tokens_out * self.ms_per_output_token
+        self.stats.add(self._kind(system, tools), tokens_in, tokens_out, busy)
+        message = FakeMessage(model, blocks, stop_reason, tokens_in, tokens_out)
+        if _stream:
+            # Primo token dopo latency_ms, poi l'output arriva al ritmo di ms_per_output_token
+            _sleep(self.latency_ms)
+            return MessageStream(message, chunk=64, delay_s=16 * self.ms_per_output_token / 1000)
+        _sleep(busy)
+        return message
+
+    def stream(self, **kwargs):
+        return self.create(_stream=True, **kwargs)
+
+    def _kind(self, system, tools):
+        for name in ("SCANNER_ANALYSIS_PROMPT", "RESEARCH_PROMPT", "GENERATION_PROMPT",
+                     "FEASIBILITY_PROMPT", "FEASIBILITY_BATCH_PROMPT", "KNOWLEDGE_PROMPT", "SCOUT_PROMPT",
+                     "ANOMALY_PROMPT"):
+            prompt = getattr(self.module, name, None)
+            if prompt and system == prompt:
+                return name.replace("_PROMPT", "").lower()
+        return "chat_tools" if tools else "chat"
+
+    def _reply(self, system, messages, tools):
+        kind = self._kind(system, tools)
+        n = self._next()
+        if kind == "scanner_analysis":
+            data = {"problems": [fake_problem(n, i) for i in range(3)],
+                    "new_sources": [{"name": f"Fonte {n}", "url": f"https://example.org/{n}", "category": "news", "sectors": ["food"]}]}
+        elif kind == "research":
+            data = {"existing_solutions": [{"name": f"Competitor {n}-{i}", "what_it_does": "gestionale", "price": "49/mese",
+                        "weaknesses": "caro e lento", "market_share": "10%"} for i in range(3)],
+                    "market_gaps": ["nessuna integrazione", "onboarding lungo"], "failed_attempts": [],
+                    "expert_insights": ["gli utenti vogliono automazione"], "market_size_estimate": "200M EUR",
+                    "key_finding": f"gap evidente #{n}"}
+        elif kind == "generation":
+            data = {"solutions": [{"title": f"Soluzione {n}-{i}", "description": "servizio che fa X per Y tramite Z",
+                        "value_proposition": "risparmia tempo", "target_segment": "PMI", "job_to_be_done": "incassare",
+                        "revenue_model": "subscription", "monthly_revenue_potential": "5000", "monthly_burn_rate": "300",
+                        "competitive_moat": "dati proprietari", "novelty_score": 0.6 + i / 10,
+                        "opportunity_score": 0.7, "defensibility_score": 0.5} for i in range(3)],
+                    "ranking_rationale": "la prima ha il gap piu' ampio"}
+        elif kind == "feasibility":
+            titles = re.findall(r'"title":\s*"([^"]+)"', messages[-1]["content"] if messages else "")
+            data = {"assessments": [{"solution_title": t, "feasibility_score": 0.7, "complexity": "medium",
+                        "time_to_mvp": "3 settimane", "cost_estimate": "80 euro/mese", "tech_stack_fit": 0.8,
+                        "biggest_risk": "adozione", "recommended_mvp": "landing + bot", "nocode_compatible": True}
+                        for t in titles],
+                    "best_feasible": titles[0] if titles else "", "best_overall": titles[-1] if titles else ""}
+        elif kind == "feasibility_batch":
+            content = messages[-1]["content"] if messages else ""
+            ids = re.findall(r'"solution_id":\s*"([^"]+)"', content)
+            titles = re.findall(r'"title":\s*"([^"]+)"', content)
+            data = {"assessments": [{"solution_id": sid, "solution_title": t, "feasibility_score": 0.7, "complexity": "medium",
+                        "time_to_mvp": "3 settimane", "cost_estimate": "80 euro/mese", "tech_stack_fit": 0.8,
+                        "biggest_risk": "adozione", "recommended_mvp": "landing + bot", "nocode_compatible": True}
+                        for sid, t in zip(ids, titles)]}
+        elif kind == "knowledge":
+            data = {"lessons": [{"title": f"Lezione {n}", "content": "batch piu' grandi riducono i costi",
+                        "category": "cost", "actionable": "aumentare batch"}],
+                    "patterns": [{"pattern": "latenza stabile", "frequency": "giornaliera"}], "summary": "ok"}
+        elif kind == "scout":
+            data = {"discoveries": [{"tool_name": f"Tool {n}", "category": "ai_model", "description": "nuovo modello",
+                        "potential_impact": "costi minori", "cost": "free", "relevance": "medium", "action": "monitor"}],
+                    "summary": "ok"}
+        elif kind == "anomaly":
+            ids = re.findall(r'"anomaly_id":\s*"([^"]+)"', messages[-1]["content"] if messages else "")
+            data = {"explanations": [{"anomaly_id": a, "likely_cause": "provider lento o in errore",
+                        "suggested_action": "controllare lo stato del provider"} for a in ids]}
+        elif kind == "chat_tools" and not _has_tool_result(messages):
+            return [Block(type="tool_use", id=f"toolu_{n}", name="get_system_status", input={})], "tool_use"
+        else:
+            return [Block(type="text", text=f"Risposta di prova #{n}: tutto sotto controllo, tre problemi da guardare.")], "end_turn"
+        return [Block(type="text", text=json.dumps(data, ensure_ascii=False))], "end_turn"
+
+
+def _has_tool_result(messages):
+    last = messages[-1]["content"] if messages else None
+    return isinstance(last, list) and any(isinstance(c, dict) and c.get("type") == "tool_result" for c in last)
+
+
+def fake_problem(n, i):
+    return {
+        "title": f"Problema sintetico {n}-{i}", "description": "descrizione del problema",
+        "who_is_affected": "titolari di piccoli ristoranti", "real_world_example": "Anna butta 30kg di cibo a settimana",
+        "why_it_matters": "margini bassi", "sector": ["food", "health", "finance"][i % 3],
+        "geographic_scope": "global", "top_markets": ["IT", "US"],
+        "market_size": 0.8 - i * 0.2, "willingness_to_pay": 0.3, "urgency": 0.6, "competition_gap": 0.7,
+        "ai_solvability": 0.8, "time_to_market": 0.4, "recurring_potential": 0.2,
+        "source_name": "Reddit", "source_url": "https://reddit.com",
+    }
+
+
+# ---------------------------------------------------------------- HTTP
+
+class FakeHttp:
+    """Perplexity, Telegram, GitHub e chiamate tra servizi. Stessa interfaccia di HttpClients."""
+
+    CLAUDE_MD = "# brAIn\nOrganismo AI-native. Regole: italiano, zero fuffa.\n"
+
+    def __init__(self, search_latency_ms=200, latency_ms=50):
+        self.search_latency_ms = search_latency_ms
+        self.latency_ms = latency_ms
+        self.stats_ = Counters()
+
+    def request(self, method, url, json=None, **kwargs):
+        host = urlsplit(url).netloc
+        if host == "api.perplexity.ai":
+            query = (json or {}).get("messages", [{}])[-1].get("content", "")
+            body = {"choices": [{"message": {"content": f"Risultati per '{query}': utenti lamentano costi alti, "
+                "processi manuali e assenza di strumenti adatti alle piccole realta'. " * 4}}]}
+            busy = self.search_latency_ms
+            key = "search"
+        elif host == "api.telegram.org":
+            body, busy, key = {"ok": True, "result": {}}, self.latency_ms, "telegram"
+        elif host == "api.github.com":
+            content = base64.b64encode(self.CLAUDE_MD.encode()).decode()
+            body, busy, key = {"content": content, "sha": "0" * 40}, self.latency_ms, "github"
+        else:
+            body, busy, key = {"status": "ok"}, self.latency_ms, "other"
+        _sleep(busy)
+        self.stats_.add(key, estimate_tokens(json) if json else 0, 0, busy)
+        return HttpResponse(200, _json_dumps(body), {"content-type": "application/json"})
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    async def async_session(self):
+        return AsyncSession(self)
+
+    def warm(self, urls):
+        pass
+
+    def stats(self):
+        return {"sync": {}, "async": {}}
+
+    async def close(self):
+        pass
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False)
+
+
+# ---------------------------------------------------------------- installazione
+
+@contextmanager
+def install(module, claude=None, db=None, http=None, throttle_scale=0.0):
+    """Sostituisce claude/supabase/http_client del modulo con i fake; pause() scalata di throttle_scale."""
+    saved = {name: getattr(module, name) for name in ("claude", "supabase", "http_client", "pause") if hasattr(module, name)}
+    if claude is not None:
+        module.claude = claude
+    if db is not None:
+        module.supabase = module.TracedSupabase(db) if hasattr(module, "TracedSupabase") else db
+    if http is not None and "http_client" in saved:
+        module.http_client = http
+    if "pause" in saved:
+        real_pause = saved["pause"]
+        module.pause = lambda seconds, reason="sleep": real_pause(seconds * throttle_scale, reason)
+    try:
+        yield module
+    finally:
+        wait_log_sink(module)
+        for name, obj in saved.items():
+            setattr(module, name, obj)
@@ -0,0 +1,95 @@
+"""
+brAIn bench — microbenchmark di extract_json: implementazione storica vs agents/json_extract.py.
+
+Risposte grandi e realistiche (JSON puro, testo + fence, graffe nelle stringhe,
+virgole finali, troncamento da max_tokens): per ognuna tempo medio e se il
+risultato e' valido.
+
+    python -m bench.json_extract_bench --items 300 --rounds 50
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "agents"))
+from json_extract import extract_json, extract_stats  # noqa: E402
+
+
+def legacy_extract_json(text):
+    """La versione copiata in ogni agente fino a oggi."""
+    text = text.replace("```json", "").replace("```", "").strip()
+    try:
+        return json.loads(text)
+    except:
+        pass
+    start = text.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    end = start
+    for i in range(start, len(text)):
+        if text[i] == "{":
+            depth += 1
+        elif text[i] == "}":
+            depth -= 1
+            if depth == 0:
+                end = i + 1
+                break
+    try:
+        return json.loads(text[start:end])
+    except:
+        return None
+
+
+def make_payload(items):
+    return {"problems": [{
+        "title": f"Problema {i}", "description": "Clienti frustrati da resi lenti " * 8,
+        "who_is_affected": "PMI e-commerce", "real_world_example": "Luca aspetta 3 settimane il rimborso",
+        "sector": "ecommerce", "top_markets": ["IT", "US"], "market_size": 0.7, "urgency": 0.4,
+        "notes": "formato {campo: valore} usato nel report" if i % 3 == 0 else "ok",
+    } for i in range(items)], "new_sources": []}
+
+
+def make_cases(items):
+    payload = make_payload(items)
+    raw = json.dumps(payload, ensure_ascii=False, indent=2)
+    truncated = raw[:int(len(raw) * 0.8)]
+    trailing = raw.replace('"ok"\n', '"ok",\n')
+    return {
+        "json_puro": raw,
+        "testo_e_fence": "Ecco l'analisi richiesta.\n```json\n" + raw + "\n```\nFammi sapere se serve altro.",
+        "graffe_nelle_stringhe": "Risultato: " + raw,
+        "virgole_finali": "Risultato:\n" + trailing,
+        "troncato": "```json\n" + truncated,
+    }
+
+
+def timeit(fn, text, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = fn(text)
+    return (time.perf_counter() - start) / rounds * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark extract_json")
+    parser.add_argument("--items", type=int, default=300)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    cases = make_cases(args.items)
+    print(f"{'caso':24} {'KB':>6} {'storico ms':>11} {'nuovo ms':>9} {'x':>6}  storico / nuovo")
+    for name, text in cases.items():
+        old_ms, old = timeit(legacy_extract_json, text, args.rounds)
+        new_ms, new = timeit(extract_json, text, args.rounds)
+        old_ok = "ok" if isinstance(old, dict) and old.get("problems") else "FALLITO"
+        new_ok = f"ok ({len(new['problems'])} item)" if isinstance(new, dict) and new.get("problems") else "FALLITO"
+        print(f"{name:24} {len(text) / 1024:6.0f} {old_ms:11.2f} {new_ms:9.2f} {old_ms / new_ms:6.1f}  {old_ok} / {new_ok}")
+    print(f"\nesiti nuovo extractor: {dict(extract_stats)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,578 @@
+"""
+brAIn bench — Supabase in memoria con il sottoinsieme del query builder usato dai servizi.
+
+    table().select(cols, count="exact").eq/neq/gt/gte/lt/lte/like/ilike/in_/is_ / not_.<filtro>
+           .order(col, desc=).limit(n).range(a, b).execute()
+    insert / update / upsert(on_conflict=...) / delete, rpc(fn, params)
+
+Le tabelle hanno la forma di quelle reali (colonne, default, id seriale, vincoli
+unique con lo stesso nome dell'indice Postgres), quindi gli errori di colonna o di
+duplicato escono come in produzione. Ogni execute() e' un round trip: viene
+contato con il chiamante (file:riga funzione), cosi' i pattern N+1 come
+get_db_context si vedono e si misurano senza un progetto Supabase vivo.
+
+    db = MemorySupabase(dataset.build(1000, 10000), latency_ms=20)
+    with db.measure() as trips:
+        cc.get_db_context()
+    print(db.report(trips))
+
+    python -m bench.memdb            # report N+1 di get_db_context di CC e God
+"""
+
+import os
+import re
+import sys
+import copy
+import math
+import time
+import operator
+import threading
+import collections
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+_now = lambda: datetime.now(timezone.utc).isoformat()
+
+# Colonne e default delle tabelle reali. "id" e' sempre seriale.
+SCHEMAS = {
+    "problems": {
+        "title": None, "description": None, "domain": None, "sector": None, "geographic_scope": "global",
+        "top_markets": None, "market_size": None, "willingness_to_pay": None, "urgency": None,
+        "competition_gap": None, "ai_solvability": None, "time_to_market": None, "recurring_potential": None,
+        "weighted_score": None, "score": None, "who_is_affected": None, "real_world_example": None,
+        "why_it_matters": None, "fingerprint": None, "source_id": None, "status": "new",
+        "created_by": None, "created_at": _now,
+    },
+    "solutions": {
+        "problem_id": None, "title": None, "description": None, "approach": None, "sector": None,
+        "sub_sector": None, "status": "proposed", "created_by": None, "created_at": _now,
+    },
+    "solution_scores": {
+        "solution_id": None, "feasibility_score": None, "impact_score": None, "cost_estimate": None,
+        "complexity": None, "time_to_market": None, "nocode_compatible": True, "overall_score": None,
+        "notes": None, "scored_by": None, "created_at": _now,
+    },
+    "agent_logs": {
+        "agent_id": None, "action": None, "layer": None, "input_summary": None, "output_summary": None,
+        "model_used": None, "tokens_input": 0, "tokens_output": 0, "cost_usd": 0, "duration_ms": 0,
+        "status": "success", "error": None, "retries": 0, "circuit_state": None, "created_at": _now,
+    },
+    "agent_events": {
+        "event_type": None, "source_agent": None, "target_agent": None, "payload": None,
+        "priority": "normal", "status": "pending", "processed_at": None, "created_at": _now,
+    },
+    "scan_sources": {
+        "name": None, "url": None, "category": None, "sectors": None, "relevance_score": 0.5,
+        "problems_found": 0, "avg_problem_score": 0, "status": "active", "notes": None,
+        "last_scanned": None, "created_at": _now,
+    },
+    "org_config": {"key": None, "value": None, "description": None, "updated_at": _now},
+    "org_knowledge": {
+        "title": None, "content": None, "category": "general", "source": None, "embedding": None,
+        "occurrences": 1, "created_at": _now, "last_seen_at": _now,
+    },
+    "capability_log": {
+        "tool_name": None, "category": None, "description": None, "potential_impact": None,
+        "cost": None, "status": "discovered", "created_at": _now,
+    },
+    "llm_cache": {"key": None, "agent_id": None, "model": None, "response": None, "created_at": _now, "expires_at": None},
+    "problem_dossiers": {
+        "problem_id": None, "sector": None, "keywords": list, "embedding": None, "dossier": None,
+        "based_on": None, "reuse_count": 0, "created_at": _now, "researched_at": _now, "last_used_at": None,
+    },
+    "architect_artifacts": {"problem_id": None, "phase": None, "version": None, "payload": None, "created_at": _now, "updated_at": _now},
+}
+
+# tabella -> [(colonne, nome indice)]
+UNIQUE = {
+    "problems": [(("fingerprint",), "idx_problems_fingerprint")],
+    "org_config": [(("key",), "org_config_key_key")],
+    "llm_cache": [(("key",), "llm_cache_pkey")],
+    "architect_artifacts": [(("problem_id", "phase", "version"), "architect_artifacts_pkey")],
+}
+
+WRITE_OPS = ("insert", "update", "upsert", "delete")
+
+
+class MemoryDBError(Exception):
+    """Stessa forma dei messaggi di PostgREST/Postgres, cosi' i controlli sul testo dell'errore funzionano."""
+
+
+class Result:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+RoundTrip = collections.namedtuple("RoundTrip", "table op rows ms caller")
+
+
+class MemorySupabase:
+    """Client finto: stesse chiamate di supabase-py, dati in dict, un round trip per execute()."""
+
+    def __init__(self, tables=None, latency_ms=5.0, per_row_ms=0.0, strict=True):
+        self.latency_ms = latency_ms
+        self.per_row_ms = per_row_ms
+        self.strict = strict
+        self.tables = collections.defaultdict(list)
+        self.rpcs = dict(RPCS)
+        self.trips = []
+        self._lock = threading.RLock()
+        self._ids = collections.defaultdict(int)
+        self._unique = collections.defaultdict(dict)
+        for name, rows in (tables or {}).items():
+            self.load(name, rows)
+
+    def load(self, name, rows):
+        """Carica righe esistenti (dataset) senza contare round trip."""
+        with self._lock:
+            for row in rows:
+                self._insert_row(name, dict(row), check=False)
+
+    def register_rpc(self, name, fn):
+        """fn(db, **params) -> lista di righe. Le rpc non registrate ritornano []."""
+        self.rpcs[name] = fn
+
+    def table(self, name):
+        return Query(self, name)
+
+    def rpc(self, fn, params=None, **kwargs):
+        return Query(self, fn, op="rpc", params=params or {})
+
+    # --- misure
+
+    @property
+    def round_trips(self):
+        return len(self.trips)
+
+    def busy_ms(self, trips=None):
+        return sum(t.ms for t in (self.trips if trips is None else trips))
+
+    def rows_returned(self, trips=None):
+        return sum(t.rows for t in (self.trips if trips is None else trips))
+
+    def by_op(self, trips=None):
+        return collections.Counter(f"{t.table}.{t.op}" for t in (self.trips if trips is None else trips))
+
+    def hotspots(self, trips=None, top=10):
+        """Chiamanti con piu' round trip: un N+1 appare come tante chiamate dalla stessa riga."""
+        return collections.Counter(f"{t.caller} {t.table}.{t.op}" for t in (self.trips if trips is None else trips)).most_common(top)
+
+    @contextmanager
+    def measure(self):
+        start = len(self.trips)
+        window = []
+        try:
+            yield window
+        finally:
+            window.extend(self.trips[start:])
+
+    def report(self, trips=None):
+        trips = self.trips if trips is None else trips
+        lines = [f"{len(trips)} round trip, {self.rows_returned(trips)} righe, {self.busy_ms(trips):.1f} ms"]
+        for key, n in self.hotspots(trips):
+            lines.append(f"  {n:5}  {key}")
+        return "\n".join(lines)
+
+    # --- storage
+
+    def _next_id(self, table):
+        self._ids[table] += 1
+        return self._ids[table]
+
+    def _check_columns(self, table, row):
+        schema = SCHEMAS.get(table)
+        if not (self.strict and schema):
+            return
+        for col in row:
+            if col != "id" and col not in schema:
+                raise MemoryDBError(f"{{'code': 'PGRST204', 'message': \"Could not find the '{col}' column of '{table}' in the schema cache\"}}")
+
+    def _unique_keys(self, table, row):
+        for cols, index in UNIQUE.get(table, []):
+            values = tuple(row.get(c) for c in cols)
+            if None not in values:
+                yield index, values
+
+    def _insert_row(self, table, row, check=True):
+        if check:
+            self._check_columns(table, row)
+        for col, default in SCHEMAS.get(table, {}).items():
+            if col not in row:
+                row[col] = default() if callable(default) else copy.deepcopy(default)
+        if row.get("id") is None:
+            row["id"] = self._next_id(table)
+        else:
+            self._ids[table] = max(self._ids[table], row["id"]) if isinstance(row["id"], int) else self._ids[table]
+        for index, values in self._unique_keys(table, row):
+            if values in self._unique[(table, index)]:
+                raise MemoryDBError(f"{{'code': '23505', 'message': 'duplicate key value violates unique constraint \"{index}\"'}}")
+        for index, values in self._unique_keys(table, row):
+            self._unique[(table, index)][values] = row
+        self.tables[table].append(row)
+        return row
+
+    def _reindex(self, table):
+        for cols, index in UNIQUE.get(table, []):
+            self._unique[(table, index)] = {tuple(r.get(c) for c in cols): r for r in self.tables[table]
+                                            if None not in tuple(r.get(c) for c in cols)}
+
+    def _find_conflict(self, table, row, on_conflict):
+        cols = tuple(c.strip() for c in on_conflict.split(","))
+        values = tuple(row.get(c) for c in cols)
+        if None in values:
+            return None
+        for cols_u, index in UNIQUE.get(table, []):
+            if cols_u == cols:
+                return self._unique[(table, index)].get(values)
+        return next((r for r in self.tables[table] if tuple(r.get(c) for c in cols) == values), None)
+
+
+def _caller():
+    """Primo frame fuori da memdb e dai wrapper execute() dei servizi."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        if not code.co_filename.endswith("memdb.py") and code.co_name != "execute":
+            return f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+        frame = frame.f_back
+    return "?"
+
+
+def _coerce(value, target):
+    """PostgREST confronta con il tipo della colonna: '5' == 5 su una colonna intera."""
+    if isinstance(target, str) and isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return type(value)(target)
+        except ValueError:
+            return target
+    if isinstance(target, str) and isinstance(value, bool):
+        return target.lower() == "true"
+    return target
+
+
+def _cmp(op, target):
+    def check(value):
+        if value is None:
+            return False
+        try:
+            return op(value, _coerce(value, target))
+        except TypeError:
+            return False
+    return check
+
+
+def _like(pattern, flags=0):
+    regex = re.compile("^" + re.escape(pattern).replace("%", ".*").replace("_", ".") + "$", flags | re.DOTALL)
+    return lambda value: value is not None and bool(regex.match(str(value)))
+
+
+class Query:
+    def __init__(self, db, table, op="select", params=None):
+        self.db = db
+        self.table_name = table
+        self.op = op
+        self.params = params
+        self.columns = "*"
+        self.count_mode = None
+        self.filters = []
+        self.orders = []
+        self.offset = 0
+        self.limit_n = None
+        self.payload = None
+        self.on_conflict = "id"
+        self.ignore_duplicates = False
+        self.single_row = False
+        self._negate = False
+
+    # --- operazioni
+
+    def select(self, columns="*", count=None):
+        if self.op not in WRITE_OPS:
+            self.op = "select"
+        self.columns, self.count_mode = columns, count
+        return self
+
+    def insert(self, rows, **kwargs):
+        self.op, self.payload = "insert", rows
+        return self
+
+    def update(self, values, **kwargs):
+        self.op, self.payload = "update", values
+        return self
+
+    def upsert(self, rows, on_conflict="id", ignore_duplicates=False, **kwargs):
+        self.op, self.payload = "upsert", rows
+        self.on_conflict, self.ignore_duplicates = on_conflict or "id", ignore_duplicates
+        return self
+
+    def delete(self, **kwargs):
+        self.op = "delete"
+        return self
+
+    # --- filtri
+
+    @property
+    def not_(self):
+        self._negate = True
+        return self
+
+    def _add(self, col, test):
+        negate, self._negate = self._negate, False
+        self.filters.append((col, test, negate))
+        return self
+
+    def eq(self, col, value):
+        return self._add(col, _cmp(operator.eq, value))
+
+    def neq(self, col, value):
+        return self._add(col, _cmp(operator.ne, value))
+
+    def gt(self, col, value):
+        return self._add(col, _cmp(operator.gt, value))
+
+    def gte(self, col, value):
+        return self._add(col, _cmp(operator.ge, value))
+
+    def lt(self, col, value):
+        return self._add(col, _cmp(operator.lt, value))
+
+    def lte(self, col, value):
+        return self._add(col, _cmp(operator.le, value))
+
+    def like(self, col, pattern):
+        return self._add(col, _like(pattern))
+
+    def ilike(self, col, pattern):
+        return self._add(col, _like(pattern, re.IGNORECASE))
+
+    def in_(self, col, values):
+        values = list(values)
+        return self._add(col, lambda v: v is not None and any(v == _coerce(v, x) for x in values))
+
+    def is_(self, col, value):
+        if value in (None, "null"):
+            return self._add(col, lambda v: v is None)
+        flag = value if isinstance(value, bool) else str(value).lower() == "true"
+        return self._add(col, lambda v: v is flag)
+
+    # --- forma del risultato
+
+    def order(self, col, desc=False, nullsfirst=None, **kwargs):
+        self.orders.append((col, desc, nullsfirst))
+        return self
+
+    def limit(self, n, **kwargs):
+        self.limit_n = n
+        return self
+
+    def range(self, start, end):
+        self.offset, self.limit_n = start, end - start + 1
+        return self
+
+    def single(self):
+        self.single_row = True
+        self.limit_n = 1
+        return self
+
+    maybe_single = single
+
+    # --- esecuzione
+
+    def _match(self, row):
+        return all(test(row.get(col)) != negate for col, test, negate in self.filters)
+
+    def execute(self):
+        start = time.perf_counter()
+        caller = _caller()
+        with self.db._lock:
+            result = self._run()
+        rows = len(result.data) if isinstance(result.data, list) else (1 if result.data else 0)
+        wait = self.db.latency_ms + rows * self.db.per_row_ms
+        if wait > 0:
+            time.sleep(wait / 1000)
+        ms = (time.perf_counter() - start) * 1000
+        self.db.trips.append(RoundTrip(self.table_name, self.op, rows, ms, caller))
+        return result
+
+    def _run(self):
+        db, table = self.db, self.table_name
+        if self.op == "rpc":
+            fn = db.rpcs.get(table)
+            return Result(fn(db, **self.params) if fn else [])
+        if self.op == "insert":
+            rows = self.payload if isinstance(self.payload, list) else [self.payload]
+            return Result([dict(db._insert_row(table, dict(r))) for r in rows])
+        if self.op == "upsert":
+            out = []
+            for r in (self.payload if isinstance(self.payload, list) else [self.payload]):
+                db._check_columns(table, r)
+                existing = db._find_conflict(table, r, self.on_conflict)
+                if existing is None:
+                    out.append(dict(db._insert_row(table, dict(r))))
+                elif not self.ignore_duplicates:
+                    existing.update(copy.deepcopy(r))
+                    db._reindex(table)
+                    out.append(dict(existing))
+            return Result(out)
+        source = VIEWS[table](db) if table in VIEWS else db.tables[table]
+        matched = [r for r in source if self._match(r)]
+        if self.op == "update":
+            db._check_columns(table, self.payload)
+            for r in matched:
+                r.update(copy.deepcopy(self.payload))
+            db._reindex(table)
+            return Result([dict(r) for r in matched])
+        if self.op == "delete":
+            gone = {id(r) for r in matched}
+            db.tables[table] = [r for r in db.tables[table] if id(r) not in gone]
+            db._reindex(table)
+            return Result([dict(r) for r in matched])
+        count = len(matched) if self.count_mode == "exact" else None
+        for col, desc, nullsfirst in reversed(self.orders):
+            nulls_first = desc if nullsfirst is None else nullsfirst
+            present = [r for r in matched if r.get(col) is not None]
+            missing = [r for r in matched if r.get(col) is None]
+            present.sort(key=lambda r: r.get(col), reverse=desc)
+            matched = missing + present if nulls_first else present + missing
+        end = None if self.limit_n is None else self.offset + self.limit_n
+        matched = matched[self.offset:end]
+        data = [self._project(r) for r in matched]
+        if self.single_row:
+            return Result(data[0] if data else None, count)
+        return Result(data, count)
+
+    def _project(self, row):
+        if self.columns.strip() == "*":
+            return copy.deepcopy(row)
+        cols = [c.strip() for c in self.columns.split(",") if c.strip()]
+        if self.db.strict and self.table_name in SCHEMAS:
+            for c in cols:
+                if c != "id" and c not in SCHEMAS[self.table_name] and c not in row:
+                    raise MemoryDBError(f"{{'code': '42703', 'message': 'column {self.table_name}.{c} does not exist'}}")
+        return {c: copy.deepcopy(row.get(c)) for c in cols}
+
+
+def match_dossiers(db, query_embedding, match_sector=None, min_similarity=0.6, max_age_hours=336, match_count=1):
+    """Come la funzione SQL: similarita' coseno (embedding gia' normalizzati) nello stesso settore,
+    eta' misurata da researched_at."""
+    cutoff = datetime.now(timezone.utc).timestamp() - max_age_hours * 3600
+    out = []
+    for row in db.tables["problem_dossiers"]:
+        if match_sector is not None and row["sector"] != match_sector:
+            continue
+        if datetime.fromisoformat(row["researched_at"]).timestamp() < cutoff:
+            continue
+        similarity = sum(a * b for a, b in zip(row["embedding"], query_embedding))
+        if similarity >= min_similarity:
+            out.append(dict({k: row[k] for k in ("id", "problem_id", "sector", "keywords", "dossier", "reuse_count", "created_at", "researched_at")},
+                similarity=similarity))
+    return sorted(out, key=lambda r: -r["similarity"])[:match_count]
+
+
+def save_solutions_batch(db, p_problem_id, p_items):
+    """Come la funzione SQL: tutte le soluzioni e i loro score o niente."""
+    with db._lock:
+        written = []
+        try:
+            out = []
+            for ordinal, item in enumerate(p_items, 1):
+                solution = db._insert_row("solutions", dict(item["solution"], problem_id=p_problem_id))
+                written.append(("solutions", solution))
+                score = db._insert_row("solution_scores", dict(item["score"], solution_id=solution["id"]))
+                written.append(("solution_scores", score))
+                out.append({"ordinal": ordinal, "solution_id": solution["id"]})
+            return out
+        except Exception:
+            for table, row in written:
+                db.tables[table] = [r for r in db.tables[table] if r is not row]
+            raise
+
+
+def _cosine(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+def save_lesson(db, p_title, p_content, p_category, p_source, p_embedding, p_min_similarity=0.9):
+    """Come la funzione SQL: fonde con la lezione piu' simile della stessa categoria o inserisce."""
+    with db._lock:
+        candidates = [(_cosine(r["embedding"], p_embedding), r) for r in db.tables["org_knowledge"]
+                      if r["category"] == p_category and r.get("embedding") is not None]
+        candidates = [c for c in candidates if c[0] >= p_min_similarity]
+        if candidates:
+            row = max(candidates, key=lambda c: c[0])[1]
+            row["occurrences"] = (row.get("occurrences") or 1) + 1
+            row["last_seen_at"] = _now()
+            return [{"id": row["id"], "merged": True, "occurrences": row["occurrences"]}]
+        row = db._insert_row("org_knowledge", {"title": p_title, "content": p_content, "category": p_category,
+            "source": p_source, "embedding": p_embedding})
+        return [{"id": row["id"], "merged": False, "occurrences": row["occurrences"]}]
+
+
+def backfill_lesson(db, p_id, p_embedding, p_min_similarity=0.9):
+    """Come la funzione SQL: fonde la riga senza embedding nella lezione piu' simile della stessa
+    categoria (e la cancella) oppure le assegna l'embedding."""
+    with db._lock:
+        row = next((r for r in db.tables["org_knowledge"] if r["id"] == p_id and r.get("embedding") is None), None)
+        if row is None:
+            return []
+        candidates = [(_cosine(r["embedding"], p_embedding), r) for r in db.tables["org_knowledge"]
+                      if r["category"] == row["category"] and r is not row and r.get("embedding") is not None]
+        candidates = [c for c in candidates if c[0] >= p_min_similarity]
+        if candidates:
+            target = max(candidates, key=lambda c: c[0])[1]
+            db.tables["org_knowledge"] = [r for r in db.tables["org_knowledge"] if r is not row]
+            target["occurrences"] = (target.get("occurrences") or 1) + (row.get("occurrences") or 1)
+            target["last_seen_at"] = max(target.get("last_seen_at") or "", row.get("last_seen_at") or "")
+            return [{"id": target["id"], "merged": True, "occurrences": target["occurrences"]}]
+        row["embedding"] = p_embedding
+        return [{"id": row["id"], "merged": False, "occurrences": row.get("occurrences") or 1}]
+
+
+def relevant_lessons(db, query_embedding, match_count=3, frequency_weight=0.05):
+    """Come la funzione SQL: i match_count * 10 piu' vicini, riordinati con il peso della frequenza."""
+    rows = [dict({k: r.get(k) for k in ("id", "title", "content", "category", "occurrences", "last_seen_at")},
+                 similarity=_cosine(r["embedding"], query_embedding))
+            for r in db.tables["org_knowledge"] if r.get("embedding") is not None]
+    rows = sorted(rows, key=lambda r: -r["similarity"])[:match_count * 10]
+    return sorted(rows, key=lambda r: -(r["similarity"] + frequency_weight * math.log(r["occurrences"] or 1)))[:match_count]
+
+
+# RPC del progetto reale disponibili di default (le altre ritornano [])
+RPCS = {"match_dossiers": match_dossiers, "save_solutions_batch": save_solutions_batch,
+        "save_lesson": save_lesson, "backfill_lesson": backfill_lesson, "relevant_lessons": relevant_lessons}
+
+
+def problems_needing_solutions(db):
+    solved = {s["problem_id"] for s in db.tables["solutions"]}
+    return [p for p in db.tables["problems"] if p["status"] == "approved" and p["id"] not in solved]
+
+
+# View in sola lettura: nome -> righe calcolate dalle tabelle a ogni select
+VIEWS = {"problems_needing_solutions": problems_needing_solutions}
+
+
+def main():
+    """Report dei round trip di get_db_context (CC e God) sul dataset sintetico."""
+    from bench import dataset
+    from bench.replay import load_service
+
+    tables = dataset.build(problems=2000, logs=20000)
+    for service in ("cc", "god"):
+        module = load_service(service)
+        db = MemorySupabase(tables, latency_ms=float(os.getenv("MEMDB_LATENCY_MS", "20")))
+        saved = module.supabase
+        module.supabase = module.TracedSupabase(db) if hasattr(module, "TracedSupabase") else db
+        try:
+            start = time.perf_counter()
+            with db.measure() as trips:
+                module.get_db_context()
+            elapsed = (time.perf_counter() - start) * 1000
+        finally:
+            module.supabase = saved
+        print(f"[{service}] get_db_context: {elapsed:.0f} ms")
+        print(db.report(trips))
+
+
+if __name__ == "__main__":
+    main()
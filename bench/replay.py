@@ -0,0 +1,510 @@
+"""
+brAIn bench — record/replay di Anthropic, Supabase e HTTP (Perplexity, Telegram, GitHub).
+
+In modalita' record i servizi girano con le chiavi vere e ogni coppia
+richiesta/risposta finisce in una cassetta JSONL. In replay la stessa cassetta
+risponde al posto delle API, senza rete e in modo deterministico, opzionalmente
+con la latenza registrata o una latenza fissa.
+
+Il trasporto sostituisce gli oggetti che i moduli usano gia' (`claude`,
+`supabase`, `http_client`), quindi il codice dei servizi non cambia.
+
+    from bench.replay import Cassette, load_service
+
+    runner = load_service("runner")
+    with Cassette("bench/fixtures/scan.jsonl", mode="record").patch(runner):
+        runner.run_world_scanner()
+
+    with Cassette("bench/fixtures/scan.jsonl", latency="recorded").patch(runner):
+        runner.run_world_scanner()
+
+Matching: prima per hash esatto della richiesta, poi (se strict=False) per una
+chiave lasca (modello, tabella+operazione, metodo+host+path) nell'ordine di
+registrazione. Cosi' i prompt con timestamp o contesto DB variabile si
+riproducono lo stesso.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import collections
+import importlib.util
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVICES = {
+    "runner": ("deploy-agents/agents_runner.py", "agents_runner"),
+    "cc": ("deploy/command_center_cloud.py", "command_center_cloud"),
+    "god": ("deploy-god/brain_god.py", "brain_god"),
+}
+
+# Valori finti ma validi per create_client e per i client costruiti all'import
+OFFLINE_ENV = {
+    "SUPABASE_URL": "http://localhost:54321",
+    "SUPABASE_KEY": "replay.replay.replay",
+    "ANTHROPIC_API_KEY": "replay",
+    "PERPLEXITY_API_KEY": "replay",
+    "TELEGRAM_BOT_TOKEN": "0:replay",
+    "GITHUB_TOKEN": "replay",
+}
+
+SECRET_FIELDS = {"access_token", "refresh_token", "id_token", "token"}
+
+
+class ReplayMiss(Exception):
+    pass
+
+
+def load_service(name, offline=True):
+    """Importa un servizio dal suo file. Con offline=True riempie le env mancanti con valori finti."""
+    path, module_name = SERVICES[name]
+    if offline:
+        for k, v in OFFLINE_ENV.items():
+            os.environ.setdefault(k, v)
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def digest(obj):
+    raw = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def redact_url(url):
+    return re.sub(r"/bot[^/]+/", "/bot<redacted>/", url)
+
+
+def redact(obj):
+    if isinstance(obj, dict):
+        return {k: ("<redacted>" if k in SECRET_FIELDS else redact(v)) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [redact(v) for v in obj]
+    return obj
+
+
+class Obj:
+    """Vista ad attributi di un dict registrato. I campi `input` dei tool_use restano dict."""
+
+    def __init__(self, data):
+        for k, v in data.items():
+            setattr(self, k, v if k == "input" else to_obj(v))
+
+    def __repr__(self):
+        return f"Obj({self.__dict__!r})"
+
+
+def to_obj(value):
+    if isinstance(value, dict):
+        return Obj(value)
+    if isinstance(value, list):
+        return [to_obj(v) for v in value]
+    return value
+
+
+def dump_model(obj):
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json")
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    return json.loads(json.dumps(obj, default=lambda o: getattr(o, "__dict__", str(o))))
+
+
+class Cassette:
+    """Una cassetta JSONL: una riga per interazione {kind, key, loose, request, response, latency_ms}.
+
+    latency: None = nessuna attesa, "recorded" = la latenza registrata,
+    numero = millisecondi fissi, dict = millisecondi per kind ("anthropic", "supabase", "http").
+    """
+
+    def __init__(self, path, mode="replay", latency=None, latency_scale=1.0, strict=False):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"mode non valido: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.strict = strict
+        self.entries = []
+        self.stats = collections.Counter()
+        self._lock = threading.Lock()
+        self._exact = collections.defaultdict(collections.deque)
+        self._loose = collections.defaultdict(collections.deque)
+        self._last = {}
+        if mode == "replay":
+            self._load()
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self.entries.append(json.loads(line))
+        for i, e in enumerate(self.entries):
+            self._exact[(e["kind"], e["key"])].append(i)
+            self._loose[(e["kind"], e["loose"])].append(i)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            for e in self.entries:
+                f.write(json.dumps(e, ensure_ascii=False, default=str) + "\n")
+
+    def add(self, kind, key, loose, request, response, latency_ms):
+        with self._lock:
+            self.entries.append({
+                "kind": kind, "key": key, "loose": loose,
+                "request": redact(request), "response": redact(response),
+                "latency_ms": round(latency_ms, 1),
+            })
+            self.stats[f"{kind}.recorded"] += 1
+
+    def take(self, kind, key, loose):
+        """Prossima risposta per la richiesta. Se la coda e' finita ripete l'ultima servita."""
+        with self._lock:
+            buckets = [(self._exact[(kind, key)], "exact")]
+            if not self.strict:
+                buckets.append((self._loose[(kind, loose)], "loose"))
+            for bucket, label in buckets:
+                if bucket:
+                    i = bucket[0]
+                    self._consume(i)
+                    self._last[(kind, key)] = i
+                    self.stats[f"{kind}.{label}"] += 1
+                    return self.entries[i]
+            if (kind, key) in self._last:
+                self.stats[f"{kind}.repeat"] += 1
+                return self.entries[self._last[(kind, key)]]
+            self.stats[f"{kind}.miss"] += 1
+        raise ReplayMiss(f"{kind}: nessuna risposta registrata per {loose}")
+
+    def _consume(self, i):
+        e = self.entries[i]
+        for bucket in (self._exact[(e["kind"], e["key"])], self._loose[(e["kind"], e["loose"])]):
+            try:
+                bucket.remove(i)
+            except ValueError:
+                pass
+
+    def wait(self, kind, entry):
+        if self.latency is None:
+            return
+        if self.latency == "recorded":
+            ms = entry.get("latency_ms", 0)
+        elif isinstance(self.latency, dict):
+            ms = self.latency.get(kind, 0)
+        else:
+            ms = float(self.latency)
+        if ms > 0:
+            time.sleep(ms * self.latency_scale / 1000)
+
+    @contextmanager
+    def patch(self, module):
+        """Sostituisce claude, supabase e http_client del modulo per la durata del blocco."""
+        saved = {name: getattr(module, name) for name in ("claude", "supabase", "http_client") if hasattr(module, name)}
+        real_db = saved.get("supabase")
+        real_db = getattr(real_db, "_client", real_db)
+        if "claude" in saved:
+            module.claude = AnthropicTransport(self, saved["claude"] if self.recording else None)
+        if "supabase" in saved:
+            db = SupabaseTransport(self, real_db if self.recording else None)
+            module.supabase = module.TracedSupabase(db) if hasattr(module, "TracedSupabase") else db
+        if "http_client" in saved:
+            module.http_client = HttpTransport(self, saved["http_client"] if self.recording else None)
+        try:
+            yield self
+        finally:
+            wait_log_sink(module)
+            for name, obj in saved.items():
+                setattr(module, name, obj)
+            if self.recording:
+                self.save()
+
+
+def wait_log_sink(module, timeout=10):
+    """Aspetta che il log sink abbia scritto tutto quello che ha in coda (attraverso il trasporto)."""
+    sink = getattr(module, "log_sink", None)
+    if sink is None:
+        return
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        s = sink.stats()
+        if s["queued"] == 0 and s["written"] + s["failed"] >= s["enqueued"]:
+            return
+        time.sleep(0.02)
+
+
+# ---------------------------------------------------------------- Anthropic
+
+class AnthropicTransport:
+    def __init__(self, cassette, real):
+        self.messages = _Messages(cassette, real.messages if real is not None else None)
+
+
+class _Messages:
+    def __init__(self, cassette, real):
+        self.cassette = cassette
+        self.real = real
+
+    def create(self, **kwargs):
+        key = digest(kwargs)
+        loose = str(kwargs.get("model"))
+        if self.cassette.recording:
+            start = time.perf_counter()
+            response = self.real.create(**kwargs)
+            self.cassette.add("anthropic", key, loose, kwargs, dump_model(response), (time.perf_counter() - start) * 1000)
+            return response
+        entry = self.cassette.take("anthropic", key, loose)
+        self.cassette.wait("anthropic", entry)
+        return to_obj(entry["response"])
+
+    def stream(self, **kwargs):
+        """Come create(): si registra la risposta finale e in replay lo stream viene ricostruito da quella."""
+        if self.cassette.recording:
+            start = time.perf_counter()
+            with self.real.stream(**kwargs) as live:
+                response = live.get_final_message()
+            self.cassette.add("anthropic", digest(kwargs), str(kwargs.get("model")), kwargs,
+                dump_model(response), (time.perf_counter() - start) * 1000)
+            return MessageStream(response)
+        return MessageStream(self.create(**kwargs))
+
+
+class MessageStream:
+    """Interfaccia di anthropic.MessageStream (context manager, eventi, get_final_message)
+    ricostruita da una risposta completa: testo e input dei tool escono a pezzi di `chunk` caratteri."""
+
+    def __init__(self, message, chunk=64, delay_s=0.0):
+        self.message = message
+        self.chunk = chunk
+        self.delay_s = delay_s
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        for index, block in enumerate(self.message.content):
+            if block.type == "tool_use":
+                text, kind, field = json.dumps(block.input, ensure_ascii=False), "input_json_delta", "partial_json"
+            elif block.type == "text":
+                text, kind, field = block.text, "text_delta", "text"
+            else:
+                continue
+            for i in range(0, len(text), self.chunk):
+                if self.delay_s:
+                    time.sleep(self.delay_s)
+                yield Obj({"type": "content_block_delta", "index": index,
+                    "delta": {"type": kind, field: text[i:i + self.chunk]}})
+
+    def get_final_message(self):
+        return self.message
+
+
+# ---------------------------------------------------------------- Supabase
+
+class SupabaseResult:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class SupabaseTransport:
+    def __init__(self, cassette, real):
+        self.cassette = cassette
+        self.real = real
+
+    def table(self, name):
+        return _Query(self.cassette, self.real.table(name) if self.real is not None else None, [["table", name]])
+
+    def rpc(self, fn, params=None, **kwargs):
+        real = self.real.rpc(fn, params or {}, **kwargs) if self.real is not None else None
+        return _Query(self.cassette, real, [["rpc", fn, params or {}, kwargs]])
+
+
+class _Query:
+    """Registra la catena select/eq/order/... e la chiude su execute()."""
+
+    def __init__(self, cassette, real, steps):
+        self._cassette = cassette
+        self._real = real
+        self._steps = steps
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        attr = getattr(self._real, name) if self._real is not None else None
+        if name == "not_":
+            return _Query(self._cassette, attr, self._steps + [["not_"]])
+
+        def step(*args, **kwargs):
+            real = attr(*args, **kwargs) if attr is not None else None
+            return _Query(self._cassette, real, self._steps + [[name, list(args), kwargs]])
+        return step
+
+    def execute(self):
+        key = digest(self._steps)
+        ops = [s[0] for s in self._steps[1:] if s[0] in ("select", "insert", "update", "upsert", "delete")]
+        loose = f"{self._steps[0][0]}:{self._steps[0][1]}.{ops[0] if ops else 'call'}"
+        if self._cassette.recording:
+            start = time.perf_counter()
+            result = self._real.execute()
+            self._cassette.add("supabase", key, loose, self._steps,
+                {"data": result.data, "count": getattr(result, "count", None)},
+                (time.perf_counter() - start) * 1000)
+            return result
+        try:
+            entry = self._cassette.take("supabase", key, loose)
+        except ReplayMiss:
+            # Scritture e rpc non registrate (batch del log sink, refresh dei rollup, purge)
+            # dipendono dal timing dei thread: vengono accettate senza risposta.
+            if self._steps[0][0] == "rpc" or ops[0:1] == ["delete"]:
+                return SupabaseResult([])
+            written = [s for s in self._steps if s[0] in ("insert", "upsert", "update")]
+            if not written:
+                raise
+            rows = written[0][1][0] if written[0][1] else []
+            return SupabaseResult(rows if isinstance(rows, list) else [rows])
+        self._cassette.wait("supabase", entry)
+        return SupabaseResult(entry["response"]["data"], entry["response"].get("count"))
+
+
+# ---------------------------------------------------------------- HTTP
+
+class HttpResponse:
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.headers = headers or {}
+        self.ok = status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+
+class HttpTransport:
+    """Stessa interfaccia di HttpClients (request/get/post/put/async_session/stats/warm/close)."""
+
+    def __init__(self, cassette, real):
+        self.cassette = cassette
+        self.real = real
+
+    def request(self, method, url, **kwargs):
+        body = {k: kwargs.get(k) for k in ("params", "json", "data") if kwargs.get(k) is not None}
+        safe_url = redact_url(url)
+        key = digest([method.upper(), safe_url, body])
+        parts = urlsplit(safe_url)
+        loose = f"{method.upper()} {parts.netloc}{parts.path}"
+        if self.cassette.recording:
+            start = time.perf_counter()
+            r = self.real.request(method, url, **kwargs)
+            self.cassette.add("http", key, loose, {"method": method.upper(), "url": safe_url, "body": body},
+                {"status": r.status_code, "text": r.text, "content_type": r.headers.get("content-type")},
+                (time.perf_counter() - start) * 1000)
+            return r
+        entry = self.cassette.take("http", key, loose)
+        self.cassette.wait("http", entry)
+        res = entry["response"]
+        return HttpResponse(res["status"], res["text"], {"content-type": res.get("content_type")})
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    async def async_session(self):
+        return AsyncSession(self)
+
+    def warm(self, urls):
+        pass
+
+    def stats(self):
+        return {"sync": {}, "async": {}}
+
+    async def close(self):
+        pass
+
+
+class AsyncSession:
+    """Il minimo di aiohttp.ClientSession usato dai servizi: request/get/post come async context manager."""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def request(self, method, url, **kwargs):
+        kwargs.pop("timeout", None)
+        return _AsyncCall(self.transport, method, url, kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class _AsyncCall:
+    def __init__(self, transport, method, url, kwargs):
+        self.args = (transport, method, url, kwargs)
+
+    async def __aenter__(self):
+        transport, method, url, kwargs = self.args
+        r = await asyncio.to_thread(transport.request, method, url, **kwargs)
+        return _AsyncResponse(r)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _AsyncResponse:
+    def __init__(self, r):
+        self.status = r.status_code
+        self._r = r
+
+    async def json(self):
+        return self._r.json()
+
+    async def text(self):
+        return self._r.text
+
+
+def main():
+    """python -m bench.replay <cassetta.jsonl>: riepilogo delle interazioni registrate."""
+    if len(sys.argv) != 2:
+        print("uso: python -m bench.replay <cassetta.jsonl>")
+        sys.exit(1)
+    cassette = Cassette(sys.argv[1])
+    by_loose = collections.defaultdict(lambda: [0, 0.0])
+    for e in cassette.entries:
+        agg = by_loose[(e["kind"], e["loose"])]
+        agg[0] += 1
+        agg[1] += e.get("latency_ms", 0)
+    for (kind, loose), (n, ms) in sorted(by_loose.items()):
+        print(f"{kind:10} {loose:60} {n:5}  {ms / n:8.1f} ms medi")
+    print(f"totale: {len(cassette.entries)} interazioni")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+brAIn bench — benchmark end-to-end di agents runner, Command Center e brAIn God su fake offline.
+
+Ogni scenario gira in un processo separato (stato dei moduli pulito, RSS di picco
+misurabile) sullo stesso dataset sintetico. Per scenario riporta wall time,
+round trip LLM / ricerca / DB, token inviati e RSS di picco, e salva tutto in
+bench/results/<data>-<commit>.json per confrontare le versioni.
+
+    python -m bench.run                                  # tutti gli scenari, dataset 10k/100k
+    python -m bench.run -s knowledge_keeper -s cc_ask_claude --repeat 3
+    python -m bench.run --llm-ms 800 --search-ms 1500 --db-ms 20
+    python -m bench.run --compare bench/results/20261019-1200-abc1234.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+from bench import dataset
+from bench.replay import ROOT, load_service
+from bench.fakes import FakeClaude, FakeHttp, install
+from bench.memdb import MemorySupabase
+
+SCENARIOS = {
+    "world_scanner": ("runner", lambda m: m.run_world_scanner()),
+    "custom_scan": ("runner", lambda m: m.run_custom_scan("pet care")),
+    "solution_architect": ("runner", lambda m: m.run_solution_architect()),
+    "knowledge_keeper": ("runner", lambda m: m.run_knowledge_keeper()),
+    "cc_ask_claude": ("cc", lambda m: m.ask_claude("Quali sono i problemi piu' promettenti?")),
+    "god_ask_claude": ("god", lambda m: m.ask_claude("Come sta il sistema?")),
+}
+
+# Metriche confrontate con --compare: (chiave, piu' basso e' meglio)
+COMPARED = ["wall_s", "llm_calls", "search_calls", "db_round_trips", "tokens_in", "rss_peak_mb"]
+
+
+def rss_mb():
+    """RSS massimo del processo finora (ru_maxrss e' in KB su Linux, in byte su macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_child(name, args):
+    """Esegue uno scenario nel processo corrente e ritorna le metriche."""
+    service, fn = SCENARIOS[name]
+    tables = dataset.load(args.dataset)
+    module = load_service(service)
+    claude = FakeClaude(module, latency_ms=args.llm_ms, ms_per_output_token=args.ms_per_token)
+    http = FakeHttp(search_latency_ms=args.search_ms, latency_ms=args.http_ms)
+    db = MemorySupabase(tables, latency_ms=args.db_ms)
+    del tables
+    rss_start = rss_mb()
+
+    with install(module, claude=claude, db=db, http=http, throttle_scale=args.throttle_scale):
+        start = time.perf_counter()
+        if hasattr(module, "run_context"):
+            with module.run_context(f"bench:{name}") as run:
+                result = fn(module)
+            spans = run.summary()
+        else:
+            result = fn(module)
+            spans = None
+        wall = time.perf_counter() - start
+
+    return {
+        "wall_s": round(wall, 3),
+        "llm_calls": claude.stats.total(),
+        "llm_by_kind": dict(claude.stats.calls),
+        "llm_busy_s": round(claude.stats.busy_ms / 1000, 3),
+        "tokens_in": claude.stats.tokens_in,
+        "tokens_out": claude.stats.tokens_out,
+        "search_calls": http.stats_.calls.get("search", 0),
+        "http_calls": http.stats_.total(),
+        "http_by_kind": dict(http.stats_.calls),
+        "db_round_trips": db.round_trips,
+        "db_by_op": dict(db.by_op().most_common()),
+        "db_hotspots": db.hotspots(top=5),
+        "db_busy_s": round(db.busy_ms() / 1000, 3),
+        "db_rows_returned": db.rows_returned(),
+        "rss_start_mb": rss_start,
+        "rss_peak_mb": rss_mb(),
+        "result": _short(result),
+        "run": spans,
+    }
+
+
+def _short(result):
+    text = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False, default=str)
+    return text[:300]
+
+
+def child_argv(name, args, dataset_path):
+    return [sys.executable, "-m", "bench.run", "--child", name, "--dataset", dataset_path,
+            "--llm-ms", str(args.llm_ms), "--search-ms", str(args.search_ms), "--http-ms", str(args.http_ms),
+            "--db-ms", str(args.db_ms), "--ms-per-token", str(args.ms_per_token),
+            "--throttle-scale", str(args.throttle_scale)]
+
+
+def run_scenario(name, args, dataset_path):
+    runs = []
+    for _ in range(args.repeat):
+        proc = subprocess.run(child_argv(name, args, dataset_path), cwd=ROOT, capture_output=True, text=True)
+        if proc.returncode != 0:
+            return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}"}
+        runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    out = dict(runs[-1])
+    out["wall_s"] = round(statistics.median(r["wall_s"] for r in runs), 3)
+    out["wall_s_runs"] = [r["wall_s"] for r in runs]
+    out["rss_peak_mb"] = max(r["rss_peak_mb"] for r in runs)
+    return out
+
+
+def git_sha():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(current, previous_path):
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\nConfronto con {previous_path} ({previous.get('git_sha')}):")
+    for name, cur in current["scenarios"].items():
+        prev = previous.get("scenarios", {}).get(name)
+        if not prev or "error" in prev or "error" in cur:
+            continue
+        parts = []
+        for key in COMPARED:
+            a, b = prev.get(key), cur.get(key)
+            if not a or b is None:
+                continue
+            delta = (b - a) / a * 100
+            flag = " !" if delta > 10 else ""
+            parts.append(f"{key} {a}->{b} ({delta:+.0f}%){flag}")
+        print(f"  {name:20} " + " | ".join(parts))
+
+
+def print_table(report):
+    print(f"{'scenario':20} {'wall s':>8} {'llm':>5} {'search':>6} {'db':>6} {'tok in':>8} {'rss MB':>7}")
+    for name, r in report["scenarios"].items():
+        if "error" in r:
+            print(f"{name:20} ERRORE: {r['error']}")
+            continue
+        print(f"{name:20} {r['wall_s']:8.2f} {r['llm_calls']:5} {r['search_calls']:6} {r['db_round_trips']:6} "
+              f"{r['tokens_in']:8} {r['rss_peak_mb']:7.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end su fake offline")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--problems", type=int, default=10000)
+    parser.add_argument("--logs", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--llm-ms", type=float, default=300)
+    parser.add_argument("--ms-per-token", type=float, default=0.0)
+    parser.add_argument("--search-ms", type=float, default=200)
+    parser.add_argument("--http-ms", type=float, default=50)
+    parser.add_argument("--db-ms", type=float, default=5)
+    parser.add_argument("--throttle-scale", type=float, default=0.0,
+        help="moltiplicatore delle pause di throttling (0 = salta, 1 = come in produzione)")
+    parser.add_argument("--out", help="file JSON dei risultati (default bench/results/<data>-<commit>.json)")
+    parser.add_argument("--compare", help="risultati precedenti con cui confrontare")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--dataset", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args), ensure_ascii=False, default=str))
+        return
+
+    names = args.scenario or list(SCENARIOS)
+    with tempfile.TemporaryDirectory(prefix="brain-bench-") as tmp:
+        dataset_path = os.path.join(tmp, "dataset.json.gz")
+        dataset.save(dataset.build(args.problems, args.logs, seed=args.seed), dataset_path)
+        report = {
+            "git_sha": git_sha(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "config": {k: v for k, v in vars(args).items() if k not in ("child", "dataset", "out", "compare", "scenario")},
+            "scenarios": {},
+        }
+        for name in names:
+            report["scenarios"][name] = run_scenario(name, args, dataset_path)
+
+    out = args.out or os.path.join(ROOT, "bench", "results",
+        f"{datetime.now().strftime('%Y%m%d-%H%M')}-{report['git_sha']}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print_table(report)
+    print(f"\nRisultati salvati in {out}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
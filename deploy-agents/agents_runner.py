@@ -5,17 +5,34 @@ Score normalization, query diversificate, scan custom via chat.
 """
 
 import os
+import re
+import sys
 import json
+import math
 import time
+import uuid
+import queue
+import signal
+import atexit
+import random
 import hashlib
 import logging
 import asyncio
+import collections
+import threading
+import contextvars
+import concurrent.futures
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
+from urllib.parse import urlsplit
+import aiohttp
 from aiohttp import web
 from dotenv import load_dotenv
 import anthropic
 from supabase import create_client
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 
 load_dotenv()
 
@@ -24,7 +41,8 @@ logger = logging.getLogger(__name__)
 
 PORT = int(os.environ.get("PORT", 8080))
 
-claude = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+# I retry li gestisce call_claude (backoff, breaker, fallback): niente retry interni dell'SDK
+claude = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0)
 supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
 PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -53,11 +71,12 @@ def notify_telegram(message):
     if not chat_id or not TELEGRAM_BOT_TOKEN:
         return
     try:
-        requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-            json={"chat_id": chat_id, "text": message},
-            timeout=10,
-        )
+        with span("notify", "telegram"):
+            http_client.post(
+                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
+                json={"chat_id": chat_id, "text": message},
+                timeout=10,
+            )
     except Exception as e:
         logger.error(f"[TELEGRAM] {e}")
 
@@ -97,66 +116,1728 @@ def mark_event_done(event_id, status="completed"):
         pass
 
 
-def log_to_supabase(agent_id, action, layer, input_summary, output_summary, model_used, tokens_in=0, tokens_out=0, cost=0, duration_ms=0, status="success", error=None):
+# ============================================================
+# LOG SINK — agent_logs bufferizzati, un solo flusher in background
+# ============================================================
+
+LOG_SINK_MAX_QUEUE = int(os.getenv("LOG_SINK_MAX_QUEUE", "2000"))
+LOG_SINK_BATCH_SIZE = int(os.getenv("LOG_SINK_BATCH_SIZE", "50"))
+LOG_SINK_FLUSH_MS = int(os.getenv("LOG_SINK_FLUSH_MS", "2000"))
+
+_SINK_STOP = object()
+
+
+class LogSink:
+    """Coda limitata di righe agent_logs, scritte in insert multi-riga da un solo thread.
+
+    Il flush parte ogni batch_size righe o dopo flush_ms dalla prima riga in coda.
+    Se la coda e' piena la riga viene scartata e contata: chi logga non si blocca mai.
+    """
+
+    def __init__(self, table, max_queue, batch_size, flush_ms, on_flush=None):
+        self.table = table
+        self.on_flush = on_flush
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.01, flush_ms / 1000)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._stats = {
+            "enqueued": 0, "written": 0, "dropped": 0, "failed": 0,
+            "batches": 0, "flush_ms_total": 0, "flush_ms_max": 0, "last_flush_ms": 0,
+        }
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="log-sink", daemon=True)
+                    self._thread.start()
+
+    def put(self, row):
+        if self._closed:
+            self._count("dropped")
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            dropped = self._count("dropped")
+            if dropped % 100 == 1:
+                logger.warning(f"[LOG SINK] coda piena, {dropped} righe scartate finora")
+            return False
+        self._count("enqueued")
+        return True
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+            return self._stats[key]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _SINK_STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _SINK_STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            if stop:
+                self._drain()
+                return
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _SINK_STOP:
+                batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        start = time.monotonic()
+        try:
+            supabase.table(self.table).insert(batch).execute()
+            ok = True
+        except Exception as e:
+            ok = False
+            logger.error(f"[LOG SINK] insert di {len(batch)} righe fallito: {e}")
+        elapsed = int((time.monotonic() - start) * 1000)
+        with self._lock:
+            self._stats["written" if ok else "failed"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["flush_ms_total"] += elapsed
+            self._stats["flush_ms_max"] = max(self._stats["flush_ms_max"], elapsed)
+            self._stats["last_flush_ms"] = elapsed
+        if ok and self.on_flush:
+            try:
+                self.on_flush()
+            except Exception as e:
+                logger.error(f"[LOG SINK] on_flush: {e}")
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        s["queued"] = self._queue.qsize()
+        s["flush_ms_avg"] = round(s["flush_ms_total"] / s["batches"], 1) if s["batches"] else 0
+        return s
+
+    def close(self, timeout=10):
+        """Svuota la coda e ferma il flusher. Idempotente, chiamato allo shutdown."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            try:
+                self._queue.put(_SINK_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            logger.info(f"[LOG SINK] chiuso: {self.stats()}")
+
+
+ROLLUP_REFRESH_S = int(os.getenv("ROLLUP_REFRESH_S", "60"))
+
+
+def refresh_rollups(since=None):
+    """Ricalcola agent_logs_hourly/daily dalle ore toccate da since (default: ultime 2 ore)."""
+    since = since or (datetime.now(timezone.utc) - timedelta(hours=2)).isoformat()
+    result = supabase.rpc("refresh_agent_logs_rollups", {"p_since": since}).execute()
+    return result.data
+
+
+class RollupRefresher:
+    """Refresh dei rollup su un thread proprio, mai su quello del log sink.
+
+    Il sink segnala ogni flush riuscito con mark(); al piu' ogni interval secondi, se ci sono
+    state scritture, parte un refresh. Un flush arrivato durante il refresh resta segnato e
+    va in quello successivo: anche le ultime righe di un burst finiscono nei rollup.
+    """
+
+    def __init__(self, interval):
+        self.interval = max(1, interval)
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def mark(self):
+        self._dirty.set()
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="rollup-refresh", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._refresh()
+
+    def _refresh(self):
+        if not self._dirty.is_set():
+            return
+        self._dirty.clear()
+        try:
+            refresh_rollups()
+        except Exception as e:
+            self._dirty.set()
+            logger.error(f"[ROLLUP] refresh: {e}")
+
+    def close(self):
+        """Allo shutdown, dopo lo svuotamento del sink: un ultimo refresh se restano scritture."""
+        self._stop.set()
+        self._refresh()
+
+
+rollup_refresher = RollupRefresher(ROLLUP_REFRESH_S)
+log_sink = LogSink("agent_logs", LOG_SINK_MAX_QUEUE, LOG_SINK_BATCH_SIZE, LOG_SINK_FLUSH_MS, rollup_refresher.mark)
+# atexit in ordine inverso: prima si svuota il sink, poi l'ultimo refresh dei rollup
+atexit.register(rollup_refresher.close)
+atexit.register(log_sink.close)
+
+
+def log_to_supabase(agent_id, action, layer, input_summary, output_summary, model_used, tokens_in=0, tokens_out=0, cost=0, duration_ms=0, status="success", error=None, retries=0, circuit_state=None):
+    log_sink.put({
+        "agent_id": agent_id,
+        "action": action,
+        "layer": layer,
+        "input_summary": input_summary[:500] if input_summary else None,
+        "output_summary": output_summary[:500] if output_summary else None,
+        "model_used": model_used,
+        "tokens_input": tokens_in,
+        "tokens_output": tokens_out,
+        "cost_usd": cost,
+        "duration_ms": duration_ms,
+        "status": status,
+        "error": error,
+        "retries": retries,
+        "circuit_state": circuit_state,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    })
+
+
+# ============================================================
+# COSTI — listino modelli, costo per chiamata, budget per run e per giorno
+# ============================================================
+
+# USD per milione di token. cache_write = scrittura cache 5 minuti, cache_read = lettura.
+MODEL_PRICING = {
+    "claude-haiku-4-5": {"input": 1.0, "output": 5.0, "cache_write": 1.25, "cache_read": 0.10},
+    "claude-sonnet-4-5": {"input": 3.0, "output": 15.0, "cache_write": 3.75, "cache_read": 0.30},
+    "claude-opus-4-6": {"input": 5.0, "output": 25.0, "cache_write": 6.25, "cache_read": 0.50},
+}
+if os.getenv("MODEL_PRICING_JSON"):
+    MODEL_PRICING.update(json.loads(os.getenv("MODEL_PRICING_JSON")))
+
+# Scala di degradazione quando il budget e' stretto: modello -> modello piu' economico
+MODEL_DOWNGRADE = {
+    "claude-opus-4-6": "claude-sonnet-4-5-20250514",
+    "claude-sonnet-4-5-20250514": "claude-haiku-4-5-20251001",
+}
+
+RUN_BUDGET_USD = float(os.getenv("RUN_BUDGET_USD", "0") or 0)
+DAILY_BUDGET_USD = float(os.getenv("DAILY_BUDGET_USD", "0") or 0)
+BUDGET_DEGRADE_RATIO = float(os.getenv("BUDGET_DEGRADE_RATIO", "0.8"))
+DAILY_SPEND_REFRESH_S = 300
+
+
+def model_pricing(model):
+    for prefix, price in MODEL_PRICING.items():
+        if model.startswith(prefix):
+            return price
+    for family in ("haiku", "sonnet", "opus"):
+        if family in model:
+            for prefix, price in MODEL_PRICING.items():
+                if family in prefix:
+                    return price
+    logger.warning(f"[COST] modello senza prezzo: {model}, uso tariffa sonnet")
+    return MODEL_PRICING["claude-sonnet-4-5"]
+
+
+def usage_cost(model, usage):
+    """Costo USD di una risposta a partire da response.usage, token di cache inclusi."""
+    price = model_pricing(model)
+    tokens_in = getattr(usage, "input_tokens", 0) or 0
+    tokens_out = getattr(usage, "output_tokens", 0) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    cost = (
+        tokens_in * price["input"] + tokens_out * price["output"]
+        + cache_write * price["cache_write"] + cache_read * price["cache_read"]
+    ) / 1_000_000
+    return {
+        "tokens_in": tokens_in, "tokens_out": tokens_out,
+        "cache_write": cache_write, "cache_read": cache_read,
+        "cost": round(cost, 6),
+    }
+
+
+class RunStats:
+    """Contabilita' di una singola esecuzione (endpoint o messaggio chat)."""
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.cost = 0.0
+        self.calls = 0
+        self.by_agent = {}
+        self.spans = []
+        self.dropped_spans = 0
+        self._t0 = time.monotonic()
+        self._elapsed = None
+        self._lock = threading.Lock()
+
+    def add(self, agent_id, usage):
+        with self._lock:
+            self.cost += usage["cost"]
+            self.calls += 1
+            a = self.by_agent.setdefault(agent_id, {"calls": 0, "cost_usd": 0.0, "tokens_in": 0, "tokens_out": 0})
+            a["calls"] += 1
+            a["cost_usd"] += usage["cost"]
+            a["tokens_in"] += usage["tokens_in"]
+            a["tokens_out"] += usage["tokens_out"]
+
+    def add_span(self, kind, name, t0, elapsed, error, attrs):
+        with self._lock:
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped_spans += 1
+                return
+            self.spans.append({
+                "kind": kind, "name": name,
+                "start_ms": round((t0 - self._t0) * 1000, 1),
+                "duration_ms": round(elapsed * 1000, 1),
+                "error": error, "attrs": {k: v for k, v in attrs.items() if v is not None},
+            })
+
+    def finish(self):
+        self._elapsed = time.monotonic() - self._t0
+
+    def trace(self):
+        """Summary + span ordinati + totale per tipo: dove e' andato il tempo della run."""
+        data = self.summary()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda x: x["start_ms"])
+            data["dropped_spans"] = self.dropped_spans
+        by_kind = {}
+        for sp in spans:
+            by_kind[sp["kind"]] = round(by_kind.get(sp["kind"], 0) + sp["duration_ms"], 1)
+        data["time_by_kind_ms"] = by_kind
+        data["spans"] = spans
+        return data
+
+    def summary(self):
+        with self._lock:
+            return {
+                "run_id": self.id, "name": self.name, "started_at": self.started_at,
+                "llm_calls": self.calls, "cost_usd": round(self.cost, 6),
+                "elapsed_ms": round((self._elapsed if self._elapsed is not None else time.monotonic() - self._t0) * 1000, 1),
+                "by_agent": {k: dict(v, cost_usd=round(v["cost_usd"], 6)) for k, v in self.by_agent.items()},
+            }
+
+
+_current_run = contextvars.ContextVar("brain_run", default=None)
+
+
+def current_run():
+    return _current_run.get()
+
+
+@contextmanager
+def run_context(name):
+    """Apre una run: i costi delle chiamate Claude fatte dentro il blocco si sommano qui.
+
+    Se una run e' gia' aperta (es. dal profiler o da /all) il blocco si aggrega a quella.
+    """
+    parent = current_run()
+    if parent is not None:
+        yield parent
+        return
+    run = RunStats(name)
+    token = _current_run.set(run)
     try:
-        supabase.table("agent_logs").insert({
-            "agent_id": agent_id,
-            "action": action,
-            "layer": layer,
-            "input_summary": input_summary[:500] if input_summary else None,
-            "output_summary": output_summary[:500] if output_summary else None,
-            "model_used": model_used,
-            "tokens_input": tokens_in,
-            "tokens_output": tokens_out,
-            "cost_usd": cost,
-            "duration_ms": duration_ms,
-            "status": status,
-            "error": error,
-        }).execute()
-    except Exception as e:
-        logger.error(f"[LOG ERROR] {e}")
+        yield run
+    finally:
+        _current_run.reset(token)
+        run.finish()
+        remember_run(run)
+        logger.info(f"[RUN] {run.name} {run.id}: {run.calls} chiamate, ${run.cost:.4f}")
+
 
+_cost_scope = contextvars.ContextVar("brain_cost_scope", default=None)
 
-def extract_json(text):
-    text = text.replace("```json", "").replace("```", "").strip()
+
+@contextmanager
+def cost_scope():
+    """Somma costo e chiamate Claude fatte dentro il blocco, nello stesso contesto (es. un tier della cascade)."""
+    scope = {"cost": 0.0, "calls": 0}
+    token = _cost_scope.set(scope)
     try:
-        return json.loads(text)
-    except:
+        yield scope
+    finally:
+        _cost_scope.reset(token)
+
+
+class CostTracker:
+    """Aggrega i costi per agente e per giorno e applica i budget opzionali.
+
+    Con budget al BUDGET_DEGRADE_RATIO lo stato diventa "tight" e i chiamanti passano
+    al modello piu' economico e fanno meno query; a budget esaurito diventa "exhausted"
+    e le chiamate opzionali vanno saltate.
+    """
+
+    def __init__(self, run_budget, daily_budget):
+        self.run_budget = run_budget
+        self.daily_budget = daily_budget
+        self._lock = threading.Lock()
+        self.by_agent = {}
+        self._day = None
+        self._day_base = 0.0
+        self._day_local = 0.0
+        self._day_refreshed = 0.0
+
+    def record(self, agent_id, model, usage):
+        u = usage_cost(model, usage)
+        with self._lock:
+            self._roll_day()
+            self._day_local += u["cost"]
+            a = self.by_agent.setdefault(agent_id, {"calls": 0, "cost_usd": 0.0, "tokens_in": 0, "tokens_out": 0})
+            a["calls"] += 1
+            a["cost_usd"] += u["cost"]
+            a["tokens_in"] += u["tokens_in"]
+            a["tokens_out"] += u["tokens_out"]
+        run = current_run()
+        if run:
+            run.add(agent_id, u)
+        return u
+
+    def _roll_day(self):
+        today = datetime.now(timezone.utc).date()
+        if self._day != today:
+            self._day = today
+            self._day_base = 0.0
+            self._day_local = 0.0
+            self._day_refreshed = 0.0
+
+    def _load_day_spend(self):
+        """Spesa di oggi dal rollup giornaliero, che include anche le altre istanze."""
+        today = datetime.now(timezone.utc).date().isoformat()
+        rows = supabase.table("agent_logs_daily").select("cost_usd").eq("day", today).execute().data or []
+        return sum(float(r.get("cost_usd") or 0) for r in rows)
+
+    def spent_today(self):
+        with self._lock:
+            self._roll_day()
+            stale = time.monotonic() - self._day_refreshed > DAILY_SPEND_REFRESH_S
+            day = self._day
+        if stale:
+            try:
+                base = self._load_day_spend()
+                with self._lock:
+                    if self._day != day:
+                        return self._day_base + self._day_local
+                    # Il rollup e' in ritardo (refresh periodico, righe ancora nel sink): non si
+                    # sa quali costi locali contenga gia', quindi il totale non scende mai
+                    self._day_base = max(base, self._day_base + self._day_local)
+                    self._day_local = 0.0
+                    self._day_refreshed = time.monotonic()
+            except Exception as e:
+                logger.error(f"[COST] lettura spesa giornaliera: {e}")
+                with self._lock:
+                    self._day_refreshed = time.monotonic()
+        with self._lock:
+            return self._day_base + self._day_local
+
+    def budget_state(self):
+        ratio = 0.0
+        run = current_run()
+        if self.run_budget and run:
+            ratio = max(ratio, run.cost / self.run_budget)
+        if self.daily_budget:
+            ratio = max(ratio, self.spent_today() / self.daily_budget)
+        if ratio >= 1.0:
+            return "exhausted"
+        if ratio >= BUDGET_DEGRADE_RATIO:
+            return "tight"
+        return "ok"
+
+    def allow(self):
+        return self.budget_state() != "exhausted"
+
+    def pick_model(self, model):
+        if self.budget_state() == "ok":
+            return model
+        cheaper = MODEL_DOWNGRADE.get(model, model)
+        if cheaper != model:
+            logger.info(f"[COST] budget stretto: {model} -> {cheaper}")
+        return cheaper
+
+    def snapshot(self):
+        with self._lock:
+            return {k: dict(v, cost_usd=round(v["cost_usd"], 6)) for k, v in self.by_agent.items()}
+
+
+cost_tracker = CostTracker(RUN_BUDGET_USD, DAILY_BUDGET_USD)
+
+
+# ============================================================
+# TRACING — span per fase (search, llm, db, notify, sleep) e metriche Prometheus
+# ============================================================
+
+SPAN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TRACE_KEEP_RUNS = int(os.getenv("TRACE_KEEP_RUNS", "50"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "2000"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Metrics:
+    """Istogrammi di durata per (kind, name) e collector esterni, in formato Prometheus."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._hist = {}
+        self._errors = {}
+        self._collectors = []
+
+    def observe(self, kind, name, seconds, error=False):
+        key = (kind, name)
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None:
+                h = self._hist[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    h["counts"][i] += 1
+                    break
+            h["sum"] += seconds
+            h["count"] += 1
+            if error:
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+    def register(self, collector):
+        """collector() -> lista di (nome, tipo, help, [(labels, valore)])"""
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = [
+            "# HELP brain_span_duration_seconds Durata degli span per tipo e nome",
+            "# TYPE brain_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            hist = {k: {"counts": list(v["counts"]), "sum": v["sum"], "count": v["count"]} for k, v in self._hist.items()}
+            errors = dict(self._errors)
+        for (kind, name), h in sorted(hist.items()):
+            base = [("kind", kind), ("name", name)]
+            cumulative = 0
+            for le, c in zip(self.buckets, h["counts"]):
+                cumulative += c
+                lines.append(f"brain_span_duration_seconds_bucket{_prom_labels(base + [('le', le)])} {cumulative}")
+            lines.append(f"brain_span_duration_seconds_bucket{_prom_labels(base + [('le', '+Inf')])} {h['count']}")
+            lines.append(f"brain_span_duration_seconds_sum{_prom_labels(base)} {h['sum']:.6f}")
+            lines.append(f"brain_span_duration_seconds_count{_prom_labels(base)} {h['count']}")
+        lines.append("# HELP brain_span_errors_total Span terminati con eccezione")
+        lines.append("# TYPE brain_span_errors_total counter")
+        for (kind, name), n in sorted(errors.items()):
+            lines.append(f"brain_span_errors_total{_prom_labels([('kind', kind), ('name', name)])} {n}")
+        for collector in self._collectors:
+            try:
+                for name, mtype, help_text, samples in collector():
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {mtype}")
+                    for labels, value in samples:
+                        lines.append(f"{name}{_prom_labels(labels)} {value}")
+            except Exception as e:
+                logger.error(f"[METRICS] collector: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(SPAN_BUCKETS)
+recent_runs = collections.OrderedDict()
+_recent_runs_lock = threading.Lock()
+
+
+def remember_run(run):
+    with _recent_runs_lock:
+        recent_runs[run.id] = run
+        while len(recent_runs) > TRACE_KEEP_RUNS:
+            recent_runs.popitem(last=False)
+
+
+@contextmanager
+def span(kind, name, **attrs):
+    """Misura un blocco: alimenta l'istogramma e, dentro una run, la sua trace."""
+    t0 = time.monotonic()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        elapsed = time.monotonic() - t0
+        metrics.observe(kind, name, elapsed, error is not None)
+        run = current_run()
+        if run:
+            run.add_span(kind, name, t0, elapsed, error, attrs)
+
+
+def pause(seconds, reason="throttle"):
+    """time.sleep tracciato: le attese compaiono nella trace come span sleep."""
+    with span("sleep", reason):
+        time.sleep(seconds)
+
+
+class _TracedQuery:
+    """Proxy su un query builder supabase: ogni execute() diventa uno span db."""
+
+    _OPS = ("select", "insert", "update", "upsert", "delete")
+
+    def __init__(self, builder, target, op=None):
+        self._builder = builder
+        self._target = target
+        self._op = op
+
+    def __getattr__(self, attr):
+        value = getattr(self._builder, attr)
+        if attr == "execute":
+            def execute(*args, **kwargs):
+                with span("db", f"{self._target}.{self._op or 'query'}"):
+                    return value(*args, **kwargs)
+            return execute
+        op = attr if attr in self._OPS else self._op
+        if callable(value):
+            def call(*args, **kwargs):
+                result = value(*args, **kwargs)
+                if hasattr(result, "execute"):
+                    return _TracedQuery(result, self._target, op)
+                return result
+            return call
+        if hasattr(value, "execute") or attr == "not_":
+            return _TracedQuery(value, self._target, op)
+        return value
+
+
+class TracedSupabase:
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name):
+        return _TracedQuery(self._client.table(name), name)
+
+    def rpc(self, fn, params=None, **kwargs):
+        return _TracedQuery(self._client.rpc(fn, params or {}, **kwargs), f"rpc:{fn}", "call")
+
+    def __getattr__(self, attr):
+        return getattr(self._client, attr)
+
+
+supabase = TracedSupabase(supabase)
+
+
+def _collect_log_sink():
+    s = log_sink.stats()
+    return [
+        ("brain_log_sink_rows_total", "counter", "Righe agent_logs per esito",
+            [([("outcome", k)], s[k]) for k in ("enqueued", "written", "dropped", "failed")]),
+        ("brain_log_sink_queued", "gauge", "Righe in coda", [([], s["queued"])]),
+        ("brain_log_sink_flush_ms", "gauge", "Latenza flush (ultima, media, massima)",
+            [([("stat", "last")], s["last_flush_ms"]), ([("stat", "avg")], s["flush_ms_avg"]), ([("stat", "max")], s["flush_ms_max"])]),
+    ]
+
+
+def _collect_costs():
+    snap = cost_tracker.snapshot()
+    return [
+        ("brain_llm_cost_usd_total", "counter", "Costo LLM per agente",
+            [([("agent", a)], round(v["cost_usd"], 6)) for a, v in snap.items()]),
+        ("brain_llm_calls_total", "counter", "Chiamate LLM per agente",
+            [([("agent", a)], v["calls"]) for a, v in snap.items()]),
+        ("brain_llm_tokens_total", "counter", "Token LLM per agente e direzione",
+            [([("agent", a), ("direction", d)], v[f"tokens_{d}"]) for a, v in snap.items() for d in ("in", "out")]),
+    ]
+
+
+metrics.register(_collect_log_sink)
+metrics.register(_collect_costs)
+
+
+def metrics_authorized(request):
+    if not METRICS_TOKEN:
+        return True
+    return request.headers.get("Authorization", "") == f"Bearer {METRICS_TOKEN}"
+
+
+async def metrics_endpoint(request):
+    if not metrics_authorized(request):
+        return web.Response(text="unauthorized", status=401)
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def traces_endpoint(request):
+    if not metrics_authorized(request):
+        return web.Response(text="unauthorized", status=401)
+    with _recent_runs_lock:
+        runs = list(recent_runs.values())
+    return web.json_response([r.summary() for r in reversed(runs)])
+
+
+async def trace_endpoint(request):
+    if not metrics_authorized(request):
+        return web.Response(text="unauthorized", status=401)
+    with _recent_runs_lock:
+        run = recent_runs.get(request.match_info["run_id"])
+    if not run:
+        return web.json_response({"error": "run non trovata"}, status=404)
+    return web.json_response(run.trace(), headers={
+        "Content-Disposition": f'attachment; filename="trace-{run.id}.json"'})
+
+
+# ============================================================
+# HTTP — client keep-alive condivisi (requests + aiohttp) con statistiche di riuso
+# ============================================================
+
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_KEEPALIVE_S = float(os.getenv("HTTP_KEEPALIVE_S", "60"))
+
+
+class HttpClients:
+    """Una requests.Session e una aiohttp.ClientSession per processo, riusate da tutte le chiamate.
+
+    Il timeout passato dal chiamante vale come timeout di lettura; la connessione ha
+    sempre HTTP_CONNECT_TIMEOUT.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._async_session = None
+        self._async_stats = collections.Counter()
+        self._requests = collections.Counter()
+
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    s = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+                    s.mount("https://", adapter)
+                    s.mount("http://", adapter)
+                    self._session = s
+        return self._session
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self._requests[urlsplit(url).netloc] += 1
+        return self.session().request(method, url, timeout=(HTTP_CONNECT_TIMEOUT, timeout or HTTP_READ_TIMEOUT), **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    async def async_session(self):
+        """ClientSession legata al loop corrente, creata alla prima richiesta."""
+        if self._async_session is None or self._async_session.closed:
+            trace = aiohttp.TraceConfig()
+
+            async def on_create(session, ctx, params):
+                self._async_stats["opened"] += 1
+
+            async def on_reuse(session, ctx, params):
+                self._async_stats["reused"] += 1
+
+            trace.on_connection_create_end.append(on_create)
+            trace.on_connection_reuseconn.append(on_reuse)
+            connector = aiohttp.TCPConnector(limit=HTTP_POOL_MAXSIZE * HTTP_POOL_CONNECTIONS, limit_per_host=HTTP_POOL_MAXSIZE,
+                keepalive_timeout=HTTP_KEEPALIVE_S, ttl_dns_cache=300)
+            self._async_session = aiohttp.ClientSession(connector=connector, trace_configs=[trace],
+                timeout=aiohttp.ClientTimeout(total=HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+        return self._async_session
+
+    async def close(self):
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+        if self._session is not None:
+            self._session.close()
+
+    def warm(self, urls):
+        """Apre in background una connessione verso ogni host, cosi' la prima chiamata vera non paga TLS."""
+        def _warm():
+            for url in urls:
+                try:
+                    self.request("HEAD", url, timeout=5)
+                except Exception as e:
+                    logger.info(f"[HTTP] warm {url}: {e}")
+        threading.Thread(target=_warm, name="http-warm", daemon=True).start()
+
+    def stats(self):
+        hosts = {}
+        adapter = self._session.get_adapter("https://") if self._session else None
+        if adapter is not None:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened = getattr(pool, "num_connections", 0)
+                served = getattr(pool, "num_requests", 0)
+                hosts[pool.host] = {
+                    "requests": served, "connections_opened": opened,
+                    "reuse_ratio": round(1 - opened / served, 3) if served else 0,
+                }
+        return {"sync": hosts, "async": dict(self._async_stats), "requests_by_host": dict(self._requests)}
+
+
+http_client = HttpClients()
+
+
+def _collect_http():
+    st = http_client.stats()
+    return [
+        ("brain_http_requests_total", "counter", "Richieste HTTP uscenti per host",
+            [([("host", h)], v["requests"]) for h, v in st["sync"].items()]),
+        ("brain_http_connections_opened_total", "counter", "Connessioni TCP+TLS aperte per host",
+            [([("host", h)], v["connections_opened"]) for h, v in st["sync"].items()]),
+        ("brain_http_async_connections_total", "counter", "Connessioni aiohttp aperte o riusate",
+            [([("outcome", k)], v) for k, v in st["async"].items()]),
+    ]
+
+
+metrics.register(_collect_http)
+
+
+# ============================================================
+# LLM — client Claude resiliente: retry, semaforo, circuit breaker, fallback
+# ============================================================
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE_S = float(os.getenv("LLM_BACKOFF_BASE_S", "1.5"))
+LLM_BACKOFF_MAX_S = float(os.getenv("LLM_BACKOFF_MAX_S", "30"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "60"))
+LLM_FALLBACK_ENABLED = os.getenv("LLM_FALLBACK_ENABLED", "1") == "1"
+# Con LLM_HEDGE_AFTER_S > 0, se il primario non risponde entro N secondi parte anche il fallback
+LLM_HEDGE_AFTER_S = float(os.getenv("LLM_HEDGE_AFTER_S", "0") or 0)
+LLM_FALLBACK_MODELS = {
+    "claude-sonnet-4-5-20250514": "claude-haiku-4-5-20251001",
+}
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class CircuitBreaker:
+    """closed -> open dopo N chiamate consecutive fallite per indisponibilita' -> half_open dopo il cooldown.
+
+    In half_open passa una sola chiamata di prova: il suo esito richiude o riapre il breaker.
+    Una prova che non riporta l'esito entro il cooldown lascia il posto a un'altra.
+    """
+
+    def __init__(self, model, failures, cooldown):
+        self.model = model
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = None
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.probe_at is not None and now - self.probe_at < self.cooldown:
+                    return False
+                self.probe_at = now
+            return self.state != "open"
+
+    def record_success(self):
+        """Il servizio ha risposto (anche con un errore non di disponibilita')."""
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.probe_at = None
+
+    def record_failure(self):
+        """Una chiamata ha esaurito i retry per errori di disponibilita' (5xx, connessione)."""
+        with self._lock:
+            self.failures += 1
+            self.probe_at = None
+            if self.state == "half_open" or self.failures >= self.max_failures:
+                if self.state != "open":
+                    self.trips += 1
+                    logger.warning(f"[LLM] circuit breaker aperto per {self.model}")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+_llm_semaphore = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+_breakers = {}
+_breakers_lock = threading.Lock()
+llm_stats = collections.Counter()
+
+
+def breaker_for(model):
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(model, LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN_S)
+        return _breakers[model]
+
+
+def llm_retryable(e):
+    if isinstance(e, (anthropic.RateLimitError, anthropic.APIConnectionError, anthropic.InternalServerError)):
+        return True
+    status = getattr(e, "status_code", None)
+    return status in RETRYABLE_STATUS
+
+
+def llm_outage(e):
+    """Errore di disponibilita' che conta per il breaker. 429 e retry-after sono contropressione:
+    il servizio risponde, si rallenta ma non si apre il circuito."""
+    if isinstance(e, anthropic.RateLimitError) or getattr(e, "status_code", None) == 429:
+        return False
+    return llm_retryable(e) and llm_retry_after(e) is None
+
+
+def llm_retry_after(e):
+    """Secondi suggeriti dal server (retry-after / retry-after-ms), se presenti."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
         pass
-    start = text.find("{")
-    if start < 0:
+    return None
+
+
+def llm_backoff(attempt):
+    delay = min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * (2 ** attempt))
+    return delay * (0.5 + random.random() / 2)
+
+
+def response_text(response):
+    return "".join(getattr(b, "text", "") for b in response.content if getattr(b, "type", "") == "text")
+
+
+def response_blocks(response):
+    """Blocchi text/tool_use come dict serializzabili (cache, continuazione della conversazione)."""
+    blocks = []
+    for b in response.content:
+        kind = getattr(b, "type", "")
+        if kind == "text" and getattr(b, "text", ""):
+            blocks.append({"type": "text", "text": b.text})
+        elif kind == "tool_use":
+            blocks.append({"type": "tool_use", "id": b.id, "name": b.name, "input": b.input})
+    return blocks
+
+
+def response_summary(response):
+    """Testo della risposta, o l'input dei tool se la risposta e' solo tool_use."""
+    text = response_text(response)
+    if text:
+        return text
+    return json.dumps([b["input"] for b in response_blocks(response) if b["type"] == "tool_use"],
+        ensure_ascii=False, default=str)
+
+
+class LLMUnavailable(Exception):
+    pass
+
+
+def _stream_message(model, kwargs, on_delta):
+    """messages.stream: passa a on_delta i pezzi di testo / input JSON dei tool, ritorna la Message finale."""
+    with claude.messages.stream(model=model, **kwargs) as stream:
+        for event in stream:
+            if event.type != "content_block_delta":
+                continue
+            if event.delta.type == "input_json_delta":
+                on_delta(event.delta.partial_json)
+            elif event.delta.type == "text_delta":
+                on_delta(event.delta.text)
+        return stream.get_final_message()
+
+
+def _call_model(agent_id, action, layer, input_summary, model, kwargs, on_delta=None):
+    """Una chiamata con retry sullo stesso modello. Logga su agent_logs l'esito finale.
+
+    Con on_delta la risposta arriva in streaming; prima di ogni nuovo tentativo
+    on_delta(None) avvisa il consumatore di ricominciare da capo.
+    """
+    breaker = breaker_for(model)
+    retries = 0
+    start = time.time()
+    if not breaker.allow():
+        llm_stats["breaker_rejected"] += 1
+        log_to_supabase(agent_id, action, layer, input_summary, None, model,
+            status="error", error="circuit breaker aperto", circuit_state=breaker.state)
+        raise LLMUnavailable(f"circuit breaker aperto per {model}")
+    while True:
+        try:
+            with _llm_semaphore:
+                with span("llm", action, model=model, stream=on_delta is not None or None):
+                    if on_delta is None:
+                        response = claude.messages.create(model=model, **kwargs)
+                    else:
+                        if retries:
+                            on_delta(None)
+                        response = _stream_message(model, kwargs, on_delta)
+        except Exception as e:
+            if llm_retryable(e) and retries < LLM_MAX_RETRIES:
+                delay = llm_retry_after(e) or llm_backoff(retries)
+                retries += 1
+                llm_stats["retries"] += 1
+                logger.warning(f"[LLM] {agent_id}/{action} {model}: {type(e).__name__}, retry {retries} tra {delay:.1f}s")
+                pause(min(delay, LLM_BACKOFF_MAX_S), "llm_backoff")
+                continue
+            # Un solo esito per chiamata: conta come guasto solo se l'ultimo errore e' di disponibilita'
+            if llm_outage(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            llm_stats["failures"] += 1
+            log_to_supabase(agent_id, action, layer, input_summary, None, model,
+                duration_ms=int((time.time() - start) * 1000), status="error",
+                error=f"{type(e).__name__}: {e}"[:500], retries=retries, circuit_state=breaker.state)
+            raise
+        breaker.record_success()
+        llm_stats["calls"] += 1
+        usage = cost_tracker.record(agent_id, model, response.usage)
+        scope = _cost_scope.get()
+        if scope is not None:
+            scope["cost"] += usage["cost"]
+            scope["calls"] += 1
+        log_to_supabase(agent_id, action, layer, input_summary, response_summary(response)[:500], model,
+            usage["tokens_in"], usage["tokens_out"], usage["cost"], int((time.time() - start) * 1000),
+            retries=retries, circuit_state=breaker.state)
+        return response
+
+
+# Cache risposte per prompt identici: chiave = hash di (model, system, messages, max_tokens).
+# Opt-in per call site tramite TTL in secondi (0 = non cachare). Memoria LRU davanti alla tabella llm_cache.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "256"))
+LLM_CACHE_PURGE_S = int(os.getenv("LLM_CACHE_PURGE_S", "3600"))
+LLM_CACHE_TTL = {
+    "scan_v2": 3600,
+    "research": 6 * 3600,
+    "assess_feasibility": 6 * 3600,
+    "analyze_logs": 6 * 3600,
+    "analyze_discoveries": 12 * 3600,
+}
+if os.getenv("LLM_CACHE_TTL_JSON"):
+    LLM_CACHE_TTL.update(json.loads(os.getenv("LLM_CACHE_TTL_JSON")))
+
+
+class CachedResponse:
+    """Risposta servita dalla cache: stessa forma di una Message per i campi che usiamo."""
+
+    def __init__(self, payload):
+        self.model = payload.get("model")
+        self.stop_reason = payload.get("stop_reason")
+        self.content = [type("CachedBlock", (), b)() for b in payload.get("content", [])]
+        self.usage = None
+        self.cached = True
+
+
+class LLMCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._mem = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = collections.defaultdict(lambda: {"hits": 0, "db_hits": 0, "misses": 0, "saved_usd": 0.0})
+        self._last_purge = 0.0
+
+    @staticmethod
+    def key(model, kwargs):
+        material = {k: kwargs.get(k) for k in ("system", "messages", "max_tokens", "tools", "tool_choice", "temperature")}
+        material["model"] = model
+        raw = json.dumps(material, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, agent_id, key):
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry and entry[0] > now:
+                self._mem.move_to_end(key)
+                self._hit(agent_id, entry[1], "hits")
+                return CachedResponse(entry[1])
+            if entry:
+                del self._mem[key]
+        try:
+            result = supabase.table("llm_cache").select("response,expires_at").eq("key", key) \
+                .gt("expires_at", datetime.now(timezone.utc).isoformat()).limit(1).execute()
+        except Exception as e:
+            logger.warning(f"[LLM CACHE] lettura: {e}")
+            result = None
+        if result and result.data:
+            row = result.data[0]
+            expires = datetime.fromisoformat(row["expires_at"].replace("Z", "+00:00")).timestamp()
+            with self._lock:
+                self._remember(key, expires, row["response"])
+                self._hit(agent_id, row["response"], "db_hits")
+            return CachedResponse(row["response"])
+        with self._lock:
+            self._stats[agent_id]["misses"] += 1
         return None
-    depth = 0
-    end = start
-    for i in range(start, len(text)):
-        if text[i] == "{":
-            depth += 1
-        elif text[i] == "}":
-            depth -= 1
-            if depth == 0:
-                end = i + 1
-                break
+
+    def put(self, agent_id, key, model, response, ttl):
+        payload = {
+            "model": model,
+            "stop_reason": getattr(response, "stop_reason", None),
+            "content": response_blocks(response),
+            "cost": usage_cost(model, response.usage)["cost"] if response.usage else 0,
+        }
+        expires = time.time() + ttl
+        with self._lock:
+            self._remember(key, expires, payload)
+        try:
+            supabase.table("llm_cache").upsert({
+                "key": key,
+                "agent_id": agent_id,
+                "model": model,
+                "response": payload,
+                "expires_at": datetime.fromtimestamp(expires, timezone.utc).isoformat(),
+            }).execute()
+            if time.time() - self._last_purge > LLM_CACHE_PURGE_S:
+                self._last_purge = time.time()
+                supabase.table("llm_cache").delete().lt("expires_at", datetime.now(timezone.utc).isoformat()).execute()
+        except Exception as e:
+            logger.warning(f"[LLM CACHE] scrittura: {e}")
+
+    def _remember(self, key, expires, payload):
+        self._mem[key] = (expires, payload)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _hit(self, agent_id, payload, kind):
+        self._stats[agent_id][kind] += 1
+        self._stats[agent_id]["saved_usd"] += payload.get("cost", 0) or 0
+
+    def stats(self):
+        with self._lock:
+            out = {}
+            for agent_id, s in self._stats.items():
+                hits = s["hits"] + s["db_hits"]
+                total = hits + s["misses"]
+                out[agent_id] = dict(s, saved_usd=round(s["saved_usd"], 6),
+                    hit_rate=round(hits / total, 3) if total else 0.0)
+            return {"entries": len(self._mem), "by_agent": out}
+
+
+llm_cache = LLMCache(LLM_CACHE_MAX_ENTRIES)
+
+
+def call_claude(agent_id, action, layer, input_summary, model, fallback=None, cache_ttl=None, on_delta=None, **kwargs):
+    """Unico punto d'ingresso per le chiamate Claude degli agenti.
+
+    Ritorna la risposta oppure None se primario e fallback falliscono: i chiamanti
+    gestiscono None come prima gestivano l'eccezione. cache_ttl (default da
+    LLM_CACHE_TTL per azione) abilita la cache per prompt identici. on_delta
+    riceve l'output in streaming (niente cache ne' hedge).
+    """
+    if on_delta is not None:
+        return _call_uncached(agent_id, action, layer, input_summary, model, fallback, kwargs, on_delta)
+    if cache_ttl is None:
+        cache_ttl = LLM_CACHE_TTL.get(action, 0)
+    if not (LLM_CACHE_ENABLED and cache_ttl > 0):
+        return _call_uncached(agent_id, action, layer, input_summary, model, fallback, kwargs)
+    key = LLMCache.key(model, kwargs)
+    cached = llm_cache.get(agent_id, key)
+    if cached is not None:
+        logger.info(f"[LLM CACHE] hit {agent_id}/{action} {key[:12]}")
+        return cached
+    response = _call_uncached(agent_id, action, layer, input_summary, model, fallback, kwargs)
+    if response is not None and getattr(response, "stop_reason", None) != "max_tokens":
+        llm_cache.put(agent_id, key, getattr(response, "model", None) or model, response, cache_ttl)
+    return response
+
+
+def _call_uncached(agent_id, action, layer, input_summary, model, fallback, kwargs, on_delta=None):
+    if fallback is None and LLM_FALLBACK_ENABLED:
+        fallback = LLM_FALLBACK_MODELS.get(model)
+    if fallback and LLM_HEDGE_AFTER_S > 0 and on_delta is None:
+        return _call_hedged(agent_id, action, layer, input_summary, model, fallback, kwargs)
     try:
-        return json.loads(text[start:end])
-    except:
+        return _call_model(agent_id, action, layer, input_summary, model, kwargs, on_delta)
+    except Exception as e:
+        logger.error(f"[LLM] {agent_id}/{action} {model}: {e}")
+    if not fallback:
         return None
+    llm_stats["fallbacks"] += 1
+    if on_delta is not None:
+        on_delta(None)
+    try:
+        return _call_model(agent_id, action, layer, input_summary, fallback, kwargs, on_delta)
+    except Exception as e:
+        logger.error(f"[LLM] {agent_id}/{action} fallback {fallback}: {e}")
+    return None
+
+
+_hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm-hedge")
+
+
+def _call_hedged(agent_id, action, layer, input_summary, model, fallback, kwargs):
+    """Parte il primario; se non risponde entro LLM_HEDGE_AFTER_S parte anche il fallback, vince il primo."""
+    def submit(m):
+        ctx = contextvars.copy_context()
+        return _hedge_pool.submit(ctx.run, _call_model, agent_id, action, layer, input_summary, m, kwargs)
+
+    pending = {submit(model)}
+    done, _ = concurrent.futures.wait(pending, timeout=LLM_HEDGE_AFTER_S)
+    if not done or next(iter(done)).exception() is not None:
+        llm_stats["hedges"] += 1
+        pending.add(submit(fallback))
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                return f.result()
+            logger.error(f"[LLM] {agent_id}/{action} hedge: {f.exception()}")
+    return None
+
+
+def _collect_llm():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    cache = llm_cache.stats()
+    return [
+        ("brain_llm_events_total", "counter", "Retry, fallimenti, hedge e rifiuti del breaker",
+            [([("event", k)], v) for k, v in llm_stats.items()]),
+        ("brain_llm_breaker_open", "gauge", "1 se il circuit breaker del modello e' aperto",
+            [([("model", b.model)], 1 if b.state == "open" else 0) for b in breakers]),
+        ("brain_llm_breaker_trips_total", "counter", "Aperture del circuit breaker per modello",
+            [([("model", b.model)], b.trips) for b in breakers]),
+        ("brain_llm_cache_requests_total", "counter", "Lookup cache LLM per agente ed esito",
+            [([("agent", a), ("outcome", k)], v[k]) for a, v in cache["by_agent"].items() for k in ("hits", "db_hits", "misses")]),
+        ("brain_llm_cache_saved_usd_total", "counter", "Costo evitato grazie alla cache LLM",
+            [([("agent", a)], v["saved_usd"]) for a, v in cache["by_agent"].items()]),
+    ]
+
+
+metrics.register(_collect_llm)
 
 
-def search_perplexity(query):
+# ============================================================
+# JSON — estrazione dalle risposte LLM (stessa implementazione di agents/json_extract.py)
+# ============================================================
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _DECODE_ERRORS = (orjson.JSONDecodeError, ValueError)
+except ImportError:
+    _loads = json.loads
+    _DECODE_ERRORS = (ValueError,)
+
+_JSON_TOKENS = re.compile(r'[{}\[\]"\\,]')
+_JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+_CLOSERS = {"{": "}", "[": "]"}
+# Prose con molte parentesi prima del JSON: oltre questi tentativi si rinuncia
+_MAX_CANDIDATES = 8
+
+extract_stats = collections.Counter()
+
+
+def _scan(text, start):
+    """Cammina da text[start] ('{' o '[') fino alla chiusura bilanciata.
+
+    Ritorna (end, None) se il valore e' completo, altrimenti (None, cut) dove cut
+    e' (posizione, pila aperta) dell'ultima virgola utile per troncare.
+    """
+    stack = []
+    in_string = False
+    skip = -1
+    cut_array = cut_any = None
+    for m in _JSON_TOKENS.finditer(text, start):
+        i = m.start()
+        if i == skip:
+            continue
+        c = m.group()
+        if in_string:
+            if c == "\\":
+                skip = i + 1
+            elif c == '"':
+                in_string = False
+            continue
+        if c == '"':
+            in_string = True
+        elif c == "{" or c == "[":
+            stack.append(c)
+        elif c == "}" or c == "]":
+            if not stack or _CLOSERS[stack[-1]] != c:
+                return None, cut_array or cut_any
+            stack.pop()
+            if not stack:
+                return i + 1, None
+        elif c == "," and stack:
+            cut_any = (i, tuple(stack))
+            if stack[-1] == "[":
+                cut_array = (i, tuple(stack))
+    return None, cut_array or cut_any
+
+
+def _strip_trailing_commas(s):
+    """Toglie le virgole prima di } o ], solo fuori dalle stringhe."""
+    out = []
+    pos = 0
+    for m in _JSON_STRING.finditer(s):
+        out.append(_TRAILING_COMMA.sub(r"\1", s[pos:m.start()]))
+        out.append(m.group())
+        pos = m.end()
+    out.append(_TRAILING_COMMA.sub(r"\1", s[pos:]))
+    return "".join(out)
+
+
+def _decode(s):
     try:
-        response = requests.post(
-            "https://api.perplexity.ai/chat/completions",
-            headers={
-                "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": "sonar",
-                "messages": [{"role": "user", "content": query}],
-                "max_tokens": 600,
-            },
-            timeout=30,
-        )
+        return _loads(s), True
+    except _DECODE_ERRORS:
+        pass
+    try:
+        return _loads(_strip_trailing_commas(s)), True
+    except _DECODE_ERRORS:
+        return None, False
+
+
+def extract_json(text, arrays=False):
+    """Primo oggetto JSON nel testo (anche array con arrays=True), riparato se possibile.
+
+    None se non c'e' niente di valido.
+    """
+    if not text:
+        return None
+    stripped = text.strip()
+    if stripped[:1] == "{" or (arrays and stripped[:1] == "["):
+        try:
+            result = _loads(stripped)
+            extract_stats["direct"] += 1
+            return result
+        except _DECODE_ERRORS:
+            pass
+
+    start = -1
+    for _ in range(_MAX_CANDIDATES):
+        candidates = [p for p in (text.find("{", start + 1), text.find("[", start + 1) if arrays else -1) if p >= 0]
+        if not candidates:
+            break
+        start = min(candidates)
+        end, cut = _scan(text, start)
+        if end is not None:
+            result, ok = _decode(text[start:end])
+            if ok:
+                extract_stats["scanned"] += 1
+                return result
+            continue
+        if cut is not None:
+            pos, stack = cut
+            result, ok = _decode(text[start:pos] + "".join(_CLOSERS[c] for c in reversed(stack)))
+            if ok:
+                extract_stats["repaired_truncated"] += 1
+                return result
+    extract_stats["failed"] += 1
+    return None
+
+
+def _collect_json_extract():
+    return [
+        ("brain_json_extract_total", "counter", "Estrazioni JSON dalle risposte LLM per esito",
+            [([("outcome", k)], v) for k, v in extract_stats.items()]),
+    ]
+
+
+metrics.register(_collect_json_extract)
+
+
+# ============================================================
+# STRUCTURED OUTPUT — tool forzati con schema JSON, re-request dei soli item invalidi
+# ============================================================
+
+# Re-request massimi per chiamata: oltre, gli item ancora invalidi vengono scartati
+STRUCTURED_MAX_REREQUESTS = int(os.getenv("STRUCTURED_MAX_REREQUESTS", "3"))
+STRUCTURED_ITEM_MAX_TOKENS = int(os.getenv("STRUCTURED_ITEM_MAX_TOKENS", "1024"))
+
+_JSON_TYPES = {"object": dict, "array": list, "string": str, "boolean": bool, "number": (int, float), "integer": int}
+
+SCHEMA_STR = {"type": "string"}
+SCHEMA_STRS = {"type": "array", "items": {"type": "string"}}
+SCHEMA_SCORE = {"type": "number", "minimum": 0, "maximum": 1}
+
+
+class OutputTool:
+    """Tool il cui input e' l'output dell'agente. items_key = array validato elemento per elemento."""
+
+    def __init__(self, name, description, properties, required, items_key):
+        self.name = name
+        self.items_key = items_key
+        self.schema = {"type": "object", "properties": properties, "required": required}
+        self.item_schema = properties[items_key]["items"]
+        self.spec = {"name": name, "description": description, "input_schema": self.schema}
+        self.item_spec = {"name": f"{name}_item", "input_schema": self.item_schema,
+            "description": f"Un solo elemento di {items_key}, corretto"}
+
+
+def _type_ok(expected, value):
+    if isinstance(expected, list):
+        return any(_type_ok(t, value) for t in expected)
+    if isinstance(value, bool) and expected in ("number", "integer"):
+        return False
+    return isinstance(value, _JSON_TYPES[expected])
+
+
+def schema_errors(schema, value, path="$"):
+    """Il sottoinsieme di JSON Schema che usiamo: type, required, properties, items, enum, minimum, maximum."""
+    if "type" in schema and not _type_ok(schema["type"], value):
+        return [f"{path}: atteso {schema['type']}"]
+    errors = []
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path}: {value!r} non in {schema['enum']}")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if "minimum" in schema and value < schema["minimum"]:
+            errors.append(f"{path}: {value} < {schema['minimum']}")
+        if "maximum" in schema and value > schema["maximum"]:
+            errors.append(f"{path}: {value} > {schema['maximum']}")
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}.{key}: mancante")
+        for key, sub in schema.get("properties", {}).items():
+            if key in value:
+                errors.extend(schema_errors(sub, value[key], f"{path}.{key}"))
+    elif isinstance(value, list) and "items" in schema:
+        for i, item in enumerate(value):
+            errors.extend(schema_errors(schema["items"], item, f"{path}[{i}]"))
+    return errors
+
+
+class StructuredStats:
+    """Contatori per prompt (azione): parse falliti e re-request, con i tassi per /costs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = collections.defaultdict(collections.Counter)
+
+    def add(self, action, key, n=1):
+        with self._lock:
+            self._counts[action][key] += n
+
+    def items(self):
+        with self._lock:
+            return [(action, dict(c)) for action, c in self._counts.items()]
+
+    def snapshot(self):
+        out = {}
+        for action, c in self.items():
+            calls, items = c.get("calls", 0), c.get("items", 0)
+            out[action] = dict(c,
+                parse_failure_rate=round(c.get("parse_failed", 0) / calls, 3) if calls else 0.0,
+                rerequest_rate=round(c.get("rerequests", 0) / items, 3) if items else 0.0)
+        return out
+
+
+structured_stats = StructuredStats()
+
+
+class ArrayItemStream:
+    """Parser incrementale: riceve l'output JSON a pezzi e chiama on_item(indice, item)
+    per ogni elemento completo dell'array `key` di primo livello, appena si chiude."""
+
+    def __init__(self, key, on_item):
+        self.key = key
+        self.on_item = on_item
+        self.reset()
+
+    def reset(self):
+        self._buf = []
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._current_key = None
+        self._in_target = False
+        self._item_start = None
+        self._index = 0
+
+    def feed(self, chunk):
+        if chunk is None:
+            self.reset()
+            return
+        self._buf.append(chunk)
+        text = "".join(self._buf)
+        self._buf = [text]
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = text[self._string_start + 1:i]
+                continue
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c == ":" and self._depth == 1:
+                self._current_key = self._last_string
+            elif c in "{[":
+                self._depth += 1
+                if c == "[" and self._depth == 2 and self._current_key == self.key:
+                    self._in_target = True
+                elif c == "{" and self._depth == 3 and self._in_target:
+                    self._item_start = i
+            elif c in "}]":
+                if c == "}" and self._depth == 3 and self._item_start is not None:
+                    self._emit(text[self._item_start:i + 1])
+                elif c == "]" and self._depth == 2:
+                    self._in_target = False
+                self._depth -= 1
+        self._pos = len(text)
+
+    def _emit(self, raw):
+        self._item_start = None
+        index = self._index
+        self._index += 1
+        try:
+            item = _loads(raw)
+        except _DECODE_ERRORS:
+            return
+        self.on_item(index, item)
+
+
+def _tool_use(response, name):
+    for b in response.content:
+        if getattr(b, "type", "") == "tool_use" and getattr(b, "name", "") == name:
+            return b
+    return None
+
+
+def call_structured(agent_id, action, layer, input_summary, model, tool, messages, on_item=None, **kwargs):
+    """Chiamata con output forzato sul tool: ritorna il dict dell'output oppure None.
+
+    Gli item di tool.items_key che non rispettano lo schema vengono richiesti di
+    nuovo uno per volta (stessa conversazione + tool_result con gli errori)
+    invece di rifare il batch; quelli ancora invalidi vengono scartati.
+
+    Con on_item(indice, item) l'output arriva in streaming: ogni item valido viene
+    consegnato appena completo, quelli corretti dopo il re-request a fine risposta.
+    L'indice e' la posizione nell'array originale e resta stabile. Se lo stream
+    riparte (retry o fallback di modello) o la chiamata fallisce, on_item(None, None)
+    annulla gli item gia' consegnati: quelli successivi sono di un'altra risposta.
+    """
+    structured_stats.add(action, "calls")
+    emitted = set()
+    on_delta = None
+
+    def discard():
+        if emitted:
+            emitted.clear()
+            on_item(None, None)
+
+    if on_item is not None:
+        def deliver(index, item):
+            if index not in emitted and not schema_errors(tool.item_schema, item):
+                emitted.add(index)
+                on_item(index, item)
+
+        stream = ArrayItemStream(tool.items_key, deliver)
+
+        def on_delta(chunk):
+            if chunk is None:
+                discard()
+            stream.feed(chunk)
+
+    response = call_claude(agent_id, action, layer, input_summary, model, messages=messages,
+        tools=[tool.spec], tool_choice={"type": "tool", "name": tool.name}, on_delta=on_delta, **kwargs)
+    if response is None:
+        discard()
+        return None
+
+    block = _tool_use(response, tool.name)
+    if block is not None:
+        data = block.input
+    else:
+        # Risposta solo testo (cache o cassette precedenti ai tool): ripiego sull'estrazione
+        structured_stats.add(action, "text_fallback")
+        data = extract_json(response_text(response))
+    if not isinstance(data, dict):
+        structured_stats.add(action, "parse_failed")
+        logger.error(f"[STRUCTURED] {agent_id}/{action}: output non valido (stop_reason={getattr(response, 'stop_reason', None)})")
+        discard()
+        return None
+
+    items = data.get(tool.items_key)
+    if not isinstance(items, list):
+        items = []
+    envelope = {k: v for k, v in data.items() if k != tool.items_key}
+    envelope[tool.items_key] = []
+    if schema_errors(tool.schema, envelope):
+        structured_stats.add(action, "envelope_invalid")
+
+    structured_stats.add(action, "items", len(items))
+    result = []
+    rerequests = 0
+    for i, item in enumerate(items):
+        errors = schema_errors(tool.item_schema, item, f"{tool.items_key}[{i}]")
+        if not errors:
+            result.append(item)
+            if on_item is not None and i not in emitted:
+                emitted.add(i)
+                on_item(i, item)
+            continue
+        structured_stats.add(action, "items_invalid")
+        fixed = None
+        if rerequests < STRUCTURED_MAX_REREQUESTS:
+            rerequests += 1
+            fixed = _rerequest_item(agent_id, action, layer, model, tool, messages, response, block, i, errors, kwargs)
+        if fixed is not None:
+            structured_stats.add(action, "rerequest_fixed")
+            result.append(fixed)
+            if on_item is not None and i not in emitted:
+                emitted.add(i)
+                on_item(i, fixed)
+        else:
+            structured_stats.add(action, "items_dropped")
+            logger.warning(f"[STRUCTURED] {agent_id}/{action}: scartato {tool.items_key}[{i}]: {'; '.join(errors[:3])}")
+    data[tool.items_key] = result
+    return data
+
+
+def _rerequest_item(agent_id, action, layer, model, tool, messages, response, block, index, errors, kwargs):
+    """Chiede di nuovo il solo elemento index, citando gli errori. Ritorna l'item valido o None."""
+    assistant = response_blocks(response)
+    if not assistant:
+        return None
+    note = (f"L'elemento {tool.items_key}[{index}] non rispetta lo schema: {'; '.join(errors[:5])}. "
+            f"Gli altri elementi vanno bene: reinvia SOLO questo elemento, corretto, con {tool.item_spec['name']}.")
+    followup = [{"type": "tool_result", "tool_use_id": block.id, "is_error": True, "content": note}] if block is not None else note
+    structured_stats.add(action, "rerequests")
+    retry_kwargs = dict(kwargs, max_tokens=min(kwargs.get("max_tokens", STRUCTURED_ITEM_MAX_TOKENS), STRUCTURED_ITEM_MAX_TOKENS))
+    reply = call_claude(agent_id, f"{action}_item", layer, f"Re-request {tool.items_key}[{index}]", model,
+        messages=messages + [{"role": "assistant", "content": assistant}, {"role": "user", "content": followup}],
+        # La conversazione contiene gia' il tool_use di tool.name: va dichiarato anche lui
+        tools=[tool.spec, tool.item_spec], tool_choice={"type": "tool", "name": tool.item_spec["name"]}, cache_ttl=0, **retry_kwargs)
+    if reply is None:
+        return None
+    fixed = _tool_use(reply, tool.item_spec["name"])
+    if fixed is None or schema_errors(tool.item_schema, fixed.input):
+        return None
+    return fixed.input
+
+
+def _collect_structured():
+    return [
+        ("brain_llm_structured_total", "counter", "Output strutturati per prompt: chiamate, parse falliti, item invalidi, re-request",
+            [([("prompt", action), ("outcome", k)], v) for action, c in structured_stats.items() for k, v in c.items()]),
+    ]
+
+
+metrics.register(_collect_structured)
+
+
+# Perplexity: ritmo condiviso fra tutti i thread (scan, architect in parallelo, scout).
+# SEARCH_BURST chiamate possono partire insieme, poi si scende a SEARCH_RATE_PER_S.
+SEARCH_RATE_PER_S = float(os.getenv("SEARCH_RATE_PER_S", "1"))
+SEARCH_BURST = int(os.getenv("SEARCH_BURST", "4"))
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", "8"))
+SEARCH_QUERY_TIMEOUT_S = float(os.getenv("SEARCH_QUERY_TIMEOUT_S", "20"))
+
+
+class RateLimiter:
+    """Token bucket (GCRA): ogni chiamante prenota il proprio slot e attende fuori dal lock."""
+
+    def __init__(self, per_second, burst=1):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self.tolerance = max(0, burst - 1) * self.interval
+        self._lock = threading.Lock()
+        self._tat = 0.0
+
+    def acquire(self, reason="rate_limit"):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            tat = max(self._tat, now)
+            slot = max(now, tat - self.tolerance)
+            self._tat = tat + self.interval
+        if slot > now:
+            pause(slot - now, reason)
+
+
+search_limiter = RateLimiter(SEARCH_RATE_PER_S, SEARCH_BURST)
+_search_pool = concurrent.futures.ThreadPoolExecutor(max_workers=SEARCH_MAX_CONCURRENCY, thread_name_prefix="search")
+
+
+def search_perplexity(query, timeout=30, on_start=None):
+    """on_start(istante) viene chiamato quando search_limiter concede lo slot, prima della richiesta."""
+    search_limiter.acquire("search_throttle")
+    if on_start is not None:
+        on_start(time.monotonic())
+    try:
+        with span("search", "perplexity"):
+            response = http_client.post(
+                "https://api.perplexity.ai/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "model": "sonar",
+                    "messages": [{"role": "user", "content": query}],
+                    "max_tokens": 600,
+                },
+                timeout=timeout,
+            )
         if response.status_code == 200:
             data = response.json()
             return data["choices"][0]["message"]["content"]
@@ -221,9 +1902,22 @@ NON riproporre problemi generici. Cerca problemi specifici con gap reale.
 
 REGOLA SULLA DIVERSITA DEI SETTORI: i problemi che identifichi devono riguardare settori DIVERSI. Se la query parla di food, trova problemi di food. Se parla di health, trova problemi di health. NON trasformare tutto in un problema di AI o tecnologia — cerca i problemi UMANI concreti del settore specifico.
 
-Rispondi SOLO con JSON:
-{"problems":[{"title":"titolo","description":"descrizione","who_is_affected":"chi","real_world_example":"storia","why_it_matters":"perche","sector":"food","geographic_scope":"global","top_markets":["US","UK"],"market_size":0.8,"willingness_to_pay":0.3,"urgency":0.6,"competition_gap":0.8,"ai_solvability":0.9,"time_to_market":0.4,"recurring_potential":0.2,"source_name":"fonte","source_url":"url"}],"new_sources":[{"name":"nome","url":"url","category":"tipo","sectors":["settore"]}]}
-SOLO JSON."""
+Rispondi chiamando report_problems con i problemi e le eventuali nuove fonti scoperte."""
+
+SCANNER_TOOL = OutputTool("report_problems", "Problemi identificati nei risultati di ricerca e nuove fonti", {
+    "problems": {"type": "array", "items": {"type": "object", "properties": {
+        "title": SCHEMA_STR, "description": SCHEMA_STR, "who_is_affected": SCHEMA_STR,
+        "real_world_example": SCHEMA_STR, "why_it_matters": SCHEMA_STR,
+        "sector": {"type": "string", "enum": SCANNER_SECTORS},
+        "geographic_scope": {"type": "string", "enum": ["global", "continental", "national", "regional"]},
+        "top_markets": SCHEMA_STRS,
+        **{param: SCHEMA_SCORE for param in SCANNER_WEIGHTS},
+        "source_name": SCHEMA_STR, "source_url": SCHEMA_STR,
+    }, "required": ["title", "description", "who_is_affected", "sector", *SCANNER_WEIGHTS]}},
+    "new_sources": {"type": "array", "items": {"type": "object", "properties": {
+        "name": SCHEMA_STR, "url": SCHEMA_STR, "category": SCHEMA_STR, "sectors": SCHEMA_STRS,
+    }, "required": ["name", "url"]}},
+}, ["problems"], "problems")
 
 
 def scanner_make_fingerprint(title, sector):
@@ -337,13 +2031,16 @@ def run_scan(queries):
 
     source_map = {s["name"]: s["id"] for s in sources}
 
-    # Ricerca
+    # Ricerca — con budget stretto dimezza le query
+    if cost_tracker.budget_state() != "ok" and len(queries) > 2:
+        queries = queries[:max(2, len(queries) // 2)]
+        logger.info(f"[SCAN] budget stretto, ridotto a {len(queries)} query")
+
     search_results = []
     for sector, query in queries:
         result = search_perplexity(query)
         if result:
             search_results.append((sector, query, result))
-        time.sleep(1)
 
     if not search_results:
         return {"status": "no_results", "saved": 0}
@@ -361,25 +2058,19 @@ def run_scan(queries):
             for sector, query, result in batch
         ])
 
-        start = time.time()
+        if not cost_tracker.allow():
+            logger.warning(f"[SCAN] budget esaurito, salto {len(search_results) - i} risultati")
+            break
+
+        model = "claude-haiku-4-5-20251001"
         try:
-            response = claude.messages.create(
-                model="claude-haiku-4-5-20251001",
+            data = call_structured("world_scanner", "scan_v2", 1, f"Batch {len(batch)} ricerche",
+                model=model,
+                tool=SCANNER_TOOL,
                 max_tokens=4096,
                 system=SCANNER_ANALYSIS_PROMPT,
-                messages=[{"role": "user", "content": f"Analizza e identifica problemi. SOLO JSON:\n\n{combined}"}]
+                messages=[{"role": "user", "content": f"Analizza e identifica problemi:\n\n{combined}"}]
             )
-            duration = int((time.time() - start) * 1000)
-            reply = response.content[0].text
-
-            log_to_supabase("world_scanner", "scan_v2", 1,
-                f"Batch {len(batch)} ricerche", reply[:500],
-                "claude-haiku-4-5-20251001",
-                response.usage.input_tokens, response.usage.output_tokens,
-                (response.usage.input_tokens * 1.0 + response.usage.output_tokens * 5.0) / 1_000_000,
-                duration)
-
-            data = extract_json(reply)
             if data:
                 batch_problems = []
                 for prob in data.get("problems", []):
@@ -475,7 +2166,7 @@ def run_scan(queries):
 
         except Exception as e:
             logger.error(f"[BATCH ERROR] {e}")
-        time.sleep(1)
+        pause(1, "batch_throttle")
 
     # Aggiorna statistiche fonti
     if all_scores and sources:
@@ -562,9 +2253,21 @@ Il dossier deve includere:
 4. INSIGHT ESPERTI: cosa dicono ricercatori, analisti, utenti su Reddit/forum?
 5. DIMENSIONE OPPORTUNITA: quanto vale questo mercato? Quanto si spende oggi?
 
-Rispondi SOLO con JSON:
-{"existing_solutions":[{"name":"nome","what_it_does":"cosa fa","price":"costo","weaknesses":"punti deboli","market_share":"stima"}],"market_gaps":["gap1","gap2"],"failed_attempts":[{"who":"chi","why_failed":"perche"}],"expert_insights":["insight1","insight2"],"market_size_estimate":"stima valore mercato","key_finding":"la scoperta piu' importante in una frase"}
-SOLO JSON."""
+Rispondi chiamando report_dossier; key_finding e' la scoperta piu' importante in una frase."""
+
+RESEARCH_TOOL = OutputTool("report_dossier", "Dossier competitivo sul problema", {
+    "existing_solutions": {"type": "array", "items": {"type": "object", "properties": {
+        "name": SCHEMA_STR, "what_it_does": SCHEMA_STR, "price": SCHEMA_STR,
+        "weaknesses": SCHEMA_STR, "market_share": SCHEMA_STR,
+    }, "required": ["name", "what_it_does", "weaknesses"]}},
+    "market_gaps": SCHEMA_STRS,
+    "failed_attempts": {"type": "array", "items": {"type": "object", "properties": {
+        "who": SCHEMA_STR, "why_failed": SCHEMA_STR,
+    }, "required": ["who", "why_failed"]}},
+    "expert_insights": SCHEMA_STRS,
+    "market_size_estimate": SCHEMA_STR,
+    "key_finding": SCHEMA_STR,
+}, ["existing_solutions", "market_gaps", "key_finding"], "existing_solutions")
 
 # FASE 2: Prompt per generazione soluzioni SENZA vincoli tech
 GENERATION_PROMPT = """Sei un innovation strategist di livello mondiale. Combini il meglio di:
@@ -596,9 +2299,20 @@ Per ogni soluzione fornisci:
 - opportunity_score: 0.0-1.0 dimensione opportunita' di mercato
 - defensibility_score: 0.0-1.0 quanto e' difendibile nel tempo
 
-Rispondi SOLO con JSON:
-{"solutions":[{"title":"","description":"","value_proposition":"","target_segment":"","job_to_be_done":"","revenue_model":"","monthly_revenue_potential":"","monthly_burn_rate":"","competitive_moat":"","novelty_score":0.7,"opportunity_score":0.8,"defensibility_score":0.6}],"ranking_rationale":"perche' hai messo la prima in cima"}
-SOLO JSON."""
+Rispondi chiamando report_solutions; ranking_rationale spiega perche' hai messo la prima in cima."""
+
+GENERATION_TOOL = OutputTool("report_solutions", "Le 3 soluzioni ordinate per potenziale", {
+    "solutions": {"type": "array", "items": {"type": "object", "properties": {
+        "title": SCHEMA_STR, "description": SCHEMA_STR, "value_proposition": SCHEMA_STR,
+        "target_segment": SCHEMA_STR, "job_to_be_done": SCHEMA_STR, "revenue_model": SCHEMA_STR,
+        "monthly_revenue_potential": {"type": ["string", "number"]},
+        "monthly_burn_rate": {"type": ["string", "number"]},
+        "competitive_moat": SCHEMA_STR,
+        "novelty_score": SCHEMA_SCORE, "opportunity_score": SCHEMA_SCORE, "defensibility_score": SCHEMA_SCORE,
+    }, "required": ["title", "description", "value_proposition", "target_segment", "revenue_model",
+                    "novelty_score", "opportunity_score", "defensibility_score"]}},
+    "ranking_rationale": SCHEMA_STR,
+}, ["solutions", "ranking_rationale"], "solutions")
 
 # FASE 3: Prompt per valutazione fattibilita
 FEASIBILITY_PROMPT = """Sei un CTO pragmatico. Valuta la fattibilita' di ogni soluzione dati questi VINCOLI:
@@ -620,37 +2334,188 @@ Per ogni soluzione valuta:
 - recommended_mvp: cosa costruire come primo test (specifico, concreto)
 - nocode_compatible: true/false
 
-Rispondi SOLO con JSON:
-{"assessments":[{"solution_title":"","feasibility_score":0.7,"complexity":"medium","time_to_mvp":"3 settimane","cost_estimate":"80 euro/mese","tech_stack_fit":0.8,"biggest_risk":"rischio","recommended_mvp":"cosa costruire","nocode_compatible":true}],"best_feasible":"quale soluzione e' la piu' fattibile e perche'","best_overall":"quale soluzione e' la migliore in assoluto ignorando i vincoli"}
-SOLO JSON."""
+Rispondi chiamando report_feasibility con una valutazione per ogni soluzione ricevuta (solution_title identico al titolo)."""
+
+FEASIBILITY_TOOL = OutputTool("report_feasibility", "Valutazione di fattibilita' di ogni soluzione", {
+    "assessments": {"type": "array", "items": {"type": "object", "properties": {
+        "solution_title": SCHEMA_STR, "feasibility_score": SCHEMA_SCORE,
+        "complexity": {"type": "string", "enum": ["low", "medium", "high"]},
+        "time_to_mvp": SCHEMA_STR, "cost_estimate": SCHEMA_STR, "tech_stack_fit": SCHEMA_SCORE,
+        "biggest_risk": SCHEMA_STR, "recommended_mvp": SCHEMA_STR, "nocode_compatible": {"type": "boolean"},
+    }, "required": ["solution_title", "feasibility_score", "complexity", "recommended_mvp", "nocode_compatible"]}},
+}, ["assessments"], "assessments")
+
+
+def search_many(queries, timeout=SEARCH_QUERY_TIMEOUT_S):
+    """Ricerche Perplexity in parallelo sotto search_limiter. Ritorna i risultati nell'ordine delle query;
+    quelle fallite o oltre il timeout restano None. Il timeout di ogni query parte quando il limiter
+    le concede lo slot: l'attesa in coda non conta."""
+    started = {}
+    futures = {}
+    for i, q in enumerate(queries):
+        on_start = lambda t, i=i: started.__setitem__(i, t)
+        futures[_search_pool.submit(contextvars.copy_context().run, search_perplexity, q, timeout, on_start)] = i
+    results = [None] * len(queries)
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        for f in [f for f in pending if futures[f] in started and now >= started[futures[f]] + timeout]:
+            pending.discard(f)
+            logger.warning(f"[SEARCH] timeout dopo {timeout:.0f}s: {queries[futures[f]][:80]}")
+        if not pending:
+            break
+        # Le query ancora in coda sul limiter non hanno scadenza: si ricontrolla almeno ogni secondo
+        remaining = [started[futures[f]] + timeout - now for f in pending if futures[f] in started]
+        done, pending = concurrent.futures.wait(pending, timeout=min(remaining + [1.0]),
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for f in done:
+            results[futures[f]] = f.result()
+    return results
+
+
+# Dossier riusabili fra problemi simili (tabella problem_dossiers, ricerca per coseno con match_dossiers).
+# Similarita' >= DOSSIER_REUSE_SIMILARITY: si riusa il dossier cosi' com'e'. Fra REFRESH e REUSE:
+# solo le query specifiche del problema e aggiornamento del dossier esistente. Sotto: ricerca completa.
+# L'eta' (DOSSIER_MAX_AGE_H) conta da researched_at, l'ultima ricerca completa: gli aggiornamenti la ereditano.
+DOSSIER_CACHE_ENABLED = os.getenv("DOSSIER_CACHE_ENABLED", "1") == "1"
+DOSSIER_REUSE_SIMILARITY = float(os.getenv("DOSSIER_REUSE_SIMILARITY", "0.85"))
+DOSSIER_REFRESH_SIMILARITY = float(os.getenv("DOSSIER_REFRESH_SIMILARITY", "0.6"))
+DOSSIER_MAX_AGE_H = int(os.getenv("DOSSIER_MAX_AGE_H", str(14 * 24)))
+DOSSIER_EMBED_DIM = 256
+
+_WORD = re.compile(r"[a-z0-9\u00e0-\u00f9]{3,}")
+_STOPWORDS = frozenset("""
+the and for with that this from are not but have has you your their they its can who what when how
+che per con una uno del della dei delle degli nel nella non sono come anche piu' loro chi cosa quando
+""".split())
+
+dossier_stats = collections.Counter()
+
+
+def text_tokens(text):
+    return [w for w in _WORD.findall((text or "").lower()) if w not in _STOPWORDS]
+
+
+def text_embedding(text, dim=DOSSIER_EMBED_DIM):
+    """Embedding locale a feature hashing (unigrammi + bigrammi, segno dal hash), normalizzato L2.
+
+    Nessuna API esterna: basta a riconoscere problemi che condividono il lessico del settore.
+    """
+    tokens = text_tokens(text)
+    vec = [0.0] * dim
+    for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        vec[h % dim] += 1.0 if h >> 63 else -1.0
+    norm = math.sqrt(sum(v * v for v in vec))
+    return [round(v / norm, 6) for v in vec] if norm else vec
+
+
+def problem_text(problem):
+    return " ".join(str(problem.get(k) or "") for k in ("title", "description", "who_is_affected", "why_it_matters"))
+
+
+def find_similar_dossier(problem, embedding):
+    """Il dossier fresco piu' simile nello stesso settore, o None."""
+    try:
+        result = supabase.rpc("match_dossiers", {
+            "query_embedding": embedding,
+            "match_sector": problem.get("sector") or None,
+            "min_similarity": DOSSIER_REFRESH_SIMILARITY,
+            "max_age_hours": DOSSIER_MAX_AGE_H,
+            "match_count": 1,
+        }).execute()
+        return result.data[0] if result.data else None
+    except Exception as e:
+        dossier_stats["lookup_errors"] += 1
+        logger.warning(f"[SA DOSSIER] ricerca: {e}")
+        return None
+
+
+def save_dossier(problem, dossier, embedding, keywords, based_on=None):
+    """based_on: il match aggiornato, di cui il nuovo dossier eredita researched_at."""
+    row = {
+        "problem_id": problem.get("id"),
+        "sector": problem.get("sector") or None,
+        "keywords": keywords,
+        "embedding": embedding,
+        "dossier": dossier,
+        "based_on": based_on["id"] if based_on else None,
+    }
+    if based_on and based_on.get("researched_at"):
+        row["researched_at"] = based_on["researched_at"]
+    try:
+        supabase.table("problem_dossiers").insert(row).execute()
+    except Exception as e:
+        logger.warning(f"[SA DOSSIER] salvataggio: {e}")
+
+
+def touch_dossier(match):
+    try:
+        supabase.table("problem_dossiers").update({
+            "reuse_count": (match.get("reuse_count") or 0) + 1,
+            "last_used_at": datetime.now(timezone.utc).isoformat(),
+        }).eq("id", match["id"]).execute()
+    except Exception as e:
+        logger.warning(f"[SA DOSSIER] aggiornamento: {e}")
+
+
+def _collect_dossiers():
+    return [
+        ("brain_dossier_total", "counter", "Dossier della fase 1 per esito (reused, refreshed, fresh)",
+            [([("outcome", k)], v) for k, v in dossier_stats.items()]),
+    ]
+
+
+metrics.register(_collect_dossiers)
 
 
 def research_problem(problem):
-    """FASE 1: Ricerca competitiva via Perplexity + analisi Claude"""
+    """FASE 1: Ricerca competitiva via Perplexity + analisi Claude, riusando i dossier di problemi simili"""
     logger.info(f"[SA] Fase 1: Ricerca per '{problem['title'][:60]}'")
 
     title = problem["title"]
     sector = problem.get("sector", "")
     description = problem.get("description", "")
 
-    # 4 ricerche mirate su Perplexity
-    search_queries = [
-        f"{title} existing solutions competitors market",
-        f"{title} startup failed attempts lessons learned",
-        f"{title} reddit forum user complaints workarounds",
-        f"{title} market size revenue opportunity {sector}",
-    ]
-
-    search_results = []
-    for q in search_queries:
-        result = search_perplexity(q)
-        if result:
-            search_results.append(result)
-        time.sleep(1)
+    embedding = keywords = match = None
+    if DOSSIER_CACHE_ENABLED:
+        text = problem_text(problem)
+        embedding = text_embedding(text)
+        keywords = [w for w, _ in collections.Counter(text_tokens(text)).most_common(8)]
+        match = find_similar_dossier(problem, embedding)
+
+    if match and match["similarity"] >= DOSSIER_REUSE_SIMILARITY:
+        dossier_stats["reused"] += 1
+        logger.info(f"[SA] Dossier riusato (#{match['id']}, similarita' {match['similarity']:.2f})")
+        touch_dossier(match)
+        return match["dossier"]
+
+    if match:
+        # Panorama competitivo gia' noto: si cerca solo cio' che e' specifico di questo problema
+        search_queries = [
+            f"{title} startup failed attempts lessons learned",
+            f"{title} reddit forum user complaints workarounds",
+        ]
+    else:
+        # 4 ricerche mirate su Perplexity
+        search_queries = [
+            f"{title} existing solutions competitors market",
+            f"{title} startup failed attempts lessons learned",
+            f"{title} reddit forum user complaints workarounds",
+            f"{title} market size revenue opportunity {sector}",
+        ]
+
+    if cost_tracker.budget_state() != "ok":
+        search_queries = search_queries[:2]
+
+    # Le query partono insieme: la fase 1 dura quanto la piu' lenta, le mancanti non bloccano il dossier
+    search_results = [r for r in search_many(search_queries) if r]
+    if len(search_results) < len(search_queries):
+        logger.info(f"[SA] {len(search_results)}/{len(search_queries)} ricerche disponibili")
 
     if not search_results:
         logger.warning("[SA] Nessun risultato di ricerca")
-        return None
+        return match["dossier"] if match else None
 
     combined_research = "\n\n---\n\n".join(search_results)
 
@@ -661,34 +2526,196 @@ def research_problem(problem):
         f"Chi e' colpito: {problem.get('who_is_affected', '')}\n"
         f"Perche conta: {problem.get('why_it_matters', '')}"
     )
+    if match:
+        base = json.dumps(match["dossier"], indent=2, ensure_ascii=False)
+        content = (f"{problem_context}\n\nDOSSIER DI UN PROBLEMA SIMILE (stesso panorama competitivo):\n{base}\n\n"
+                   f"NUOVI RISULTATI RICERCA, specifici di questo problema:\n{combined_research}\n\n"
+                   f"Aggiorna il dossier per questo problema: tieni cio' che vale ancora, aggiungi il nuovo.")
+    else:
+        content = f"{problem_context}\n\nRISULTATI RICERCA:\n{combined_research}\n\nCrea il dossier."
 
-    start = time.time()
+    if not cost_tracker.allow():
+        logger.warning("[SA] budget esaurito, salto analisi ricerca")
+        return match["dossier"] if match else None
+
+    model = "claude-haiku-4-5-20251001"
     try:
-        response = claude.messages.create(
-            model="claude-haiku-4-5-20251001",
+        dossier = call_structured("solution_architect", "research", 2, f"Ricerca: {title[:100]}",
+            model=model,
+            tool=RESEARCH_TOOL,
             max_tokens=3000,
             system=RESEARCH_PROMPT,
-            messages=[{"role": "user", "content": f"{problem_context}\n\nRISULTATI RICERCA:\n{combined_research}\n\nCrea il dossier. SOLO JSON."}]
+            messages=[{"role": "user", "content": content}]
         )
-        duration = int((time.time() - start) * 1000)
-        reply = response.content[0].text
-
-        log_to_supabase("solution_architect", "research", 2,
-            f"Ricerca: {title[:100]}", reply[:500],
-            "claude-haiku-4-5-20251001",
-            response.usage.input_tokens, response.usage.output_tokens,
-            (response.usage.input_tokens * 1.0 + response.usage.output_tokens * 5.0) / 1_000_000,
-            duration)
-
-        return extract_json(reply)
-
     except Exception as e:
         logger.error(f"[SA RESEARCH ERROR] {e}")
         return None
 
+    if dossier and embedding is not None:
+        dossier_stats["refreshed" if match else "fresh"] += 1
+        save_dossier(problem, dossier, embedding, keywords, based_on=match)
+    return dossier
+
+
+# Cascade per la generazione: prima Haiku, controlli automatici sull'output, Sonnet solo se non passa.
+# Override per settore con GENERATION_CASCADE_SECTORS_JSON, es. {"legal": {"enabled": false}, "health": {"min_quality": 0.8}}
+GENERATION_MODEL = "claude-sonnet-4-5-20250514"
+GENERATION_CASCADE_MODEL = "claude-haiku-4-5-20251001"
+GENERATION_CASCADE = {
+    "enabled": os.getenv("GENERATION_CASCADE", "1") == "1",
+    "min_quality": float(os.getenv("GENERATION_CASCADE_MIN_QUALITY", "0.6")),
+    "min_solutions": int(os.getenv("GENERATION_CASCADE_MIN_SOLUTIONS", "3")),
+    "max_overlap": float(os.getenv("GENERATION_CASCADE_MAX_OVERLAP", "0.5")),
+    "min_spread": float(os.getenv("GENERATION_CASCADE_MIN_SPREAD", "0.05")),
+}
+GENERATION_CASCADE_SECTORS = json.loads(os.getenv("GENERATION_CASCADE_SECTORS_JSON", "{}"))
+
+
+def cascade_config(sector):
+    return dict(GENERATION_CASCADE, **GENERATION_CASCADE_SECTORS.get(sector or "", {}))
+
+
+def generation_quality(data, dossier, config):
+    """Controlli economici sull'output della generazione. Ritorna (qualita' 0-1, motivi di escalation).
+
+    - completezza: numero di soluzioni e campi dello schema valorizzati
+    - novita': sovrapposizione lessicale massima con i competitor del dossier
+    - spread: le soluzioni devono differire nello score strategico (prompt: "ordinate per potenziale")
+    """
+    solutions = (data or {}).get("solutions") or []
+    if not solutions:
+        return 0.0, ["no_output"]
+    reasons = []
+
+    fields = list(GENERATION_TOOL.item_schema["properties"])
+    filled = sum(1 for sol in solutions for f in fields if sol.get(f) not in (None, "", []))
+    completeness = filled / (len(fields) * max(len(solutions), config["min_solutions"]))
+    if len(solutions) < config["min_solutions"] or completeness < 0.9:
+        reasons.append("incomplete")
+
+    competitors = [set(text_tokens(f"{c.get('name', '')} {c.get('what_it_does', '')}"))
+                   for c in dossier.get("existing_solutions", [])]
+    overlap = 0.0
+    for sol in solutions:
+        words = set(text_tokens(f"{sol.get('title', '')} {sol.get('description', '')}"))
+        for comp in competitors:
+            if words and comp:
+                overlap = max(overlap, len(words & comp) / len(words | comp))
+    if overlap >= config["max_overlap"]:
+        reasons.append("not_novel")
+
+    strategic = [sum(float(sol.get(k, 0) or 0) for k in ("novelty_score", "opportunity_score", "defensibility_score")) / 3
+                 for sol in solutions]
+    spread = max(strategic) - min(strategic) if len(strategic) > 1 else 0.0
+    if spread < config["min_spread"]:
+        reasons.append("flat_scores")
+
+    quality = round((completeness + (1 - overlap) + min(1.0, spread / (2 * config["min_spread"]))) / 3, 4)
+    if quality < config["min_quality"] and not reasons:
+        reasons.append("low_quality")
+    return quality, reasons
+
+
+class CascadeStats:
+    """Per settore e tier: chiamate, latenza, costo; escalation con i motivi."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tiers = collections.defaultdict(lambda: {"calls": 0, "latency_s": 0.0, "cost_usd": 0.0})
+        self._cascades = collections.Counter()
+        self._escalations = collections.Counter()
+
+    def record(self, sector, tier, latency_s, cost):
+        with self._lock:
+            t = self._tiers[(sector, tier)]
+            t["calls"] += 1
+            t["latency_s"] += latency_s
+            t["cost_usd"] += cost
+
+    def cascade(self, sector, reasons):
+        with self._lock:
+            self._cascades[sector] += 1
+            for r in reasons:
+                self._escalations[(sector, r)] += 1
+            if reasons:
+                self._escalations[(sector, "total")] += 1
+
+    def snapshot(self):
+        with self._lock:
+            out = {}
+            for (sector, tier), t in self._tiers.items():
+                out.setdefault(sector, {})[tier] = {
+                    "calls": t["calls"], "cost_usd": round(t["cost_usd"], 6),
+                    "avg_latency_s": round(t["latency_s"] / t["calls"], 2) if t["calls"] else 0.0,
+                    "avg_cost_usd": round(t["cost_usd"] / t["calls"], 6) if t["calls"] else 0.0,
+                }
+            for sector, n in self._cascades.items():
+                escalated = self._escalations[(sector, "total")]
+                out.setdefault(sector, {})["escalation_rate"] = round(escalated / n, 3)
+                out[sector]["escalation_reasons"] = {r: v for (sec, r), v in self._escalations.items()
+                    if sec == sector and r != "total"}
+            return out
+
+    def metrics(self):
+        with self._lock:
+            tiers = [(k, dict(v)) for k, v in self._tiers.items()]
+            escalations = list(self._escalations.items())
+        return tiers, escalations
+
+
+cascade_stats = CascadeStats()
+
+
+def _collect_cascade():
+    tiers, escalations = cascade_stats.metrics()
+    return [
+        ("brain_generation_calls_total", "counter", "Generazioni soluzioni per settore e tier (haiku/sonnet)",
+            [([("sector", s), ("tier", t)], v["calls"]) for (s, t), v in tiers]),
+        ("brain_generation_latency_seconds_total", "counter", "Latenza cumulata della generazione per settore e tier",
+            [([("sector", s), ("tier", t)], round(v["latency_s"], 3)) for (s, t), v in tiers]),
+        ("brain_generation_cost_usd_total", "counter", "Costo della generazione per settore e tier",
+            [([("sector", s), ("tier", t)], round(v["cost_usd"], 6)) for (s, t), v in tiers]),
+        ("brain_generation_escalations_total", "counter", "Escalation Haiku -> Sonnet per settore e motivo",
+            [([("sector", s), ("reason", r)], v) for (s, r), v in escalations]),
+    ]
+
+
+metrics.register(_collect_cascade)
+
+
+def _model_tier(model):
+    return next((t for t in ("haiku", "sonnet", "opus") if t in model), model)
 
-def generate_solutions_unconstrained(problem, dossier):
-    """FASE 2: Generazione soluzioni senza vincoli tech"""
+
+def _generate_with(model, problem, content, sector, on_solution=None):
+    start = time.time()
+    with cost_scope() as scope:
+        try:
+            data = call_structured("solution_architect", "generate_unconstrained", 2, f"Soluzioni per: {problem['title'][:100]}",
+                model=model,
+                tool=GENERATION_TOOL,
+                on_item=on_solution,
+                max_tokens=4000,
+                system=GENERATION_PROMPT,
+                messages=[{"role": "user", "content": content}]
+            )
+        except Exception as e:
+            logger.error(f"[SA GENERATE ERROR] {e}")
+            data = None
+            if on_solution is not None:
+                on_solution(None, None)
+    cascade_stats.record(sector, _model_tier(model), time.time() - start, scope["cost"])
+    return data
+
+
+def generate_solutions_unconstrained(problem, dossier, on_solution=None):
+    """FASE 2: Generazione soluzioni senza vincoli tech.
+
+    In cascade prova prima Haiku e passa a Sonnet solo se i controlli di qualita'
+    falliscono. Con on_solution(indice, soluzione) ogni soluzione viene consegnata
+    appena disponibile: in streaming da Sonnet, tutte insieme dall'output Haiku accettato.
+    on_solution(None, None) annulla quelle consegnate finora (stream ripartito o fallito).
+    """
     logger.info(f"[SA] Fase 2: Generazione per '{problem['title'][:60]}'")
 
     problem_context = (
@@ -702,228 +2729,529 @@ def generate_solutions_unconstrained(problem, dossier):
     )
 
     dossier_text = json.dumps(dossier, indent=2, ensure_ascii=False)
+    content = f"{problem_context}\n\nDOSSIER COMPETITIVO:\n{dossier_text}\n\nGenera 3 soluzioni."
 
-    start = time.time()
+    if not cost_tracker.allow():
+        logger.warning("[SA] budget esaurito, salto generazione")
+        return None
+
+    sector = problem.get("sector") or "unknown"
+    config = cascade_config(sector)
+    if config["enabled"]:
+        # Niente streaming sul primo tier: le soluzioni partono verso la fattibilita' solo se accettate
+        data = _generate_with(GENERATION_CASCADE_MODEL, problem, content, sector)
+        quality, reasons = generation_quality(data, dossier, config)
+        if reasons and data and cost_tracker.budget_state() != "ok":
+            logger.info(f"[SA] cascade: {reasons} ma budget stretto, tengo l'output Haiku")
+            reasons = []
+        cascade_stats.cascade(sector, reasons)
+        if not reasons:
+            logger.info(f"[SA] cascade: Haiku accettato (qualita' {quality})")
+            if on_solution is not None:
+                for index, sol in enumerate(data["solutions"]):
+                    on_solution(index, sol)
+            return data
+        logger.info(f"[SA] cascade: escalation a Sonnet ({', '.join(reasons)}, qualita' {quality})")
+
+    # Sonnet per qualita', Haiku se il budget e' stretto
+    return _generate_with(cost_tracker.pick_model(GENERATION_MODEL), problem, content, sector, on_solution)
+
+
+# Fase 3 in pipeline con la 2: una chiamata Haiku per soluzione, appena la generazione la completa
+FEASIBILITY_CONCURRENCY = int(os.getenv("FEASIBILITY_CONCURRENCY", "6"))
+_feasibility_pool = concurrent.futures.ThreadPoolExecutor(max_workers=FEASIBILITY_CONCURRENCY, thread_name_prefix="feasibility")
+
+
+def assess_feasibility(problem, solution):
+    """FASE 3: Valutazione fattibilita con vincoli di una singola soluzione. Ritorna l'assessment o None."""
+    title = solution.get("title", "")
+    logger.info(f"[SA] Fase 3: Fattibilita di '{title[:60]}'")
+
+    if not cost_tracker.allow():
+        logger.warning("[SA] budget esaurito, salto fattibilita")
+        return None
+
+    model = "claude-haiku-4-5-20251001"
     try:
-        response = claude.messages.create(
-            model="claude-sonnet-4-5-20250514",
-            max_tokens=4000,
-            system=GENERATION_PROMPT,
-            messages=[{"role": "user", "content": f"{problem_context}\n\nDOSSIER COMPETITIVO:\n{dossier_text}\n\nGenera 3 soluzioni. SOLO JSON."}]
+        data = call_structured("solution_architect", "assess_feasibility", 2, f"Fattibilita: {title[:100]}",
+            model=model,
+            tool=FEASIBILITY_TOOL,
+            max_tokens=800,
+            system=FEASIBILITY_PROMPT,
+            messages=[{"role": "user", "content": f"PROBLEMA: {problem['title']}\n\nSOLUZIONE DA VALUTARE:\n{json.dumps(solution, ensure_ascii=False)}\n\nValuta fattibilita."}]
         )
-        duration = int((time.time() - start) * 1000)
-        reply = response.content[0].text
+    except Exception as e:
+        logger.error(f"[SA FEASIBILITY ERROR] {e}")
+        return None
+    assessments = (data or {}).get("assessments") or []
+    return assessments[0] if assessments else None
 
-        log_to_supabase("solution_architect", "generate_unconstrained", 2,
-            f"Soluzioni per: {problem['title'][:100]}", reply[:500],
-            "claude-sonnet-4-5-20250514",
-            response.usage.input_tokens, response.usage.output_tokens,
-            (response.usage.input_tokens * 3.0 + response.usage.output_tokens * 15.0) / 1_000_000,
-            duration)
 
-        return extract_json(reply)
 
-    except Exception as e:
-        logger.error(f"[SA GENERATE ERROR] {e}")
-        return None
+# Fattibilita' a batch fra problemi: le soluzioni in attesa (anche di problemi diversi, dal pool
+# dell'architect) si raccolgono per FEASIBILITY_BATCH_WAIT_MS e si valutano in una sola chiamata Haiku,
+# cosi' il prompt dei vincoli si paga una volta per batch. Ogni soluzione ha un id stabile
+# (<problem_id>.<indice>) che deve tornare nell'output; quelle non coperte da una valutazione
+# valida ripiegano su assess_feasibility singola.
+FEASIBILITY_BATCH_ENABLED = os.getenv("FEASIBILITY_BATCH_ENABLED", "1") == "1"
+FEASIBILITY_BATCH_MAX_ITEMS = int(os.getenv("FEASIBILITY_BATCH_MAX_ITEMS", "12"))
+FEASIBILITY_BATCH_MAX_TOKENS = int(os.getenv("FEASIBILITY_BATCH_MAX_TOKENS", "6000"))
+FEASIBILITY_BATCH_WAIT_MS = int(os.getenv("FEASIBILITY_BATCH_WAIT_MS", "400"))
+FEASIBILITY_BATCH_TOKENS_PER_ITEM = 300
 
+FEASIBILITY_BATCH_PROMPT = FEASIBILITY_PROMPT.rsplit("\n\n", 1)[0] + """
 
-def assess_feasibility(problem, solutions_data):
-    """FASE 3: Valutazione fattibilita con vincoli"""
-    logger.info(f"[SA] Fase 3: Fattibilita per '{problem['title'][:60]}'")
+Le soluzioni arrivano da problemi diversi, ognuna con il suo solution_id.
+Rispondi chiamando report_feasibility_batch con una valutazione per ogni soluzione ricevuta (solution_id identico, solution_title identico al titolo)."""
 
-    solutions_text = json.dumps(solutions_data.get("solutions", []), indent=2, ensure_ascii=False)
+FEASIBILITY_BATCH_TOOL = OutputTool("report_feasibility_batch", "Valutazione di fattibilita' di soluzioni di piu' problemi", {
+    "assessments": {"type": "array", "items": dict(FEASIBILITY_TOOL.item_schema,
+        properties=dict(FEASIBILITY_TOOL.item_schema["properties"], solution_id=SCHEMA_STR),
+        required=["solution_id"] + FEASIBILITY_TOOL.item_schema["required"])},
+}, ["assessments"], "assessments")
 
-    start = time.time()
-    try:
-        response = claude.messages.create(
-            model="claude-haiku-4-5-20251001",
-            max_tokens=2000,
-            system=FEASIBILITY_PROMPT,
-            messages=[{"role": "user", "content": f"PROBLEMA: {problem['title']}\n\nSOLUZIONI DA VALUTARE:\n{solutions_text}\n\nValuta fattibilita. SOLO JSON."}]
-        )
-        duration = int((time.time() - start) * 1000)
-        reply = response.content[0].text
+feasibility_batch_stats = collections.Counter()
 
-        log_to_supabase("solution_architect", "assess_feasibility", 2,
-            f"Fattibilita: {problem['title'][:100]}", reply[:500],
-            "claude-haiku-4-5-20251001",
-            response.usage.input_tokens, response.usage.output_tokens,
-            (response.usage.input_tokens * 1.0 + response.usage.output_tokens * 5.0) / 1_000_000,
-            duration)
 
-        return extract_json(reply)
+def _feasibility_entry(problem, solution):
+    return {"problem": problem.get("title", ""), "solution": solution}
 
-    except Exception as e:
-        logger.error(f"[SA FEASIBILITY ERROR] {e}")
-        return None
 
+class FeasibilityBatcher:
+    """Coda delle valutazioni di fattibilita': un thread forma i batch (per numero e token stimati),
+    le chiamate girano su _feasibility_pool. submit() ritorna un Future con l'assessment o None.
 
-def save_solution_v2(problem_id, sol, assessment, ranking_rationale, dossier):
-    """Salva soluzione con tutti i dati delle 3 fasi"""
-    try:
-        complexity = str(assessment.get("complexity", "medium")).lower().strip()
-        if "low" in complexity:
-            complexity = "low"
-        elif "high" in complexity:
-            complexity = "high"
-        else:
-            complexity = "medium"
+    Un batch contiene solo richieste della stessa run: la chiamata gira nel contesto del primo
+    item, quindi costo, budget e span vanno tutti alla run giusta.
+    """
 
-        # Salva soluzione
-        sol_result = supabase.table("solutions").insert({
-            "problem_id": problem_id,
-            "title": sol.get("title", "Senza titolo"),
-            "description": sol.get("description", ""),
-            "approach": json.dumps({
-                "value_proposition": sol.get("value_proposition", ""),
-                "target_segment": sol.get("target_segment", ""),
-                "job_to_be_done": sol.get("job_to_be_done", ""),
-                "revenue_model": sol.get("revenue_model", ""),
-                "competitive_moat": sol.get("competitive_moat", ""),
-                "recommended_mvp": assessment.get("recommended_mvp", ""),
-                "monthly_revenue_potential": sol.get("monthly_revenue_potential", ""),
-                "monthly_burn_rate": sol.get("monthly_burn_rate", ""),
-                "biggest_risk": assessment.get("biggest_risk", ""),
-                "market_gaps": dossier.get("market_gaps", []),
-                "existing_competitors": [s.get("name", "") for s in dossier.get("existing_solutions", [])],
-                "ranking_rationale": ranking_rationale,
-            }, ensure_ascii=False),
-            "sector": sol.get("sector", ""),
-            "sub_sector": sol.get("sub_sector", ""),
-            "status": "proposed",
-            "created_by": "solution_architect_v2",
-        }).execute()
+    def __init__(self, max_items, max_tokens, wait_ms):
+        self.max_items = max(1, max_items)
+        self.max_tokens = max_tokens
+        self.wait = max(0.0, wait_ms / 1000)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
 
-        sol_id = sol_result.data[0]["id"]
-
-        # Score combinato: media di novelty, opportunity, defensibility per impact
-        novelty = float(sol.get("novelty_score", 0.5))
-        opportunity = float(sol.get("opportunity_score", 0.5))
-        defensibility = float(sol.get("defensibility_score", 0.5))
-        feasibility = float(assessment.get("feasibility_score", 0.5))
-        tech_fit = float(assessment.get("tech_stack_fit", 0.5))
-
-        # Impact score = media dei 3 score strategici
-        impact = round((novelty + opportunity + defensibility) / 3, 4)
-        # Overall = media di impact e feasibility
-        overall = round((impact + feasibility) / 2, 4)
-
-        supabase.table("solution_scores").insert({
-            "solution_id": sol_id,
-            "feasibility_score": feasibility,
-            "impact_score": impact,
-            "cost_estimate": str(assessment.get("cost_estimate", "unknown")),
-            "complexity": complexity,
-            "time_to_market": str(assessment.get("time_to_mvp", "unknown")),
-            "nocode_compatible": bool(assessment.get("nocode_compatible", True)),
-            "overall_score": overall,
-            "notes": json.dumps({
-                "novelty": novelty,
-                "opportunity": opportunity,
-                "defensibility": defensibility,
-                "tech_stack_fit": tech_fit,
-                "revenue_model": sol.get("revenue_model", ""),
-                "monthly_revenue_potential": sol.get("monthly_revenue_potential", ""),
-                "monthly_burn_rate": sol.get("monthly_burn_rate", ""),
-            }, ensure_ascii=False),
-            "scored_by": "solution_architect_v2",
-        }).execute()
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="feasibility-batch", daemon=True)
+                    self._thread.start()
+
+    def submit(self, problem, index, solution):
+        future = concurrent.futures.Future()
+        text = json.dumps(_feasibility_entry(problem, solution), ensure_ascii=False)
+        self._ensure_started()
+        self._queue.put((f"{problem.get('id')}.{index}", problem, solution, len(text) // 4, contextvars.copy_context(), future))
+        return future
+
+    def _run(self):
+        carry = None
+        while True:
+            item = carry or self._queue.get()
+            carry = None
+            batch, ids, tokens = [item], {item[0]}, item[3]
+            run = item[4].get(_current_run)
+            deadline = time.monotonic() + self.wait
+            while len(batch) < self.max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item[0] in ids or tokens + item[3] > self.max_tokens or item[4].get(_current_run) is not run:
+                    carry = item
+                    break
+                batch.append(item)
+                ids.add(item[0])
+                tokens += item[3]
+            # Le richieste annullate (generazione scartata a meta' stream) non partono
+            batch = [b for b in batch if b[5].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            _feasibility_pool.submit(batch[0][4].copy().run, self._assess, batch)
+
+    def _assess(self, batch):
+        by_id = {}
+        try:
+            by_id = assess_feasibility_batch([(sid, problem, solution) for sid, problem, solution, _, _, _ in batch])
+        except Exception as e:
+            logger.error(f"[SA FEASIBILITY BATCH ERROR] {e}")
+        for sid, problem, solution, _, ctx, future in batch:
+            if sid in by_id:
+                future.set_result(by_id[sid])
+                continue
+            feasibility_batch_stats["fallback_items"] += 1
+            fallback = _feasibility_pool.submit(ctx.copy().run, assess_feasibility, problem, solution)
+            fallback.add_done_callback(lambda f, future=future: future.set_result(None if f.exception() else f.result()))
+
+
+def assess_feasibility_batch(items):
+    """Una chiamata per [(solution_id, problem, solution)]. Ritorna {solution_id: assessment}
+    con le sole valutazioni valide: id sconosciuti o ripetuti vengono scartati."""
+    if not cost_tracker.allow():
+        logger.warning("[SA] budget esaurito, salto fattibilita")
+        return {}
+    logger.info(f"[SA] Fase 3: Fattibilita di {len(items)} soluzioni in batch")
+    feasibility_batch_stats["batches"] += 1
+    feasibility_batch_stats["items"] += len(items)
+    entries = [dict(_feasibility_entry(problem, solution), solution_id=sid) for sid, problem, solution in items]
+    data = call_structured("solution_architect", "assess_feasibility_batch", 2, f"Fattibilita: {len(items)} soluzioni",
+        model="claude-haiku-4-5-20251001",
+        tool=FEASIBILITY_BATCH_TOOL,
+        max_tokens=min(4096, FEASIBILITY_BATCH_TOKENS_PER_ITEM * len(items) + 200),
+        system=FEASIBILITY_BATCH_PROMPT,
+        messages=[{"role": "user", "content": f"SOLUZIONI DA VALUTARE:\n{json.dumps(entries, ensure_ascii=False, indent=1)}\n\nValuta fattibilita."}]
+    )
+    if data is None:
+        feasibility_batch_stats["failed_batches"] += 1
+        return {}
+    wanted = {sid for sid, _, _ in items}
+    by_id, seen = {}, collections.Counter(a.get("solution_id") for a in data.get("assessments", []))
+    for assessment in data.get("assessments", []):
+        sid = assessment.get("solution_id")
+        if sid in wanted and seen[sid] == 1:
+            by_id[sid] = {k: v for k, v in assessment.items() if k != "solution_id"}
+    if len(by_id) < len(items):
+        feasibility_batch_stats["partial_batches"] += 1
+        logger.warning(f"[SA] batch fattibilita: {len(items) - len(by_id)}/{len(items)} soluzioni senza valutazione valida")
+    return by_id
+
+
+feasibility_batcher = FeasibilityBatcher(FEASIBILITY_BATCH_MAX_ITEMS, FEASIBILITY_BATCH_MAX_TOKENS, FEASIBILITY_BATCH_WAIT_MS)
+
+
+def _collect_feasibility_batch():
+    return [
+        ("brain_feasibility_batch_total", "counter", "Fattibilita' a batch: batch, soluzioni, batch falliti o parziali, ripieghi singoli",
+            [([("outcome", k)], v) for k, v in feasibility_batch_stats.items()]),
+    ]
+
+
+metrics.register(_collect_feasibility_batch)
+
+def solution_rows(sol, assessment, ranking_rationale, dossier):
+    """Righe solutions e solution_scores di una soluzione con tutti i dati delle 3 fasi, e l'overall score."""
+    complexity = str(assessment.get("complexity", "medium")).lower().strip()
+    if "low" in complexity:
+        complexity = "low"
+    elif "high" in complexity:
+        complexity = "high"
+    else:
+        complexity = "medium"
+
+    solution = {
+        "title": sol.get("title", "Senza titolo"),
+        "description": sol.get("description", ""),
+        "approach": json.dumps({
+            "value_proposition": sol.get("value_proposition", ""),
+            "target_segment": sol.get("target_segment", ""),
+            "job_to_be_done": sol.get("job_to_be_done", ""),
+            "revenue_model": sol.get("revenue_model", ""),
+            "competitive_moat": sol.get("competitive_moat", ""),
+            "recommended_mvp": assessment.get("recommended_mvp", ""),
+            "monthly_revenue_potential": sol.get("monthly_revenue_potential", ""),
+            "monthly_burn_rate": sol.get("monthly_burn_rate", ""),
+            "biggest_risk": assessment.get("biggest_risk", ""),
+            "market_gaps": dossier.get("market_gaps", []),
+            "existing_competitors": [s.get("name", "") for s in dossier.get("existing_solutions", [])],
+            "ranking_rationale": ranking_rationale,
+        }, ensure_ascii=False),
+        "sector": sol.get("sector", ""),
+        "sub_sector": sol.get("sub_sector", ""),
+        "status": "proposed",
+        "created_by": "solution_architect_v2",
+    }
+
+    # Score combinato: media di novelty, opportunity, defensibility per impact
+    novelty = float(sol.get("novelty_score", 0.5))
+    opportunity = float(sol.get("opportunity_score", 0.5))
+    defensibility = float(sol.get("defensibility_score", 0.5))
+    feasibility = float(assessment.get("feasibility_score", 0.5))
+    tech_fit = float(assessment.get("tech_stack_fit", 0.5))
+
+    # Impact score = media dei 3 score strategici
+    impact = round((novelty + opportunity + defensibility) / 3, 4)
+    # Overall = media di impact e feasibility
+    overall = round((impact + feasibility) / 2, 4)
+
+    score = {
+        "feasibility_score": feasibility,
+        "impact_score": impact,
+        "cost_estimate": str(assessment.get("cost_estimate", "unknown")),
+        "complexity": complexity,
+        "time_to_market": str(assessment.get("time_to_mvp", "unknown")),
+        "nocode_compatible": bool(assessment.get("nocode_compatible", True)),
+        "overall_score": overall,
+        "notes": json.dumps({
+            "novelty": novelty,
+            "opportunity": opportunity,
+            "defensibility": defensibility,
+            "tech_stack_fit": tech_fit,
+            "revenue_model": sol.get("revenue_model", ""),
+            "monthly_revenue_potential": sol.get("monthly_revenue_potential", ""),
+            "monthly_burn_rate": sol.get("monthly_burn_rate", ""),
+        }, ensure_ascii=False),
+        "scored_by": "solution_architect_v2",
+    }
+    return solution, score, overall
 
-        return sol_id, overall
 
+def save_solutions_batch(problem_id, items):
+    """Salva soluzioni e score di un problema in una sola chiamata transazionale (RPC save_solutions_batch).
+
+    items = [(solution_row, score_row)]. Ritorna gli id nello stesso ordine; [] se il salvataggio fallisce
+    (in quel caso non resta scritto niente).
+    """
+    try:
+        result = supabase.rpc("save_solutions_batch", {
+            "p_problem_id": problem_id,
+            "p_items": [{"solution": solution, "score": score} for solution, score in items],
+        }).execute()
+        ids = {row["ordinal"]: row["solution_id"] for row in (result.data or [])}
+        return [ids.get(i + 1) for i in range(len(items))]
     except Exception as e:
         logger.error(f"[SAVE SOL V2 ERROR] {e}")
-        return None, 0
+        return []
 
 
-def run_solution_architect(problem_id=None):
-    logger.info("Solution Architect v2.0 starting (3 fasi)...")
+# Output di ogni fase salvati per problema (tabella architect_artifacts): una run interrotta riparte
+# dall'ultima fase completata. La versione di una fase e' l'hash di prompt e schema concatenato a quella
+# della fase precedente, quindi cambiare un prompt ricalcola quella fase e le successive, non le altre.
+ARCHITECT_ARTIFACTS_ENABLED = os.getenv("ARCHITECT_ARTIFACTS_ENABLED", "1") == "1"
 
+
+def _phase_versions(phases):
+    versions, parent = {}, ""
+    for phase, parts in phases:
+        raw = json.dumps([parent] + parts, sort_keys=True, ensure_ascii=False)
+        parent = versions[phase] = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+    return versions
+
+
+ARCHITECT_PHASE_VERSIONS = _phase_versions([
+    ("research", [RESEARCH_PROMPT, RESEARCH_TOOL.spec]),
+    ("generation", [GENERATION_PROMPT, GENERATION_TOOL.spec, GENERATION_MODEL, GENERATION_CASCADE_MODEL]),
+    ("feasibility", [FEASIBILITY_PROMPT, FEASIBILITY_TOOL.spec, FEASIBILITY_BATCH_PROMPT, FEASIBILITY_BATCH_TOOL.spec]),
+])
+artifact_stats = collections.Counter()
+
+
+def load_artifacts(problem_id):
+    """{fase: payload} delle fasi gia' completate per il problema con i prompt attuali."""
+    if not ARCHITECT_ARTIFACTS_ENABLED or problem_id is None:
+        return {}
     try:
-        query = supabase.table("problems").select("*").eq("status", "approved").order("weighted_score", desc=True)
-        if problem_id:
-            query = query.eq("id", problem_id)
-        problems = query.execute()
-        problems = problems.data or []
-    except:
-        problems = []
+        result = supabase.table("architect_artifacts").select("phase,version,payload") \
+            .eq("problem_id", problem_id).in_("version", list(ARCHITECT_PHASE_VERSIONS.values())).execute()
+    except Exception as e:
+        logger.warning(f"[SA ARTIFACTS] lettura {problem_id}: {e}")
+        return {}
+    return {row["phase"]: row["payload"] for row in (result.data or [])
+            if ARCHITECT_PHASE_VERSIONS.get(row["phase"]) == row["version"]}
 
-    if not problems:
-        return {"status": "no_problems", "saved": 0}
 
-    # Controlla problemi che hanno gia soluzioni
+def save_artifact(problem_id, phase, payload):
+    if not ARCHITECT_ARTIFACTS_ENABLED or problem_id is None:
+        return
     try:
-        existing = supabase.table("solutions").select("problem_id").execute()
-        existing_ids = {s["problem_id"] for s in (existing.data or [])}
-    except:
-        existing_ids = set()
+        supabase.table("architect_artifacts").upsert({
+            "problem_id": problem_id,
+            "phase": phase,
+            "version": ARCHITECT_PHASE_VERSIONS[phase],
+            "payload": payload,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }, on_conflict="problem_id,phase,version").execute()
+    except Exception as e:
+        logger.warning(f"[SA ARTIFACTS] salvataggio {phase} {problem_id}: {e}")
 
-    problems = [p for p in problems if p["id"] not in existing_ids]
-    if not problems:
-        return {"status": "all_solved", "saved": 0}
 
-    total_saved = 0
-    for problem in problems:
-        # FASE 1: Ricerca competitiva
+def _collect_artifacts():
+    return [
+        ("brain_architect_artifacts_total", "counter", "Fasi dell'architect ripristinate (hit) o ricalcolate (miss)",
+            [([("phase", phase), ("outcome", outcome)], v) for (phase, outcome), v in artifact_stats.items()]),
+    ]
+
+
+metrics.register(_collect_artifacts)
+
+
+# Problemi elaborati in parallelo: le chiamate Claude restano limitate da LLM_MAX_CONCURRENCY,
+# le ricerche da SEARCH_RATE_PER_S
+ARCHITECT_CONCURRENCY = int(os.getenv("ARCHITECT_CONCURRENCY", "3"))
+
+
+def architect_problem(problem):
+    """Le 3 fasi per un problema e la notifica a Mirco appena finisce. Ritorna le soluzioni salvate."""
+    if not cost_tracker.allow():
+        logger.warning(f"[SA] budget esaurito, salto '{problem['title'][:60]}'")
+        return 0
+
+    artifacts = load_artifacts(problem.get("id"))
+    persist = True
+
+    # FASE 1: Ricerca competitiva
+    dossier = artifacts.get("research")
+    artifact_stats[("research", "hit" if dossier else "miss")] += 1
+    if not dossier:
         dossier = research_problem(problem)
-        if not dossier:
+        if dossier:
+            save_artifact(problem.get("id"), "research", dossier)
+        else:
+            # Senza dossier le fasi successive non si salvano: alla prossima run si rifa' tutto
+            artifacts = {}
+            persist = False
             dossier = {"existing_solutions": [], "market_gaps": ["nessun dato"], "failed_attempts": [], "expert_insights": [], "market_size_estimate": "sconosciuto", "key_finding": "ricerca non disponibile"}
 
-        # FASE 2: Generazione soluzioni senza vincoli (usa Sonnet per qualita')
-        solutions_data = generate_solutions_unconstrained(problem, dossier)
-        if not solutions_data or not solutions_data.get("solutions"):
-            logger.warning(f"[SA] Nessuna soluzione generata per {problem['title'][:60]}")
-            continue
+    # FASE 2 + 3 in pipeline: Sonnet genera in streaming, ogni soluzione completa parte
+    # subito verso la sua valutazione di fattibilita'. Tutto e' indicizzato per posizione;
+    # le valutazioni gia' salvate non si ripetono (valgono solo per la generazione salvata).
+    assessed = (artifacts.get("feasibility") or {}).get("by_index", {}) if artifacts.get("generation") else {}
+    artifact_stats[("feasibility", "hit" if assessed else "miss")] += 1
+    solutions = {}
+    feasibility = {}
+
+    def dispatch(index, sol):
+        if index is None:
+            # Lo stream e' ripartito: le soluzioni gia' ricevute appartengono alla risposta scartata
+            for future in feasibility.values():
+                future.cancel()
+            solutions.clear()
+            feasibility.clear()
+            return
+        solutions[index] = sol
+        if str(index) in assessed:
+            feasibility[index] = concurrent.futures.Future()
+            feasibility[index].set_result(assessed[str(index)])
+        elif FEASIBILITY_BATCH_ENABLED:
+            feasibility[index] = feasibility_batcher.submit(problem, index, sol)
+        else:
+            feasibility[index] = _feasibility_pool.submit(contextvars.copy_context().run, assess_feasibility, problem, sol)
 
-        ranking_rationale = solutions_data.get("ranking_rationale", "")
-
-        # FASE 3: Valutazione fattibilita
-        feasibility_data = assess_feasibility(problem, solutions_data)
-        if not feasibility_data:
-            feasibility_data = {"assessments": [], "best_feasible": "", "best_overall": ""}
-
-        # Mappa fattibilita per titolo
-        feas_map = {}
-        for a in feasibility_data.get("assessments", []):
-            feas_map[a.get("solution_title", "")] = a
-
-        # Salva ogni soluzione
-        best_score = 0
-        best_title = ""
-        for sol in solutions_data.get("solutions", []):
-            title = sol.get("title", "")
-            assessment = feas_map.get(title, {
-                "feasibility_score": 0.5, "complexity": "medium",
-                "time_to_mvp": "sconosciuto", "cost_estimate": "sconosciuto",
-                "tech_stack_fit": 0.5, "biggest_risk": "non valutato",
-                "recommended_mvp": "non valutato", "nocode_compatible": True,
+    solutions_data = artifacts.get("generation")
+    artifact_stats[("generation", "hit" if solutions_data else "miss")] += 1
+    if solutions_data:
+        for index, sol in enumerate(solutions_data.get("solutions", [])):
+            dispatch(index, sol)
+    else:
+        solutions_data = generate_solutions_unconstrained(problem, dossier, on_solution=dispatch)
+        # Si salva solo l'output completo e validato: una generazione fallita si rifa' da capo
+        if solutions_data is None:
+            persist = False
+        elif solutions and persist:
+            save_artifact(problem.get("id"), "generation", {
+                "solutions": solutions_data["solutions"],
+                "ranking_rationale": solutions_data.get("ranking_rationale", ""),
             })
+    if not solutions:
+        logger.warning(f"[SA] Nessuna soluzione generata per {problem['title'][:60]}")
+        return 0
+
+    ranking_rationale = (solutions_data or {}).get("ranking_rationale", "")
+
+    # Salva tutte le soluzioni con i loro score in un colpo solo, nell'ordine di generazione
+    default_assessment = {
+        "feasibility_score": 0.5, "complexity": "medium",
+        "time_to_mvp": "sconosciuto", "cost_estimate": "sconosciuto",
+        "tech_stack_fit": 0.5, "biggest_risk": "non valutato",
+        "recommended_mvp": "non valutato", "nocode_compatible": True,
+    }
+    results = {index: feasibility[index].result() for index in sorted(solutions)}
+    # Le valutazioni si salvano per posizione nella lista salvata: lo stream puo' saltare
+    # indici (item scartati dalla validazione), la lista no
+    done = {str(pos): a for pos, a in enumerate(results.values()) if a}
+    if persist and done and done != assessed:
+        save_artifact(problem.get("id"), "feasibility", {"by_index": done})
+    rows = []
+    for index, assessment in results.items():
+        assessment = assessment or default_assessment
+        rows.append((solutions[index], assessment) + solution_rows(solutions[index], assessment, ranking_rationale, dossier))
+    ids = save_solutions_batch(problem["id"], [(solution, score) for _, _, solution, score, _ in rows])
+
+    saved = 0
+    best_overall, best_overall_score = "", -1
+    best_feasible, best_feasible_score = "", -1
+    for (sol, assessment, _, _, overall), sol_id in zip(rows, ids):
+        if not sol_id:
+            continue
+        saved += 1
+        if overall > best_overall_score:
+            best_overall, best_overall_score = sol.get("title", ""), overall
+        if assessment.get("feasibility_score", 0) > best_feasible_score:
+            best_feasible, best_feasible_score = sol.get("title", ""), assessment.get("feasibility_score", 0)
+
+    # Notifica Mirco con risultato
+    if saved > 0:
+        key_finding = dossier.get("key_finding", "")
+
+        msg = f"Ho analizzato '{problem['title']}' in 3 fasi:\n\n"
+        msg += f"Ricerca: {key_finding}\n\n"
+        msg += f"Miglior soluzione in assoluto: {best_overall}\n"
+        msg += f"Piu' fattibile per noi: {best_feasible}\n\n"
+        msg += f"{saved} soluzioni salvate. Chiedimi i dettagli!"
+        notify_telegram(msg)
+
+    return saved
+
 
-            sol_id, overall = save_solution_v2(problem["id"], sol, assessment, ranking_rationale, dossier)
-            if sol_id:
-                total_saved += 1
-                if overall > best_score:
-                    best_score = overall
-                    best_title = title
+# Problemi senza soluzioni letti a pagine dalla view problems_needing_solutions (anti-join lato DB)
+ARCHITECT_PAGE_SIZE = int(os.getenv("ARCHITECT_PAGE_SIZE", "10"))
+ARCHITECT_MAX_PROBLEMS = int(os.getenv("ARCHITECT_MAX_PROBLEMS", "30"))
 
-        # Notifica Mirco con risultato
-        if total_saved > 0:
-            best_feasible = feasibility_data.get("best_feasible", "")
-            best_overall = feasibility_data.get("best_overall", "")
-            key_finding = dossier.get("key_finding", "")
 
-            msg = f"Ho analizzato '{problem['title']}' in 3 fasi:\n\n"
-            msg += f"Ricerca: {key_finding}\n\n"
-            msg += f"Miglior soluzione in assoluto: {best_overall}\n"
-            msg += f"Piu' fattibile per noi: {best_feasible}\n\n"
-            msg += f"{total_saved} soluzioni salvate. Chiedimi i dettagli!"
-            notify_telegram(msg)
+def problems_needing_solutions(limit, exclude=(), problem_id=None):
+    """Problemi approvati senza soluzioni, per weighted_score decrescente; exclude = gia' tentati in questa run."""
+    query = supabase.table("problems_needing_solutions").select("*")
+    if problem_id:
+        query = query.eq("id", problem_id)
+    if exclude:
+        query = query.not_.in_("id", list(exclude))
+    result = query.order("weighted_score", desc=True).order("id").limit(limit).execute()
+    return result.data or []
 
-        time.sleep(2)
 
-    logger.info(f"Solution Architect v2.0 completato: {total_saved} soluzioni")
-    return {"status": "completed", "saved": total_saved}
+def run_solution_architect(problem_id=None):
+    logger.info("Solution Architect v2.0 starting (3 fasi)...")
+
+    attempted = set()
+    total_saved = 0
+    while len(attempted) < ARCHITECT_MAX_PROBLEMS:
+        try:
+            page = problems_needing_solutions(min(ARCHITECT_PAGE_SIZE, ARCHITECT_MAX_PROBLEMS - len(attempted)),
+                exclude=attempted, problem_id=problem_id)
+        except Exception as e:
+            logger.error(f"[SA] lettura problemi: {e}")
+            page = []
+        if not page:
+            break
+        attempted.update(p["id"] for p in page)
+        total_saved += architect_problems(page)
+        if problem_id or not cost_tracker.allow():
+            break
+
+    if not attempted:
+        return {"status": "no_problems", "saved": 0}
+
+    logger.info(f"Solution Architect v2.0 completato: {total_saved} soluzioni su {len(attempted)} problemi")
+    return {"status": "completed", "saved": total_saved, "problems": len(attempted)}
+
+
+def architect_problems(problems):
+    """Una pagina di problemi nel pool dell'architect. Ritorna le soluzioni salvate."""
+    total_saved = 0
+    workers = max(1, min(ARCHITECT_CONCURRENCY, len(problems)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="architect") as pool:
+        futures = {pool.submit(contextvars.copy_context().run, architect_problem, p): p for p in problems}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                total_saved += future.result()
+            except Exception as e:
+                logger.error(f"[SA] {futures[future]['title'][:60]}: {e}")
+    return total_saved
 
 
 # ============================================================
@@ -931,81 +3259,429 @@ def run_solution_architect(problem_id=None):
 # ============================================================
 
 KNOWLEDGE_PROMPT = """Sei il Knowledge Keeper di brAIn.
-Analizza i log degli agenti e estrai lezioni apprese.
+Analizza gli aggregati dei log degli agenti e estrai lezioni apprese.
+Per ogni agent/action/model ricevi chiamate, error rate, durata p50/p95, token e costo,
+piu' un campione degli errori distinti con il numero di occorrenze.
+
+Rispondi chiamando report_lessons.
+Categorie: process, technical, strategic, cost, performance."""
+
+KNOWLEDGE_TOOL = OutputTool("report_lessons", "Lezioni apprese e pattern dai log degli agenti", {
+    "lessons": {"type": "array", "items": {"type": "object", "properties": {
+        "title": SCHEMA_STR, "content": SCHEMA_STR,
+        "category": {"type": "string", "enum": ["process", "technical", "strategic", "cost", "performance"]},
+        "actionable": SCHEMA_STR,
+    }, "required": ["title", "content", "category"]}},
+    "patterns": {"type": "array", "items": {"type": "object", "properties": {
+        "pattern": SCHEMA_STR, "frequency": SCHEMA_STR,
+    }, "required": ["pattern"]}},
+    "summary": SCHEMA_STR,
+}, ["lessons", "patterns", "summary"], "lessons")
+
+
+# Il Keeper legge tutti i log nuovi dal watermark (org_config, chiave KK_WATERMARK_KEY = ultimo id
+# analizzato), a pagine, e li riassume in aggregati per agent/action/model: il prompt ha la stessa
+# dimensione qualunque sia il volume. Il watermark si avanza con compare-and-set prima della chiamata
+# (due run sovrapposte non rianalizzano le stesse righe) e si ripristina se l'analisi fallisce.
+KK_WATERMARK_KEY = "knowledge_keeper_watermark"
+KK_PAGE_SIZE = int(os.getenv("KK_PAGE_SIZE", "1000"))
+KK_MAX_ROWS = int(os.getenv("KK_MAX_ROWS", "200000"))
+KK_MAX_GROUPS = int(os.getenv("KK_MAX_GROUPS", "40"))
+KK_ERROR_SAMPLES = int(os.getenv("KK_ERROR_SAMPLES", "10"))
+# Righe piu' recenti di KK_SETTLE_S restano al prossimo giro: insert concorrenti possono
+# rendersi visibili fuori ordine di id
+KK_SETTLE_S = int(os.getenv("KK_SETTLE_S", "60"))
+KK_LOG_COLUMNS = "id,agent_id,action,model_used,status,error,duration_ms,tokens_input,tokens_output,cost_usd,created_at"
+
+_ERROR_NOISE = re.compile(r"\d+|0x[0-9a-f]+|'[^']*'|\"[^\"]*\"")
+
+
+def read_watermark(key):
+    """(valore grezzo in org_config o None, stato decodificato o {})."""
+    result = supabase.table("org_config").select("value").eq("key", key).execute()
+    if not result.data:
+        return None, {}
+    raw = result.data[0]["value"]
+    return raw, json.loads(raw)
+
+
+def advance_watermark(key, raw, state, description=""):
+    """Compare-and-set: sposta il watermark solo se vale ancora raw. Ritorna il nuovo valore o None."""
+    value = json.dumps(dict(state, at=datetime.now(timezone.utc).isoformat()))
+    try:
+        if raw is None:
+            supabase.table("org_config").insert({"key": key, "value": value, "description": description}).execute()
+            return value
+        result = supabase.table("org_config").update({"value": value}).eq("key", key).eq("value", raw).execute()
+        return value if result.data else None
+    except Exception as e:
+        logger.warning(f"[WATERMARK] {key}: {e}")
+        return None
 
-Rispondi SOLO con JSON:
-{"lessons":[{"title":"titolo","content":"descrizione","category":"process","actionable":"azione"}],"patterns":[{"pattern":"descrizione","frequency":"quanto"}],"summary":"riassunto breve"}
 
-Categorie: process, technical, strategic, cost, performance.
-SOLO JSON."""
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class LogAggregate:
+    """Aggregati per (agent, action, model) e campione degli errori distinti, riga per riga."""
+
+    def __init__(self):
+        self.rows = 0
+        self.first_at = self.last_at = None
+        self.groups = collections.defaultdict(lambda: {
+            "calls": 0, "errors": 0, "durations": [], "tokens_in": 0, "tokens_out": 0, "cost": 0.0})
+        self.errors = collections.Counter()
+        self.error_example = {}
+
+    def add(self, row):
+        self.rows += 1
+        created = row.get("created_at")
+        self.first_at = self.first_at or created
+        self.last_at = created or self.last_at
+        g = self.groups[(row.get("agent_id") or "?", row.get("action") or "?", row.get("model_used") or "-")]
+        g["calls"] += 1
+        if row.get("duration_ms") is not None:
+            g["durations"].append(row["duration_ms"])
+        g["tokens_in"] += row.get("tokens_input") or 0
+        g["tokens_out"] += row.get("tokens_output") or 0
+        g["cost"] += float(row.get("cost_usd") or 0)
+        if row.get("status") == "error" or row.get("error"):
+            g["errors"] += 1
+            error = str(row.get("error") or "errore senza messaggio")
+            key = (row.get("agent_id"), _ERROR_NOISE.sub("#", error)[:160])
+            self.errors[key] += 1
+            self.error_example.setdefault(key, error[:300])
+
+    def summary(self):
+        groups = sorted(self.groups.items(), key=lambda kv: kv[1]["calls"], reverse=True)
+        out = []
+        for (agent, action, model), g in groups[:KK_MAX_GROUPS]:
+            durations = sorted(g["durations"])
+            out.append({
+                "agent": agent, "action": action, "model": model, "calls": g["calls"],
+                "error_rate": round(g["errors"] / g["calls"], 3),
+                "p50_ms": _percentile(durations, 0.5), "p95_ms": _percentile(durations, 0.95),
+                "tokens_in": g["tokens_in"], "tokens_out": g["tokens_out"], "cost_usd": round(g["cost"], 4),
+            })
+        rest = groups[KK_MAX_GROUPS:]
+        return {
+            "period": {"from": self.first_at, "to": self.last_at},
+            "rows": self.rows,
+            "cost_usd": round(sum(g["cost"] for g in self.groups.values()), 4),
+            "error_rate": round(sum(g["errors"] for g in self.groups.values()) / self.rows, 3) if self.rows else 0,
+            "by_agent_action_model": out,
+            "other_groups": {"groups": len(rest), "calls": sum(g["calls"] for _, g in rest)},
+            "errors": [{"agent": agent, "count": n, "example": self.error_example[(agent, pattern)]}
+                for (agent, pattern), n in self.errors.most_common(KK_ERROR_SAMPLES)],
+            "distinct_errors": len(self.errors),
+        }
+
+
+def aggregate_new_logs(after_id):
+    """Pagina agent_logs per id crescente da after_id (None: ultime 24 ore). Ritorna (aggregato, ultimo id).
+
+    created_at lo mette il client all'ingresso nel sink, quindi fra i sink dei tre servizi non segue
+    l'ordine degli id: la scansione va solo per id e si ferma alla prima riga non ancora assestata,
+    cosi' il watermark non supera mai righe che non sono state lette.
+    """
+    agg = LogAggregate()
+    last_id = after_id
+    settled = datetime.now(timezone.utc) - timedelta(seconds=KK_SETTLE_S)
+    since = (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()
+    while agg.rows < KK_MAX_ROWS:
+        query = supabase.table("agent_logs").select(KK_LOG_COLUMNS)
+        if after_id is None:
+            query = query.gte("created_at", since)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        page = query.order("id").limit(KK_PAGE_SIZE).execute().data or []
+        for row in page:
+            if row.get("created_at") and _parse_ts(row["created_at"]) >= settled:
+                return agg, last_id
+            agg.add(row)
+            last_id = row["id"]
+        if len(page) < KK_PAGE_SIZE:
+            break
+    return agg, last_id
+
+
+# Lezioni deduplicate via embedding (stesso feature hashing dei dossier): una lezione simile almeno
+# LESSON_MERGE_SIMILARITY a una esistente della stessa categoria ne incrementa occurrences (RPC save_lesson)
+LESSON_MERGE_SIMILARITY = float(os.getenv("LESSON_MERGE_SIMILARITY", "0.9"))
+LESSON_BACKFILL_BATCH = int(os.getenv("LESSON_BACKFILL_BATCH", "100"))
+
+
+def lesson_text(lesson):
+    return f"{lesson.get('title') or ''} {lesson.get('content') or ''}"
+
+
+def save_lesson(lesson):
+    """Inserisce la lezione o la fonde con una quasi identica. Ritorna "inserted", "merged" o None se fallisce."""
+    try:
+        result = supabase.rpc("save_lesson", {
+            "p_title": lesson.get("title", ""),
+            "p_content": lesson.get("content", ""),
+            "p_category": lesson.get("category", "general"),
+            "p_source": "knowledge_keeper_v1",
+            "p_embedding": text_embedding(lesson_text(lesson)),
+            "p_min_similarity": LESSON_MERGE_SIMILARITY,
+        }).execute()
+    except Exception as e:
+        logger.warning(f"[KK] salvataggio lezione: {e}")
+        return None
+    row = (result.data or [{}])[0]
+    return "merged" if row.get("merged") else "inserted"
+
+
+def backfill_lesson_embeddings(limit=LESSON_BACKFILL_BATCH):
+    """Indicizza le lezioni salvate prima della dedupe, qualche decina per run: con l'RPC backfill_lesson
+    quelle quasi identiche a una gia' indicizzata vi si fondono, le altre ricevono l'embedding.
+    Ritorna {"indexed": n, "merged": n}."""
+    outcomes = collections.Counter()
+    try:
+        rows = supabase.table("org_knowledge").select("id,title,content") \
+            .is_("embedding", "null").order("id").limit(limit).execute().data or []
+        for row in rows:
+            result = supabase.rpc("backfill_lesson", {
+                "p_id": row["id"],
+                "p_embedding": text_embedding(lesson_text(row)),
+                "p_min_similarity": LESSON_MERGE_SIMILARITY,
+            }).execute()
+            merged = (result.data or [{}])[0].get("merged")
+            outcomes["merged" if merged else "indexed"] += 1
+    except Exception as e:
+        logger.warning(f"[KK] backfill embedding: {e}")
+    if outcomes["merged"]:
+        logger.info(f"[KK] backfill: {outcomes['merged']} lezioni duplicate fuse")
+    return dict(outcomes)
 
 
 def run_knowledge_keeper():
     logger.info("Knowledge Keeper v1.1 starting...")
 
-    since = (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()
     try:
-        logs = supabase.table("agent_logs").select("*").gte("created_at", since).order("created_at", desc=True).limit(50).execute()
-        logs = logs.data or []
-    except:
-        logs = []
+        raw, state = read_watermark(KK_WATERMARK_KEY)
+        after_id = state.get("id")
+        agg, last_id = aggregate_new_logs(after_id)
+    except Exception as e:
+        logger.error(f"[KK ERROR] lettura log: {e}")
+        return {"status": "error", "error": str(e)}
 
-    if not logs:
+    if not agg.rows:
         return {"status": "no_logs", "saved": 0}
 
-    simple_logs = [{
-        "agent": l.get("agent_id"), "action": l.get("action"),
-        "status": l.get("status"), "model": l.get("model_used"),
-        "tokens_in": l.get("tokens_input"), "tokens_out": l.get("tokens_output"),
-        "cost": l.get("cost_usd"), "duration_ms": l.get("duration_ms"),
-        "error": l.get("error"), "time": l.get("created_at"),
-    } for l in logs]
+    if not cost_tracker.allow():
+        return {"status": "budget_exhausted", "saved": 0}
 
-    start = time.time()
+    claimed = advance_watermark(KK_WATERMARK_KEY, raw, {"id": last_id}, "Ultimo agent_logs.id analizzato dal Knowledge Keeper")
+    if claimed is None:
+        logger.warning("[KK] watermark spostato da un'altra run, salto")
+        return {"status": "concurrent_run", "saved": 0}
+
+    model = "claude-haiku-4-5-20251001"
     try:
-        response = claude.messages.create(
-            model="claude-haiku-4-5-20251001",
+        data = call_structured("knowledge_keeper", "analyze_logs", 5, f"Analizzati {agg.rows} log (id {after_id} -> {last_id})",
+            model=model,
+            tool=KNOWLEDGE_TOOL,
             max_tokens=1024,
             system=KNOWLEDGE_PROMPT,
-            messages=[{"role": "user", "content": f"Analizza SOLO JSON:\n\n{json.dumps(simple_logs, default=str)}"}]
+            messages=[{"role": "user", "content": f"Aggregati dei log degli agenti:\n\n{json.dumps(agg.summary(), ensure_ascii=False, default=str)}"}]
         )
-        duration = int((time.time() - start) * 1000)
-        reply = response.content[0].text
+        if data is None:
+            advance_watermark(KK_WATERMARK_KEY, claimed, {"id": after_id})
+            return {"status": "error", "error": "llm non disponibile o output non valido"}
+        # Le anomalie (errori, latenze, costi) le rileva run_anomaly_detector sui rollup, non il testo dei pattern
+        backfill_lesson_embeddings()
+        outcomes = collections.Counter(save_lesson(lesson) for lesson in data.get("lessons", []))
+        return {"status": "completed", "saved": outcomes["inserted"], "merged": outcomes["merged"], "logs": agg.rows}
 
-        log_to_supabase("knowledge_keeper", "analyze_logs", 5,
-            f"Analizzati {len(logs)} log", reply[:500],
-            "claude-haiku-4-5-20251001",
-            response.usage.input_tokens, response.usage.output_tokens,
-            (response.usage.input_tokens * 1.0 + response.usage.output_tokens * 5.0) / 1_000_000,
-            duration)
+    except Exception as e:
+        logger.error(f"[KK ERROR] {e}")
+        advance_watermark(KK_WATERMARK_KEY, claimed, {"id": after_id})
+        return {"status": "error", "error": str(e)}
 
-        data = extract_json(reply)
-        saved = 0
-        if data:
-            for lesson in data.get("lessons", []):
-                try:
-                    supabase.table("org_knowledge").insert({
-                        "title": lesson.get("title", ""),
-                        "content": lesson.get("content", ""),
-                        "category": lesson.get("category", "general"),
-                        "source": "knowledge_keeper_v1",
-                    }).execute()
-                    saved += 1
-                except:
-                    pass
 
-            for p in data.get("patterns", []):
-                if "error" in p.get("pattern", "").lower() or "fail" in p.get("pattern", "").lower():
-                    emit_event("knowledge_keeper", "error_pattern_detected", None,
-                        {"pattern": p["pattern"]}, "high")
-                    notify_telegram(f"Pattern di errore rilevato: {p['pattern']}")
+# ============================================================
+# ANOMALY DETECTOR — z-score robusti sui rollup orari
+# ============================================================
 
-        return {"status": "completed", "saved": saved}
+# L'ultima ora chiusa di ogni agent/action si confronta con le ANOMALY_BASELINE_H ore precedenti:
+# z = 0.6745 * (x - mediana) / MAD, per error rate, durata p95 e costo, su tutte le serie insieme.
+# La decisione e' solo numerica (riproducibile); Haiku spiega le anomalie gia' confermate.
+ANOMALY_BASELINE_H = int(os.getenv("ANOMALY_BASELINE_H", str(7 * 24)))
+ANOMALY_MIN_HISTORY_H = int(os.getenv("ANOMALY_MIN_HISTORY_H", "24"))
+ANOMALY_MIN_CALLS = int(os.getenv("ANOMALY_MIN_CALLS", "10"))
+ANOMALY_Z = float(os.getenv("ANOMALY_Z", "3.5"))
+ANOMALY_MAX_EXPLAIN = int(os.getenv("ANOMALY_MAX_EXPLAIN", "5"))
+ANOMALY_PAGE_SIZE = 1000
+ANOMALY_WATERMARK_KEY = "anomaly_detector_watermark"
+# metrica -> scarto minimo sopra la mediana, e minimo della dispersione (MAD) usata per lo z:
+# su una serie piatta (MAD 0) serve uno scarto di circa ANOMALY_Z / 0.6745 volte questo valore
+ANOMALY_MIN_DELTA = {"error_rate": 0.05, "duration_p95_ms": 2000, "cost_usd": 0.05}
+ANOMALY_METRICS = tuple(ANOMALY_MIN_DELTA)
+
+ANOMALY_PROMPT = """Sei l'SRE di brAIn. Ricevi anomalie GIA' CONFERMATE da un rilevatore statistico
+sui log orari degli agenti (valore dell'ultima ora, mediana e z-score robusto sulla settimana,
+ultime ore della serie, esempi di errori quando ci sono).
+Non rimettere in discussione l'anomalia: spiega la causa piu' probabile e l'azione da fare.
+
+Rispondi chiamando report_anomaly_explanations, una spiegazione per anomaly_id."""
+
+ANOMALY_TOOL = OutputTool("report_anomaly_explanations", "Spiegazione delle anomalie confermate", {
+    "explanations": {"type": "array", "items": {"type": "object", "properties": {
+        "anomaly_id": SCHEMA_STR, "likely_cause": SCHEMA_STR, "suggested_action": SCHEMA_STR,
+    }, "required": ["anomaly_id", "likely_cause", "suggested_action"]}},
+}, ["explanations"], "explanations")
+
+
+def _parse_ts(value):
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+
+
+def load_hourly_series(start, hours):
+    """Rollup orari da start per hours ore, sommati sui modelli: (chiavi [(agent, action)], {colonna: matrice serie x ore})."""
+    columns = "bucket,agent_id,action,calls,errors,cost_usd,duration_p95_ms"
+    rows, offset = [], 0
+    while True:
+        page = supabase.table("agent_logs_hourly").select(columns) \
+            .gte("bucket", start.isoformat()).lt("bucket", (start + timedelta(hours=hours)).isoformat()) \
+            .order("bucket").order("agent_id").order("action") \
+            .range(offset, offset + ANOMALY_PAGE_SIZE - 1).execute().data or []
+        rows.extend(page)
+        if len(page) < ANOMALY_PAGE_SIZE:
+            break
+        offset += ANOMALY_PAGE_SIZE
+    keys = sorted({(r["agent_id"], r["action"]) for r in rows})
+    if not rows:
+        return keys, {}
+    index = {k: i for i, k in enumerate(keys)}
+    series = np.array([index[(r["agent_id"], r["action"])] for r in rows])
+    hour = np.array([int((_parse_ts(r["bucket"]) - start).total_seconds() // 3600) for r in rows])
+    shape = (len(keys), hours)
+    out = {}
+    for col in ("calls", "errors", "cost_usd"):
+        out[col] = np.zeros(shape)
+        np.add.at(out[col], (series, hour), np.array([float(r[col] or 0) for r in rows]))
+    # Piu' modelli nella stessa ora: la p95 peggiore
+    out["duration_p95_ms"] = np.full(shape, np.nan)
+    np.fmax.at(out["duration_p95_ms"], (series, hour),
+        np.array([np.nan if r["duration_p95_ms"] is None else float(r["duration_p95_ms"]) for r in rows]))
+    return keys, out
+
+
+def robust_anomalies(values, min_delta):
+    """values: serie x ore, l'ultima colonna e' l'ora da giudicare (NaN = ora non valutabile).
+    Ritorna (maschera anomalie, mediana, z) per serie."""
+    baseline, current = values[:, :-1], values[:, -1]
+    history = np.sum(~np.isnan(baseline), axis=1)
+    ok = (history >= ANOMALY_MIN_HISTORY_H) & ~np.isnan(current)
+    median = np.full(len(values), np.nan)
+    mad = np.full(len(values), np.nan)
+    if ok.any():
+        median[ok] = np.nanmedian(baseline[ok], axis=1)
+        mad[ok] = np.nanmedian(np.abs(baseline[ok] - median[ok, None]), axis=1)
+    delta = current - median
+    # Dispersione minima: senza, una baseline costante (MAD 0) renderebbe infinito ogni scarto
+    z = 0.6745 * delta / np.fmax(mad, min_delta)
+    return ok & (z >= ANOMALY_Z) & (delta >= min_delta), median, z
+
+
+def detect_anomalies(target):
+    """Anomalie dell'ora che inizia a target rispetto alle ANOMALY_BASELINE_H ore precedenti."""
+    start = target - timedelta(hours=ANOMALY_BASELINE_H)
+    keys, m = load_hourly_series(start, ANOMALY_BASELINE_H + 1)
+    if not keys:
+        return [], 0
+    enough = m["calls"] >= ANOMALY_MIN_CALLS
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics_by_name = {
+            "error_rate": np.where(enough, m["errors"] / m["calls"], np.nan),
+            "duration_p95_ms": np.where(enough, m["duration_p95_ms"], np.nan),
+            # Le ore senza traffico (agenti schedulati) non entrano nella baseline del costo
+            "cost_usd": np.where(enough, m["cost_usd"], np.nan),
+        }
+    found = []
+    for metric in ANOMALY_METRICS:
+        values = metrics_by_name[metric]
+        flagged, median, z = robust_anomalies(values, ANOMALY_MIN_DELTA[metric])
+        for i in np.flatnonzero(flagged):
+            agent_id, action = keys[i]
+            found.append({
+                "anomaly_id": f"{agent_id}/{action}/{metric}/{target:%Y%m%d%H}",
+                "agent_id": agent_id, "action": action, "metric": metric, "bucket": target.isoformat(),
+                "value": round(float(values[i, -1]), 4), "median": round(float(median[i]), 4),
+                "z": round(float(z[i]), 1),
+                "calls": int(m["calls"][i, -1]),
+                "recent": [None if np.isnan(v) else round(float(v), 4) for v in values[i, -7:-1]],
+            })
+    return found, len(keys)
+
+
+def explain_anomalies(anomalies, target):
+    """{anomaly_id: spiegazione} da Haiku per le prime ANOMALY_MAX_EXPLAIN anomalie; {} se non disponibile."""
+    batch = anomalies[:ANOMALY_MAX_EXPLAIN]
+    if not batch or not cost_tracker.allow():
+        return {}
+    context = []
+    for a in batch:
+        entry = dict(a)
+        if a["metric"] == "error_rate":
+            try:
+                errors = supabase.table("agent_logs").select("error").eq("agent_id", a["agent_id"]).eq("action", a["action"]) \
+                    .eq("status", "error").gte("created_at", target.isoformat()) \
+                    .lt("created_at", (target + timedelta(hours=1)).isoformat()).limit(20).execute().data or []
+                entry["error_samples"] = list(dict.fromkeys(str(e["error"])[:200] for e in errors if e.get("error")))[:5]
+            except Exception as e:
+                logger.warning(f"[ANOMALY] esempi errori: {e}")
+        context.append(entry)
+    data = call_structured("anomaly_detector", "explain_anomalies", 5, f"{len(batch)} anomalie",
+        model="claude-haiku-4-5-20251001",
+        tool=ANOMALY_TOOL,
+        max_tokens=1024,
+        system=ANOMALY_PROMPT,
+        messages=[{"role": "user", "content": json.dumps(context, ensure_ascii=False)}]
+    )
+    return {e["anomaly_id"]: e for e in (data or {}).get("explanations", [])}
 
+
+def run_anomaly_detector(now=None):
+    """Giudica l'ultima ora chiusa (una volta sola: watermark in org_config) ed emette eventi e alert."""
+    now = now or datetime.now(timezone.utc)
+    target = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    try:
+        raw, state = read_watermark(ANOMALY_WATERMARK_KEY)
+        if state.get("bucket") and _parse_ts(state["bucket"]) >= target:
+            return {"status": "already_checked", "bucket": target.isoformat(), "anomalies": 0}
+        anomalies, series = detect_anomalies(target)
     except Exception as e:
-        logger.error(f"[KK ERROR] {e}")
+        logger.error(f"[ANOMALY ERROR] {e}")
         return {"status": "error", "error": str(e)}
 
+    if advance_watermark(ANOMALY_WATERMARK_KEY, raw, {"bucket": target.isoformat()},
+            "Ultima ora di agent_logs_hourly giudicata dall'anomaly detector") is None:
+        return {"status": "concurrent_run", "bucket": target.isoformat(), "anomalies": 0}
+
+    explanations = {}
+    if anomalies:
+        try:
+            explanations = explain_anomalies(anomalies, target)
+        except Exception as e:
+            logger.error(f"[ANOMALY] spiegazione: {e}")
+    for a in anomalies:
+        explanation = explanations.get(a["anomaly_id"], {})
+        emit_event("anomaly_detector", "anomaly_detected", None, dict(a,
+            likely_cause=explanation.get("likely_cause"), suggested_action=explanation.get("suggested_action")), "high")
+        msg = (f"Anomalia {a['metric']} su {a['agent_id']}/{a['action']} ({target:%d/%m %H}:00): "
+               f"{a['value']} contro mediana {a['median']}, z={a['z']}")
+        if explanation:
+            msg += f"\nCausa probabile: {explanation['likely_cause']}\nAzione: {explanation['suggested_action']}"
+        notify_telegram(msg)
+    logger.info(f"[ANOMALY] {target:%Y-%m-%d %H}:00: {len(anomalies)} anomalie su {series} serie")
+    return {"status": "completed", "bucket": target.isoformat(), "series": series, "anomalies": len(anomalies)}
+
 
 # ============================================================
 # CAPABILITY SCOUT v1.1
@@ -1025,45 +3701,49 @@ Budget: 1000 euro/mese. Preferenza: no-code o low-code.
 
 Seleziona SOLO le 3-5 scoperte piu rilevanti.
 
-Rispondi SOLO con JSON:
-{"discoveries":[{"tool_name":"nome","category":"ai_model","description":"cosa fa","potential_impact":"come aiuta brAIn","cost":"stima","relevance":"high","action":"evaluate"}],"summary":"riassunto"}
-SOLO JSON."""
+Rispondi chiamando report_discoveries: potential_impact = come aiuta brAIn, action = adopt, evaluate, monitor o ignore."""
+
+SCOUT_TOOL = OutputTool("report_discoveries", "Scoperte rilevanti per brAIn", {
+    "discoveries": {"type": "array", "items": {"type": "object", "properties": {
+        "tool_name": SCHEMA_STR, "category": SCHEMA_STR, "description": SCHEMA_STR,
+        "potential_impact": SCHEMA_STR, "cost": SCHEMA_STR,
+        "relevance": {"type": "string", "enum": ["high", "medium", "low"]},
+        "action": {"type": "string", "enum": ["adopt", "evaluate", "monitor", "ignore"]},
+    }, "required": ["tool_name", "category", "description", "potential_impact", "relevance", "action"]}},
+    "summary": SCHEMA_STR,
+}, ["discoveries", "summary"], "discoveries")
 
 
 def run_capability_scout():
     logger.info("Capability Scout v1.1 starting...")
 
+    if not cost_tracker.allow():
+        return {"status": "budget_exhausted", "saved": 0}
+
+    topics = SCOUT_TOPICS if cost_tracker.budget_state() == "ok" else SCOUT_TOPICS[:2]
+
     search_results = []
-    for topic in SCOUT_TOPICS:
+    for topic in topics:
         result = search_perplexity(topic)
         if result:
             search_results.append((topic, result))
-        time.sleep(1)
 
     if not search_results:
         return {"status": "no_results", "saved": 0}
 
     combined = "\n\n---\n\n".join([f"Topic: {t}\nResults: {r}" for t, r in search_results])
 
-    start = time.time()
+    model = "claude-haiku-4-5-20251001"
     try:
-        response = claude.messages.create(
-            model="claude-haiku-4-5-20251001",
+        data = call_structured("capability_scout", "analyze_discoveries", 5, f"Analizzati {len(search_results)} topic",
+            model=model,
+            tool=SCOUT_TOOL,
             max_tokens=2048,
             system=SCOUT_PROMPT,
-            messages=[{"role": "user", "content": f"Analizza SOLO JSON:\n\n{combined}"}]
+            messages=[{"role": "user", "content": f"Analizza:\n\n{combined}"}]
         )
-        duration = int((time.time() - start) * 1000)
-        reply = response.content[0].text
-
-        log_to_supabase("capability_scout", "analyze_discoveries", 5,
-            f"Analizzati {len(search_results)} topic", reply[:500],
-            "claude-haiku-4-5-20251001",
-            response.usage.input_tokens, response.usage.output_tokens,
-            (response.usage.input_tokens * 1.0 + response.usage.output_tokens * 5.0) / 1_000_000,
-            duration)
-
-        data = extract_json(reply)
+        if data is None:
+            return {"status": "error", "error": "llm non disponibile o output non valido"}
         saved = 0
         if data:
             for disc in data.get("discoveries", []):
@@ -1134,6 +3814,158 @@ def process_events():
     return {"processed": processed}
 
 
+# ============================================================
+# PROFILING — campionamento on-demand degli endpoint
+# ============================================================
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "1") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0") or 0)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/brain-profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+recent_profiles = collections.OrderedDict()
+_profiles_lock = threading.Lock()
+
+
+class SamplingProfiler:
+    """Campiona gli stack di tutti i thread ogni interval secondi.
+
+    Produce stack "folded" (thread;modulo:funzione;...) pronti per flamegraph.pl o speedscope.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._wall0 = time.monotonic()
+        self._cpu0 = time.process_time()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.wall_ms = round((time.monotonic() - self._wall0) * 1000, 1)
+        self.cpu_ms = round((time.process_time() - self._cpu0) * 1000, 1)
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                if tid not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common()) + "\n"
+
+    def top_frames(self, n=25):
+        """Campioni per frame in cima allo stack (self) e ovunque nello stack (total)."""
+        self_counts = collections.Counter()
+        total_counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                self_counts[frames[-1]] += count
+            for f in set(frames):
+                total_counts[f] += count
+        return {
+            "self": self_counts.most_common(n),
+            "total": total_counts.most_common(n),
+        }
+
+
+def save_profile(run_id, path, profiler):
+    meta = {
+        "run_id": run_id, "path": path,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "wall_ms": profiler.wall_ms, "cpu_ms": profiler.cpu_ms,
+        "samples": profiler.samples, "interval_ms": PROFILE_INTERVAL_MS,
+        "top": profiler.top_frames(),
+    }
+    folded = profiler.folded()
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f"{run_id}.folded"), "w") as f:
+            f.write(folded)
+        with open(os.path.join(PROFILE_DIR, f"{run_id}.json"), "w") as f:
+            json.dump(meta, f)
+    except OSError as e:
+        logger.error(f"[PROFILE] salvataggio {run_id}: {e}")
+    with _profiles_lock:
+        recent_profiles[run_id] = {"meta": meta, "folded": folded}
+        while len(recent_profiles) > PROFILE_KEEP:
+            old_id, _ = recent_profiles.popitem(last=False)
+            for ext in ("folded", "json"):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, f"{old_id}.{ext}"))
+                except OSError:
+                    pass
+
+
+def profile_requested(request):
+    if request.headers.get("X-Profile", "").lower() in ("1", "true", "yes"):
+        return True
+    if request.query.get("profile", "").lower() in ("1", "true", "yes"):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+@web.middleware
+async def profiling_middleware(request, handler):
+    if request.method != "POST" or not profile_requested(request):
+        return await handler(request)
+    profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+    with run_context(f"profile:{request.path}") as run:
+        profiler.start()
+        try:
+            response = await handler(request)
+        finally:
+            profiler.stop()
+            save_profile(run.id, request.path, profiler)
+    logger.info(f"[PROFILE] {request.path} run {run.id}: {profiler.samples} campioni, {profiler.wall_ms}ms")
+    response.headers["X-Profile-Id"] = run.id
+    return response
+
+
+async def profiles_endpoint(request):
+    if not metrics_authorized(request):
+        return web.Response(text="unauthorized", status=401)
+    with _profiles_lock:
+        metas = [p["meta"] for p in recent_profiles.values()]
+    return web.json_response([{k: v for k, v in m.items() if k != "top"} for m in reversed(metas)])
+
+
+async def profile_endpoint(request):
+    """Scarica il profilo: ?format=folded (default, per flamegraph) oppure ?format=json."""
+    if not metrics_authorized(request):
+        return web.Response(text="unauthorized", status=401)
+    run_id = request.match_info["run_id"]
+    with _profiles_lock:
+        profile = recent_profiles.get(run_id)
+    if not profile:
+        return web.json_response({"error": "profilo non trovato"}, status=404)
+    if request.query.get("format") == "json":
+        return web.json_response(profile["meta"])
+    return web.Response(text=profile["folded"], content_type="text/plain", headers={
+        "Content-Disposition": f'attachment; filename="profile-{run_id}.folded"'})
+
+
 # ============================================================
 # HTTP ENDPOINTS
 # ============================================================
@@ -1141,8 +3973,19 @@ def process_events():
 async def health_check(request):
     return web.Response(text="OK", status=200)
 
+def tracked(name, fn, *args):
+    """Esegue fn dentro una run e allega costo e run_id al risultato."""
+    with run_context(name) as run:
+        result = fn(*args)
+    if isinstance(result, dict):
+        summary = run.summary()
+        result["run_id"] = summary["run_id"]
+        result["cost_usd"] = summary["cost_usd"]
+    return result
+
+
 async def run_scanner_endpoint(request):
-    result = run_world_scanner()
+    result = tracked("scanner", run_world_scanner)
     return web.json_response(result)
 
 async def run_custom_scan_endpoint(request):
@@ -1151,41 +3994,69 @@ async def run_custom_scan_endpoint(request):
         topic = data.get("topic", "")
         if not topic:
             return web.json_response({"error": "missing topic"}, status=400)
-        result = run_custom_scan(topic)
+        result = tracked("scanner_custom", run_custom_scan, topic)
         return web.json_response(result)
     except Exception as e:
         return web.json_response({"error": str(e)}, status=500)
 
 async def run_architect_endpoint(request):
-    result = run_solution_architect()
+    result = tracked("architect", run_solution_architect)
     return web.json_response(result)
 
 async def run_knowledge_endpoint(request):
-    result = run_knowledge_keeper()
+    result = tracked("knowledge", run_knowledge_keeper)
     return web.json_response(result)
 
 async def run_scout_endpoint(request):
-    result = run_capability_scout()
+    result = tracked("scout", run_capability_scout)
     return web.json_response(result)
 
 async def run_events_endpoint(request):
-    result = process_events()
+    result = tracked("events", process_events)
     return web.json_response(result)
 
 async def run_all_endpoint(request):
-    results = {}
-    results["scanner"] = run_world_scanner()
-    results["architect"] = run_solution_architect()
-    results["knowledge"] = run_knowledge_keeper()
-    results["scout"] = run_capability_scout()
-    results["events"] = process_events()
-    return web.json_response(results)
+    def run_all():
+        results = {}
+        results["scanner"] = run_world_scanner()
+        results["architect"] = run_solution_architect()
+        results["knowledge"] = run_knowledge_keeper()
+        results["scout"] = run_capability_scout()
+        results["events"] = process_events()
+        return results
+    result = tracked("all", run_all)
+    return web.json_response(result)
+
+async def run_anomalies_endpoint(request):
+    result = tracked("anomalies", run_anomaly_detector)
+    return web.json_response(result)
+
+async def run_rollups_endpoint(request):
+    """Refresh periodico dei rollup (Cloud Scheduler), poi il controllo anomalie sull'ultima ora chiusa.
+    Body opzionale {"since": iso} per backfill."""
+    try:
+        data = await request.json() if request.can_read_body else {}
+        rows = refresh_rollups(data.get("since"))
+        return web.json_response({"status": "completed", "hourly_rows": rows, "anomalies": run_anomaly_detector()})
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+
+async def costs_endpoint(request):
+    return web.json_response({
+        "by_agent": cost_tracker.snapshot(),
+        "budget_state": cost_tracker.budget_state(),
+        "run_budget_usd": RUN_BUDGET_USD,
+        "daily_budget_usd": DAILY_BUDGET_USD,
+        "llm_cache": llm_cache.stats(),
+        "structured_output": structured_stats.snapshot(),
+        "generation_cascade": cascade_stats.snapshot(),
+    })
 
 
 async def main():
     logger.info("brAIn Agents Runner v1.2 starting...")
 
-    app = web.Application()
+    app = web.Application(middlewares=[profiling_middleware] if PROFILING_ENABLED else [])
     app.router.add_get("/", health_check)
     app.router.add_post("/scanner", run_scanner_endpoint)
     app.router.add_post("/scanner/custom", run_custom_scan_endpoint)
@@ -1194,6 +4065,14 @@ async def main():
     app.router.add_post("/scout", run_scout_endpoint)
     app.router.add_post("/events", run_events_endpoint)
     app.router.add_post("/all", run_all_endpoint)
+    app.router.add_post("/rollups", run_rollups_endpoint)
+    app.router.add_post("/anomalies", run_anomalies_endpoint)
+    app.router.add_get("/costs", costs_endpoint)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_get("/traces", traces_endpoint)
+    app.router.add_get("/traces/{run_id}", trace_endpoint)
+    app.router.add_get("/profiles", profiles_endpoint)
+    app.router.add_get("/profiles/{run_id}", profile_endpoint)
 
     runner = web.AppRunner(app)
     await runner.setup()
@@ -1201,12 +4080,22 @@ async def main():
     await site.start()
 
     logger.info(f"Agents Runner on port {PORT}")
+    http_client.warm(["https://api.perplexity.ai", "https://api.telegram.org"])
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
 
     try:
-        while True:
-            await asyncio.sleep(3600)
-    except (KeyboardInterrupt, SystemExit):
+        await stop.wait()
+    finally:
         await runner.cleanup()
+        await http_client.close()
+        log_sink.close()
 
 
 if __name__ == "__main__":
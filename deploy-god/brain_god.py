@@ -12,15 +12,26 @@ import os
 import json
 import re
 import time
+import uuid
+import queue
+import signal
+import atexit
 import logging
 import asyncio
+import collections
 import threading
+import random
 import base64
-from datetime import datetime, timedelta
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+import aiohttp
 from aiohttp import web
 from dotenv import load_dotenv
 import anthropic
-import requests as http_requests
+import requests
+from requests.adapters import HTTPAdapter
 from supabase import create_client
 from telegram import Update, Bot
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
@@ -38,7 +49,8 @@ GCP_PROJECT = "brain-core-487914"
 GCP_REGION = "europe-west3"
 ARTIFACT_REGISTRY = f"{GCP_REGION}-docker.pkg.dev/{GCP_PROJECT}/brain-repo"
 
-claude = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+# I retry li gestisce create_message (backoff, breaker, fallback): niente retry interni dell'SDK
+claude = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0)
 supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
 
 AUTHORIZED_USER_ID = None
@@ -88,7 +100,8 @@ def get_claude_md():
         if not GITHUB_TOKEN:
             return "[CLAUDE.md non disponibile: GitHub token mancante]"
         url = f"{GITHUB_API}/repos/{GITHUB_REPO}/contents/CLAUDE.md"
-        r = http_requests.get(url, headers=github_headers(), timeout=10)
+        with span("http", "github.claude_md"):
+            r = http_client.get(url, headers=github_headers(), timeout=10)
         if r.status_code == 200:
             content = base64.b64decode(r.json()["content"]).decode("utf-8")
             _claude_md_cache["content"] = content
@@ -104,7 +117,7 @@ def transcribe_voice(audio_bytes):
     try:
         url = "https://speech.googleapis.com/v1/speech:recognize"
         token_url = "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token"
-        token_r = http_requests.get(token_url, headers={"Metadata-Flavor": "Google"}, timeout=5)
+        token_r = http_client.get(token_url, headers={"Metadata-Flavor": "Google"}, timeout=5)
         if token_r.status_code != 200:
             return None
         access_token = token_r.json()["access_token"]
@@ -113,7 +126,8 @@ def transcribe_voice(audio_bytes):
             "config": {"encoding": "OGG_OPUS", "sampleRateHertz": 48000, "languageCode": "it-IT", "alternativeLanguageCodes": ["en-US"], "model": "latest_long", "enableAutomaticPunctuation": True},
             "audio": {"content": audio_b64}
         }
-        r = http_requests.post(url, headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}, json=payload, timeout=30)
+        with span("http", "speech.recognize"):
+            r = http_client.post(url, headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}, json=payload, timeout=30)
         if r.status_code == 200:
             result = r.json()
             if "results" in result:
@@ -181,7 +195,7 @@ def execute_tool(tool_name, tool_input):
 def github_read_file(path):
     if not GITHUB_TOKEN: return "ERRORE: GitHub token mancante."
     url = f"{GITHUB_API}/repos/{GITHUB_REPO}/contents/{path}"
-    r = http_requests.get(url, headers=github_headers(), timeout=10)
+    r = http_client.get(url, headers=github_headers(), timeout=10)
     if r.status_code == 200:
         content = base64.b64decode(r.json()["content"]).decode("utf-8")
         return f"File: {path} ({len(content)} chars)\n\n{content}"
@@ -191,7 +205,7 @@ def github_read_file(path):
 def github_list_dir(path):
     if not GITHUB_TOKEN: return "ERRORE: GitHub token mancante."
     url = f"{GITHUB_API}/repos/{GITHUB_REPO}/contents/{path}"
-    r = http_requests.get(url, headers=github_headers(), timeout=10)
+    r = http_client.get(url, headers=github_headers(), timeout=10)
     if r.status_code == 200:
         items = r.json()
         if isinstance(items, list):
@@ -212,10 +226,10 @@ def github_write_file(path, content, commit_message):
     if not check_write_limit(): return f"BLOCCATO (L2): limite scritture raggiunto"
     if not GITHUB_TOKEN: return "ERRORE: GitHub token mancante."
     url = f"{GITHUB_API}/repos/{GITHUB_REPO}/contents/{path}"
-    r = http_requests.get(url, headers=github_headers(), timeout=10)
+    r = http_client.get(url, headers=github_headers(), timeout=10)
     payload = {"message": f"[brAIn God] {commit_message}", "content": base64.b64encode(content.encode("utf-8")).decode("utf-8"), "branch": "main"}
     if r.status_code == 200: payload["sha"] = r.json()["sha"]
-    r = http_requests.put(url, headers=github_headers(), json=payload, timeout=15)
+    r = http_client.put(url, headers=github_headers(), json=payload, timeout=15)
     if r.status_code in (200, 201):
         session_write_count += 1
         return f"OK: '{path}' scritto su GitHub. [{session_write_count}/{MAX_FILE_WRITES_PER_SESSION}]"
@@ -223,7 +237,7 @@ def github_write_file(path, content, commit_message):
 
 def supabase_query(params):
     table = params["table"]
-    allowed = ["problems","solutions","agent_logs","org_knowledge","scan_sources","capability_log","org_config","solution_scores","agent_events","reevaluation_log","authorization_matrix"]
+    allowed = ["problems","solutions","agent_logs","org_knowledge","scan_sources","capability_log","org_config","solution_scores","agent_events","reevaluation_log","authorization_matrix","agent_logs_hourly","agent_logs_daily"]
     if table not in allowed: return f"BLOCCATO: tabella '{table}' non accessibile."
     try:
         q = supabase.table(table).select(params["select"])
@@ -258,8 +272,8 @@ def get_system_status():
             for l in logs.data:
                 if l["agent_id"] not in agents: agents[l["agent_id"]] = {"ultima_azione": l["action"], "stato": l["status"], "quando": l["created_at"]}
             status["agenti"] = agents
-        yesterday = (datetime.now() - timedelta(days=1)).isoformat()
-        costs = supabase.table("agent_logs").select("cost_usd").gte("created_at", yesterday).execute()
+        since_hour = (datetime.now(timezone.utc) - timedelta(hours=24)).replace(minute=0, second=0, microsecond=0).isoformat()
+        costs = supabase.table("agent_logs_hourly").select("cost_usd").gte("bucket", since_hour).execute()
         status["costi_24h_usd"] = round(sum(float(c.get("cost_usd",0) or 0) for c in (costs.data or [])), 4)
         errors = supabase.table("agent_logs").select("agent_id,error,created_at").eq("status","error").order("created_at",desc=True).limit(3).execute()
         status["errori_recenti"] = errors.data or []
@@ -269,17 +283,20 @@ def get_system_status():
 
 def get_cost_report(days=7):
     try:
-        since = (datetime.now() - timedelta(days=days)).isoformat()
-        logs = supabase.table("agent_logs").select("agent_id,cost_usd,tokens_input,tokens_output,model_used").gte("created_at", since).limit(500).execute()
-        if not logs.data: return f"Nessun dato ultimi {days} giorni."
-        by_agent = {}
-        total = 0
-        for l in logs.data:
-            aid = l["agent_id"]; cost = float(l.get("cost_usd",0) or 0); total += cost
-            if aid not in by_agent: by_agent[aid] = {"usd": 0, "calls": 0}
-            by_agent[aid]["usd"] += cost; by_agent[aid]["calls"] += 1
+        since = (datetime.now(timezone.utc) - timedelta(days=days)).date().isoformat()
+        rows = supabase.table("agent_logs_daily").select("day,agent_id,calls,errors,tokens_input,tokens_output,cost_usd,duration_p95_ms").gte("day", since).order("day").execute()
+        if not rows.data: return f"Nessun dato ultimi {days} giorni."
+        by_agent = {}; by_day = {}; total = 0
+        for r in rows.data:
+            aid = r["agent_id"]; cost = float(r.get("cost_usd",0) or 0); total += cost
+            a = by_agent.setdefault(aid, {"usd": 0, "calls": 0, "errori": 0, "tokens_in": 0, "tokens_out": 0, "p95_ms_max": 0})
+            a["usd"] += cost; a["calls"] += r.get("calls",0) or 0; a["errori"] += r.get("errors",0) or 0
+            a["tokens_in"] += r.get("tokens_input",0) or 0; a["tokens_out"] += r.get("tokens_output",0) or 0
+            a["p95_ms_max"] = max(a["p95_ms_max"], r.get("duration_p95_ms") or 0)
+            by_day[r["day"]] = by_day.get(r["day"], 0) + cost
         for a in by_agent: by_agent[a]["usd"] = round(by_agent[a]["usd"], 4)
-        return json.dumps({"giorni": days, "totale_usd": round(total,4), "per_agente": by_agent}, indent=2, ensure_ascii=False)
+        for d in by_day: by_day[d] = round(by_day[d], 4)
+        return json.dumps({"giorni": days, "totale_usd": round(total,4), "per_agente": by_agent, "per_giorno": by_day}, indent=2, ensure_ascii=False)
     except Exception as e:
         return f"Errore: {e}"
 
@@ -298,14 +315,14 @@ def execute_pending_deploy():
     image = pending_deploy["image"]
     dockerfile_dir = pending_deploy["dockerfile_dir"]
     try:
-        token_r = http_requests.get("http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token", headers={"Metadata-Flavor": "Google"}, timeout=5)
+        token_r = http_client.get("http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token", headers={"Metadata-Flavor": "Google"}, timeout=5)
         if token_r.status_code != 200:
             pending_deploy = None
             return "Errore token GCP."
         access_token = token_r.json()["access_token"]
         build_url = f"https://cloudbuild.googleapis.com/v1/projects/{GCP_PROJECT}/locations/{GCP_REGION}/builds"
         build_payload = {"steps": [{"name": "gcr.io/cloud-builders/docker", "args": ["build", "-t", image, "."], "dir": dockerfile_dir}, {"name": "gcr.io/cloud-builders/docker", "args": ["push", image]}], "source": {"repoSource": {"projectId": GCP_PROJECT, "repoName": "github_mircocerisola_brain-core", "branchName": "main"}}, "images": [image]}
-        r = http_requests.post(build_url, headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}, json=build_payload, timeout=30)
+        r = http_client.post(build_url, headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}, json=build_payload, timeout=30)
         if r.status_code not in (200, 201):
             pending_deploy = None
             return f"Build API non disponibile. Mirco esegui:\ncd C:\\brAIn\\{dockerfile_dir}\ngcloud builds submit --tag {image} --region={GCP_REGION}\ngcloud run deploy {service} --image={image} --region {GCP_REGION} --platform managed"
@@ -317,13 +334,970 @@ def execute_pending_deploy():
         pending_deploy = None
         return f"Errore deploy: {e}"
 
+# LOG SINK — agent_logs bufferizzati, un solo flusher in background
+LOG_SINK_MAX_QUEUE = int(os.getenv("LOG_SINK_MAX_QUEUE", "2000"))
+LOG_SINK_BATCH_SIZE = int(os.getenv("LOG_SINK_BATCH_SIZE", "50"))
+LOG_SINK_FLUSH_MS = int(os.getenv("LOG_SINK_FLUSH_MS", "2000"))
+
+_SINK_STOP = object()
+
+
+class LogSink:
+    """Coda limitata di righe agent_logs, scritte in insert multi-riga da un solo thread.
+
+    Il flush parte ogni batch_size righe o dopo flush_ms dalla prima riga in coda.
+    Se la coda e' piena la riga viene scartata e contata: chi logga non si blocca mai.
+    """
+
+    def __init__(self, table, max_queue, batch_size, flush_ms, on_flush=None):
+        self.table = table
+        self.on_flush = on_flush
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.01, flush_ms / 1000)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._stats = {
+            "enqueued": 0, "written": 0, "dropped": 0, "failed": 0,
+            "batches": 0, "flush_ms_total": 0, "flush_ms_max": 0, "last_flush_ms": 0,
+        }
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="log-sink", daemon=True)
+                    self._thread.start()
+
+    def put(self, row):
+        if self._closed:
+            self._count("dropped")
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            dropped = self._count("dropped")
+            if dropped % 100 == 1:
+                logger.warning(f"[LOG SINK] coda piena, {dropped} righe scartate finora")
+            return False
+        self._count("enqueued")
+        return True
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+            return self._stats[key]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _SINK_STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _SINK_STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            if stop:
+                self._drain()
+                return
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _SINK_STOP:
+                batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        start = time.monotonic()
+        try:
+            supabase.table(self.table).insert(batch).execute()
+            ok = True
+        except Exception as e:
+            ok = False
+            logger.error(f"[LOG SINK] insert di {len(batch)} righe fallito: {e}")
+        elapsed = int((time.monotonic() - start) * 1000)
+        with self._lock:
+            self._stats["written" if ok else "failed"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["flush_ms_total"] += elapsed
+            self._stats["flush_ms_max"] = max(self._stats["flush_ms_max"], elapsed)
+            self._stats["last_flush_ms"] = elapsed
+        if ok and self.on_flush:
+            try:
+                self.on_flush()
+            except Exception as e:
+                logger.error(f"[LOG SINK] on_flush: {e}")
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        s["queued"] = self._queue.qsize()
+        s["flush_ms_avg"] = round(s["flush_ms_total"] / s["batches"], 1) if s["batches"] else 0
+        return s
+
+    def close(self, timeout=10):
+        """Svuota la coda e ferma il flusher. Idempotente, chiamato allo shutdown."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            try:
+                self._queue.put(_SINK_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            logger.info(f"[LOG SINK] chiuso: {self.stats()}")
+
+
+ROLLUP_REFRESH_S = int(os.getenv("ROLLUP_REFRESH_S", "60"))
+
+
+def refresh_rollups(since=None):
+    """Ricalcola agent_logs_hourly/daily dalle ore toccate da since (default: ultime 2 ore)."""
+    since = since or (datetime.now(timezone.utc) - timedelta(hours=2)).isoformat()
+    result = supabase.rpc("refresh_agent_logs_rollups", {"p_since": since}).execute()
+    return result.data
+
+
+class RollupRefresher:
+    """Refresh dei rollup su un thread proprio, mai su quello del log sink.
+
+    Il sink segnala ogni flush riuscito con mark(); al piu' ogni interval secondi, se ci sono
+    state scritture, parte un refresh. Un flush arrivato durante il refresh resta segnato e
+    va in quello successivo: anche le ultime righe di un burst finiscono nei rollup.
+    """
+
+    def __init__(self, interval):
+        self.interval = max(1, interval)
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def mark(self):
+        self._dirty.set()
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="rollup-refresh", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._refresh()
+
+    def _refresh(self):
+        if not self._dirty.is_set():
+            return
+        self._dirty.clear()
+        try:
+            refresh_rollups()
+        except Exception as e:
+            self._dirty.set()
+            logger.error(f"[ROLLUP] refresh: {e}")
+
+    def close(self):
+        """Allo shutdown, dopo lo svuotamento del sink: un ultimo refresh se restano scritture."""
+        self._stop.set()
+        self._refresh()
+
+
+rollup_refresher = RollupRefresher(ROLLUP_REFRESH_S)
+log_sink = LogSink("agent_logs", LOG_SINK_MAX_QUEUE, LOG_SINK_BATCH_SIZE, LOG_SINK_FLUSH_MS, rollup_refresher.mark)
+# atexit in ordine inverso: prima si svuota il sink, poi l'ultimo refresh dei rollup
+atexit.register(rollup_refresher.close)
+atexit.register(log_sink.close)
+
 def log_to_supabase(agent_id, action, input_summary, output_summary, model_used, tokens_in=0, tokens_out=0, cost=0, duration_ms=0, status="success", error=None):
-    def _log():
+    log_sink.put({"agent_id": agent_id, "action": action, "layer": 0, "input_summary": (input_summary or "")[:500], "output_summary": (output_summary or "")[:500], "model_used": model_used, "tokens_input": tokens_in, "tokens_output": tokens_out, "cost_usd": cost, "duration_ms": duration_ms, "status": status, "error": error, "created_at": datetime.now(timezone.utc).isoformat()})
+
+# COSTI — listino modelli, costo per chiamata, budget per run e per giorno
+# USD per milione di token. cache_write = scrittura cache 5 minuti, cache_read = lettura.
+MODEL_PRICING = {
+    "claude-haiku-4-5": {"input": 1.0, "output": 5.0, "cache_write": 1.25, "cache_read": 0.10},
+    "claude-sonnet-4-5": {"input": 3.0, "output": 15.0, "cache_write": 3.75, "cache_read": 0.30},
+    "claude-opus-4-6": {"input": 5.0, "output": 25.0, "cache_write": 6.25, "cache_read": 0.50},
+}
+if os.getenv("MODEL_PRICING_JSON"):
+    MODEL_PRICING.update(json.loads(os.getenv("MODEL_PRICING_JSON")))
+
+# Scala di degradazione quando il budget e' stretto: modello -> modello piu' economico
+MODEL_DOWNGRADE = {
+    "claude-opus-4-6": "claude-sonnet-4-5-20250514",
+    "claude-sonnet-4-5-20250514": "claude-haiku-4-5-20251001",
+}
+
+RUN_BUDGET_USD = float(os.getenv("RUN_BUDGET_USD", "0") or 0)
+DAILY_BUDGET_USD = float(os.getenv("DAILY_BUDGET_USD", "0") or 0)
+BUDGET_DEGRADE_RATIO = float(os.getenv("BUDGET_DEGRADE_RATIO", "0.8"))
+DAILY_SPEND_REFRESH_S = 300
+
+
+def model_pricing(model):
+    for prefix, price in MODEL_PRICING.items():
+        if model.startswith(prefix):
+            return price
+    for family in ("haiku", "sonnet", "opus"):
+        if family in model:
+            for prefix, price in MODEL_PRICING.items():
+                if family in prefix:
+                    return price
+    logger.warning(f"[COST] modello senza prezzo: {model}, uso tariffa sonnet")
+    return MODEL_PRICING["claude-sonnet-4-5"]
+
+
+def usage_cost(model, usage):
+    """Costo USD di una risposta a partire da response.usage, token di cache inclusi."""
+    price = model_pricing(model)
+    tokens_in = getattr(usage, "input_tokens", 0) or 0
+    tokens_out = getattr(usage, "output_tokens", 0) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    cost = (
+        tokens_in * price["input"] + tokens_out * price["output"]
+        + cache_write * price["cache_write"] + cache_read * price["cache_read"]
+    ) / 1_000_000
+    return {
+        "tokens_in": tokens_in, "tokens_out": tokens_out,
+        "cache_write": cache_write, "cache_read": cache_read,
+        "cost": round(cost, 6),
+    }
+
+
+class RunStats:
+    """Contabilita' di una singola esecuzione (endpoint o messaggio chat)."""
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.cost = 0.0
+        self.calls = 0
+        self.by_agent = {}
+        self.spans = []
+        self.dropped_spans = 0
+        self._t0 = time.monotonic()
+        self._elapsed = None
+        self._lock = threading.Lock()
+
+    def add(self, agent_id, usage):
+        with self._lock:
+            self.cost += usage["cost"]
+            self.calls += 1
+            a = self.by_agent.setdefault(agent_id, {"calls": 0, "cost_usd": 0.0, "tokens_in": 0, "tokens_out": 0})
+            a["calls"] += 1
+            a["cost_usd"] += usage["cost"]
+            a["tokens_in"] += usage["tokens_in"]
+            a["tokens_out"] += usage["tokens_out"]
+
+    def add_span(self, kind, name, t0, elapsed, error, attrs):
+        with self._lock:
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped_spans += 1
+                return
+            self.spans.append({
+                "kind": kind, "name": name,
+                "start_ms": round((t0 - self._t0) * 1000, 1),
+                "duration_ms": round(elapsed * 1000, 1),
+                "error": error, "attrs": {k: v for k, v in attrs.items() if v is not None},
+            })
+
+    def finish(self):
+        self._elapsed = time.monotonic() - self._t0
+
+    def trace(self):
+        """Summary + span ordinati + totale per tipo: dove e' andato il tempo della run."""
+        data = self.summary()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda x: x["start_ms"])
+            data["dropped_spans"] = self.dropped_spans
+        by_kind = {}
+        for sp in spans:
+            by_kind[sp["kind"]] = round(by_kind.get(sp["kind"], 0) + sp["duration_ms"], 1)
+        data["time_by_kind_ms"] = by_kind
+        data["spans"] = spans
+        return data
+
+    def summary(self):
+        with self._lock:
+            return {
+                "run_id": self.id, "name": self.name, "started_at": self.started_at,
+                "llm_calls": self.calls, "cost_usd": round(self.cost, 6),
+                "elapsed_ms": round((self._elapsed if self._elapsed is not None else time.monotonic() - self._t0) * 1000, 1),
+                "by_agent": {k: dict(v, cost_usd=round(v["cost_usd"], 6)) for k, v in self.by_agent.items()},
+            }
+
+
+_current_run = contextvars.ContextVar("brain_run", default=None)
+
+
+def current_run():
+    return _current_run.get()
+
+
+@contextmanager
+def run_context(name):
+    """Apre una run: i costi delle chiamate Claude fatte dentro il blocco si sommano qui.
+
+    Se una run e' gia' aperta (es. dal profiler o da /all) il blocco si aggrega a quella.
+    """
+    parent = current_run()
+    if parent is not None:
+        yield parent
+        return
+    run = RunStats(name)
+    token = _current_run.set(run)
+    try:
+        yield run
+    finally:
+        _current_run.reset(token)
+        run.finish()
+        remember_run(run)
+        logger.info(f"[RUN] {run.name} {run.id}: {run.calls} chiamate, ${run.cost:.4f}")
+
+
+class CostTracker:
+    """Aggrega i costi per agente e per giorno e applica i budget opzionali.
+
+    Con budget al BUDGET_DEGRADE_RATIO lo stato diventa "tight" e i chiamanti passano
+    al modello piu' economico e fanno meno query; a budget esaurito diventa "exhausted"
+    e le chiamate opzionali vanno saltate.
+    """
+
+    def __init__(self, run_budget, daily_budget):
+        self.run_budget = run_budget
+        self.daily_budget = daily_budget
+        self._lock = threading.Lock()
+        self.by_agent = {}
+        self._day = None
+        self._day_base = 0.0
+        self._day_local = 0.0
+        self._day_refreshed = 0.0
+
+    def record(self, agent_id, model, usage):
+        u = usage_cost(model, usage)
+        with self._lock:
+            self._roll_day()
+            self._day_local += u["cost"]
+            a = self.by_agent.setdefault(agent_id, {"calls": 0, "cost_usd": 0.0, "tokens_in": 0, "tokens_out": 0})
+            a["calls"] += 1
+            a["cost_usd"] += u["cost"]
+            a["tokens_in"] += u["tokens_in"]
+            a["tokens_out"] += u["tokens_out"]
+        run = current_run()
+        if run:
+            run.add(agent_id, u)
+        return u
+
+    def _roll_day(self):
+        today = datetime.now(timezone.utc).date()
+        if self._day != today:
+            self._day = today
+            self._day_base = 0.0
+            self._day_local = 0.0
+            self._day_refreshed = 0.0
+
+    def _load_day_spend(self):
+        """Spesa di oggi dal rollup giornaliero, che include anche le altre istanze."""
+        today = datetime.now(timezone.utc).date().isoformat()
+        rows = supabase.table("agent_logs_daily").select("cost_usd").eq("day", today).execute().data or []
+        return sum(float(r.get("cost_usd") or 0) for r in rows)
+
+    def spent_today(self):
+        with self._lock:
+            self._roll_day()
+            stale = time.monotonic() - self._day_refreshed > DAILY_SPEND_REFRESH_S
+            day = self._day
+        if stale:
+            try:
+                base = self._load_day_spend()
+                with self._lock:
+                    if self._day != day:
+                        return self._day_base + self._day_local
+                    # Il rollup e' in ritardo (refresh periodico, righe ancora nel sink): non si
+                    # sa quali costi locali contenga gia', quindi il totale non scende mai
+                    self._day_base = max(base, self._day_base + self._day_local)
+                    self._day_local = 0.0
+                    self._day_refreshed = time.monotonic()
+            except Exception as e:
+                logger.error(f"[COST] lettura spesa giornaliera: {e}")
+                with self._lock:
+                    self._day_refreshed = time.monotonic()
+        with self._lock:
+            return self._day_base + self._day_local
+
+    def budget_state(self):
+        ratio = 0.0
+        run = current_run()
+        if self.run_budget and run:
+            ratio = max(ratio, run.cost / self.run_budget)
+        if self.daily_budget:
+            ratio = max(ratio, self.spent_today() / self.daily_budget)
+        if ratio >= 1.0:
+            return "exhausted"
+        if ratio >= BUDGET_DEGRADE_RATIO:
+            return "tight"
+        return "ok"
+
+    def allow(self):
+        return self.budget_state() != "exhausted"
+
+    def pick_model(self, model):
+        if self.budget_state() == "ok":
+            return model
+        cheaper = MODEL_DOWNGRADE.get(model, model)
+        if cheaper != model:
+            logger.info(f"[COST] budget stretto: {model} -> {cheaper}")
+        return cheaper
+
+    def snapshot(self):
+        with self._lock:
+            return {k: dict(v, cost_usd=round(v["cost_usd"], 6)) for k, v in self.by_agent.items()}
+
+
+cost_tracker = CostTracker(RUN_BUDGET_USD, DAILY_BUDGET_USD)
+
+
+# TRACING — span per fase (search, llm, db, notify, sleep) e metriche Prometheus
+SPAN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TRACE_KEEP_RUNS = int(os.getenv("TRACE_KEEP_RUNS", "50"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "2000"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Metrics:
+    """Istogrammi di durata per (kind, name) e collector esterni, in formato Prometheus."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._hist = {}
+        self._errors = {}
+        self._collectors = []
+
+    def observe(self, kind, name, seconds, error=False):
+        key = (kind, name)
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None:
+                h = self._hist[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    h["counts"][i] += 1
+                    break
+            h["sum"] += seconds
+            h["count"] += 1
+            if error:
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+    def register(self, collector):
+        """collector() -> lista di (nome, tipo, help, [(labels, valore)])"""
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = [
+            "# HELP brain_span_duration_seconds Durata degli span per tipo e nome",
+            "# TYPE brain_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            hist = {k: {"counts": list(v["counts"]), "sum": v["sum"], "count": v["count"]} for k, v in self._hist.items()}
+            errors = dict(self._errors)
+        for (kind, name), h in sorted(hist.items()):
+            base = [("kind", kind), ("name", name)]
+            cumulative = 0
+            for le, c in zip(self.buckets, h["counts"]):
+                cumulative += c
+                lines.append(f"brain_span_duration_seconds_bucket{_prom_labels(base + [('le', le)])} {cumulative}")
+            lines.append(f"brain_span_duration_seconds_bucket{_prom_labels(base + [('le', '+Inf')])} {h['count']}")
+            lines.append(f"brain_span_duration_seconds_sum{_prom_labels(base)} {h['sum']:.6f}")
+            lines.append(f"brain_span_duration_seconds_count{_prom_labels(base)} {h['count']}")
+        lines.append("# HELP brain_span_errors_total Span terminati con eccezione")
+        lines.append("# TYPE brain_span_errors_total counter")
+        for (kind, name), n in sorted(errors.items()):
+            lines.append(f"brain_span_errors_total{_prom_labels([('kind', kind), ('name', name)])} {n}")
+        for collector in self._collectors:
+            try:
+                for name, mtype, help_text, samples in collector():
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {mtype}")
+                    for labels, value in samples:
+                        lines.append(f"{name}{_prom_labels(labels)} {value}")
+            except Exception as e:
+                logger.error(f"[METRICS] collector: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(SPAN_BUCKETS)
+recent_runs = collections.OrderedDict()
+_recent_runs_lock = threading.Lock()
+
+
+def remember_run(run):
+    with _recent_runs_lock:
+        recent_runs[run.id] = run
+        while len(recent_runs) > TRACE_KEEP_RUNS:
+            recent_runs.popitem(last=False)
+
+
+@contextmanager
+def span(kind, name, **attrs):
+    """Misura un blocco: alimenta l'istogramma e, dentro una run, la sua trace."""
+    t0 = time.monotonic()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        elapsed = time.monotonic() - t0
+        metrics.observe(kind, name, elapsed, error is not None)
+        run = current_run()
+        if run:
+            run.add_span(kind, name, t0, elapsed, error, attrs)
+
+
+def pause(seconds, reason="throttle"):
+    """time.sleep tracciato: le attese compaiono nella trace come span sleep."""
+    with span("sleep", reason):
+        time.sleep(seconds)
+
+
+class _TracedQuery:
+    """Proxy su un query builder supabase: ogni execute() diventa uno span db."""
+
+    _OPS = ("select", "insert", "update", "upsert", "delete")
+
+    def __init__(self, builder, target, op=None):
+        self._builder = builder
+        self._target = target
+        self._op = op
+
+    def __getattr__(self, attr):
+        value = getattr(self._builder, attr)
+        if attr == "execute":
+            def execute(*args, **kwargs):
+                with span("db", f"{self._target}.{self._op or 'query'}"):
+                    return value(*args, **kwargs)
+            return execute
+        op = attr if attr in self._OPS else self._op
+        if callable(value):
+            def call(*args, **kwargs):
+                result = value(*args, **kwargs)
+                if hasattr(result, "execute"):
+                    return _TracedQuery(result, self._target, op)
+                return result
+            return call
+        if hasattr(value, "execute") or attr == "not_":
+            return _TracedQuery(value, self._target, op)
+        return value
+
+
+class TracedSupabase:
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name):
+        return _TracedQuery(self._client.table(name), name)
+
+    def rpc(self, fn, params=None, **kwargs):
+        return _TracedQuery(self._client.rpc(fn, params or {}, **kwargs), f"rpc:{fn}", "call")
+
+    def __getattr__(self, attr):
+        return getattr(self._client, attr)
+
+
+supabase = TracedSupabase(supabase)
+
+
+def _collect_log_sink():
+    s = log_sink.stats()
+    return [
+        ("brain_log_sink_rows_total", "counter", "Righe agent_logs per esito",
+            [([("outcome", k)], s[k]) for k in ("enqueued", "written", "dropped", "failed")]),
+        ("brain_log_sink_queued", "gauge", "Righe in coda", [([], s["queued"])]),
+        ("brain_log_sink_flush_ms", "gauge", "Latenza flush (ultima, media, massima)",
+            [([("stat", "last")], s["last_flush_ms"]), ([("stat", "avg")], s["flush_ms_avg"]), ([("stat", "max")], s["flush_ms_max"])]),
+    ]
+
+
+def _collect_costs():
+    snap = cost_tracker.snapshot()
+    return [
+        ("brain_llm_cost_usd_total", "counter", "Costo LLM per agente",
+            [([("agent", a)], round(v["cost_usd"], 6)) for a, v in snap.items()]),
+        ("brain_llm_calls_total", "counter", "Chiamate LLM per agente",
+            [([("agent", a)], v["calls"]) for a, v in snap.items()]),
+        ("brain_llm_tokens_total", "counter", "Token LLM per agente e direzione",
+            [([("agent", a), ("direction", d)], v[f"tokens_{d}"]) for a, v in snap.items() for d in ("in", "out")]),
+    ]
+
+
+metrics.register(_collect_log_sink)
+metrics.register(_collect_costs)
+
+
+def metrics_authorized(request):
+    if not METRICS_TOKEN:
+        return True
+    return request.headers.get("Authorization", "") == f"Bearer {METRICS_TOKEN}"
+
+
+async def metrics_endpoint(request):
+    if not metrics_authorized(request):
+        return web.Response(text="unauthorized", status=401)
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def traces_endpoint(request):
+    if not metrics_authorized(request):
+        return web.Response(text="unauthorized", status=401)
+    with _recent_runs_lock:
+        runs = list(recent_runs.values())
+    return web.json_response([r.summary() for r in reversed(runs)])
+
+
+async def trace_endpoint(request):
+    if not metrics_authorized(request):
+        return web.Response(text="unauthorized", status=401)
+    with _recent_runs_lock:
+        run = recent_runs.get(request.match_info["run_id"])
+    if not run:
+        return web.json_response({"error": "run non trovata"}, status=404)
+    return web.json_response(run.trace(), headers={
+        "Content-Disposition": f'attachment; filename="trace-{run.id}.json"'})
+
+
+# HTTP — client keep-alive condivisi (requests + aiohttp) con statistiche di riuso
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_KEEPALIVE_S = float(os.getenv("HTTP_KEEPALIVE_S", "60"))
+
+
+class HttpClients:
+    """Una requests.Session e una aiohttp.ClientSession per processo, riusate da tutte le chiamate.
+
+    Il timeout passato dal chiamante vale come timeout di lettura; la connessione ha
+    sempre HTTP_CONNECT_TIMEOUT.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._async_session = None
+        self._async_stats = collections.Counter()
+        self._requests = collections.Counter()
+
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    s = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+                    s.mount("https://", adapter)
+                    s.mount("http://", adapter)
+                    self._session = s
+        return self._session
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self._requests[urlsplit(url).netloc] += 1
+        return self.session().request(method, url, timeout=(HTTP_CONNECT_TIMEOUT, timeout or HTTP_READ_TIMEOUT), **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    async def async_session(self):
+        """ClientSession legata al loop corrente, creata alla prima richiesta."""
+        if self._async_session is None or self._async_session.closed:
+            trace = aiohttp.TraceConfig()
+
+            async def on_create(session, ctx, params):
+                self._async_stats["opened"] += 1
+
+            async def on_reuse(session, ctx, params):
+                self._async_stats["reused"] += 1
+
+            trace.on_connection_create_end.append(on_create)
+            trace.on_connection_reuseconn.append(on_reuse)
+            connector = aiohttp.TCPConnector(limit=HTTP_POOL_MAXSIZE * HTTP_POOL_CONNECTIONS, limit_per_host=HTTP_POOL_MAXSIZE,
+                keepalive_timeout=HTTP_KEEPALIVE_S, ttl_dns_cache=300)
+            self._async_session = aiohttp.ClientSession(connector=connector, trace_configs=[trace],
+                timeout=aiohttp.ClientTimeout(total=HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+        return self._async_session
+
+    async def close(self):
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+        if self._session is not None:
+            self._session.close()
+
+    def warm(self, urls):
+        """Apre in background una connessione verso ogni host, cosi' la prima chiamata vera non paga TLS."""
+        def _warm():
+            for url in urls:
+                try:
+                    self.request("HEAD", url, timeout=5)
+                except Exception as e:
+                    logger.info(f"[HTTP] warm {url}: {e}")
+        threading.Thread(target=_warm, name="http-warm", daemon=True).start()
+
+    def stats(self):
+        hosts = {}
+        adapter = self._session.get_adapter("https://") if self._session else None
+        if adapter is not None:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened = getattr(pool, "num_connections", 0)
+                served = getattr(pool, "num_requests", 0)
+                hosts[pool.host] = {
+                    "requests": served, "connections_opened": opened,
+                    "reuse_ratio": round(1 - opened / served, 3) if served else 0,
+                }
+        return {"sync": hosts, "async": dict(self._async_stats), "requests_by_host": dict(self._requests)}
+
+
+http_client = HttpClients()
+
+
+def _collect_http():
+    st = http_client.stats()
+    return [
+        ("brain_http_requests_total", "counter", "Richieste HTTP uscenti per host",
+            [([("host", h)], v["requests"]) for h, v in st["sync"].items()]),
+        ("brain_http_connections_opened_total", "counter", "Connessioni TCP+TLS aperte per host",
+            [([("host", h)], v["connections_opened"]) for h, v in st["sync"].items()]),
+        ("brain_http_async_connections_total", "counter", "Connessioni aiohttp aperte o riusate",
+            [([("outcome", k)], v) for k, v in st["async"].items()]),
+    ]
+
+
+metrics.register(_collect_http)
+
+
+# LLM — client Claude resiliente (stessa logica di call_claude in deploy-agents/agents_runner.py)
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE_S = float(os.getenv("LLM_BACKOFF_BASE_S", "1.5"))
+LLM_BACKOFF_MAX_S = float(os.getenv("LLM_BACKOFF_MAX_S", "30"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "60"))
+LLM_FALLBACK_ENABLED = os.getenv("LLM_FALLBACK_ENABLED", "1") == "1"
+LLM_FALLBACK_MODELS = {
+    "claude-opus-4-6": "claude-sonnet-4-5-20250514",
+    "claude-sonnet-4-5-20250514": "claude-haiku-4-5-20251001",
+}
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class CircuitBreaker:
+    """closed -> open dopo N chiamate consecutive fallite per indisponibilita' -> half_open dopo il cooldown.
+
+    In half_open passa una sola chiamata di prova: il suo esito richiude o riapre il breaker.
+    Una prova che non riporta l'esito entro il cooldown lascia il posto a un'altra.
+    """
+
+    def __init__(self, model, failures, cooldown):
+        self.model = model
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = None
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.probe_at is not None and now - self.probe_at < self.cooldown:
+                    return False
+                self.probe_at = now
+            return self.state != "open"
+
+    def record_success(self):
+        """Il servizio ha risposto (anche con un errore non di disponibilita')."""
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.probe_at = None
+
+    def record_failure(self):
+        """Una chiamata ha esaurito i retry per errori di disponibilita' (5xx, connessione)."""
+        with self._lock:
+            self.failures += 1
+            self.probe_at = None
+            if self.state == "half_open" or self.failures >= self.max_failures:
+                if self.state != "open":
+                    self.trips += 1
+                    logger.warning(f"[LLM] circuit breaker aperto per {self.model}")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+_llm_semaphore = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+_breakers = {}
+_breakers_lock = threading.Lock()
+llm_stats = collections.Counter()
+
+
+def breaker_for(model):
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(model, LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN_S)
+        return _breakers[model]
+
+
+def llm_retryable(e):
+    if isinstance(e, (anthropic.RateLimitError, anthropic.APIConnectionError, anthropic.InternalServerError)):
+        return True
+    status = getattr(e, "status_code", None)
+    return status in RETRYABLE_STATUS
+
+
+def llm_outage(e):
+    """Errore di disponibilita' che conta per il breaker. 429 e retry-after sono contropressione:
+    il servizio risponde, si rallenta ma non si apre il circuito."""
+    if isinstance(e, anthropic.RateLimitError) or getattr(e, "status_code", None) == 429:
+        return False
+    return llm_retryable(e) and llm_retry_after(e) is None
+
+
+def llm_retry_after(e):
+    """Secondi suggeriti dal server (retry-after / retry-after-ms), se presenti."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def llm_backoff(attempt):
+    delay = min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * (2 ** attempt))
+    return delay * (0.5 + random.random() / 2)
+
+
+class LLMUnavailable(Exception):
+    pass
+
+
+def _create_with_retry(model, kwargs):
+    """Una chiamata con retry sullo stesso modello, dentro semaforo e circuit breaker."""
+    breaker = breaker_for(model)
+    retries = 0
+    if not breaker.allow():
+        llm_stats["breaker_rejected"] += 1
+        raise LLMUnavailable(f"circuit breaker aperto per {model}")
+    while True:
         try:
-            supabase.table("agent_logs").insert({"agent_id": agent_id, "action": action, "layer": 0, "input_summary": (input_summary or "")[:500], "output_summary": (output_summary or "")[:500], "model_used": model_used, "tokens_input": tokens_in, "tokens_output": tokens_out, "cost_usd": cost, "duration_ms": duration_ms, "status": status, "error": error}).execute()
+            with _llm_semaphore:
+                response = claude.messages.create(model=model, **kwargs)
         except Exception as e:
-            logger.error(f"[LOG] {e}")
-    threading.Thread(target=_log, daemon=True).start()
+            if llm_retryable(e) and retries < LLM_MAX_RETRIES:
+                delay = llm_retry_after(e) or llm_backoff(retries)
+                retries += 1
+                llm_stats["retries"] += 1
+                logger.warning(f"[LLM] {model}: {type(e).__name__}, retry {retries} tra {delay:.1f}s")
+                pause(min(delay, LLM_BACKOFF_MAX_S), "llm_backoff")
+                continue
+            # Un solo esito per chiamata: conta come guasto solo se l'ultimo errore e' di disponibilita'
+            if llm_outage(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            llm_stats["failures"] += 1
+            raise
+        breaker.record_success()
+        llm_stats["calls"] += 1
+        return response
+
+
+def create_message(model, fallback=None, **kwargs):
+    """messages.create con retry/backoff (retry-after incluso), semaforo, circuit breaker e fallback.
+
+    Ritorna (risposta, modello usato); se falliscono primario e fallback rilancia l'errore,
+    che i chiamanti gestiscono come prima.
+    """
+    if fallback is None and LLM_FALLBACK_ENABLED:
+        fallback = LLM_FALLBACK_MODELS.get(model)
+    try:
+        return _create_with_retry(model, kwargs), model
+    except Exception as e:
+        if not fallback:
+            raise
+        logger.error(f"[LLM] {model}: {e}, passo a {fallback}")
+    llm_stats["fallbacks"] += 1
+    return _create_with_retry(fallback, kwargs), fallback
+
+
+def _collect_llm():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return [
+        ("brain_llm_events_total", "counter", "Retry, fallimenti, fallback e rifiuti del breaker",
+            [([("event", k)], v) for k, v in llm_stats.items()]),
+        ("brain_llm_breaker_open", "gauge", "1 se il circuit breaker del modello e' aperto",
+            [([("model", b.model)], 1 if b.state == "open" else 0) for b in breakers]),
+        ("brain_llm_breaker_trips_total", "counter", "Aperture del circuit breaker per modello",
+            [([("model", b.model)], b.trips) for b in breakers]),
+    ]
+
+
+metrics.register(_collect_llm)
+
 
 def get_db_context():
     ctx = ""
@@ -347,7 +1321,7 @@ def get_db_context():
 def ask_claude(user_message, is_photo=False, image_b64=None):
     global chat_history
     start = time.time()
-    model = "claude-opus-4-6"
+    model = cost_tracker.pick_model("claude-opus-4-6")
     try:
         system = build_system_prompt()
         messages = []
@@ -360,10 +1334,15 @@ def ask_claude(user_message, is_photo=False, image_b64=None):
             messages.append({"role": "user", "content": user_message})
         if user_message.strip().upper() == "STOP":
             return "STOP ricevuto. Tutto fermo."
-        total_in = 0; total_out = 0; final = ""
+        total_in = 0; total_out = 0; cost = 0.0; final = ""
         for _ in range(8):
-            resp = claude.messages.create(model=model, max_tokens=4000, system=system, messages=messages, tools=TOOLS)
-            total_in += resp.usage.input_tokens; total_out += resp.usage.output_tokens
+            if not cost_tracker.allow():
+                final += "\n[Budget esaurito: interrompo il ciclo tool]"
+                break
+            with span("llm", "chat", model=model):
+                resp, model = create_message(model, max_tokens=4000, system=system, messages=messages, tools=TOOLS)
+            usage = cost_tracker.record("brain_god", model, resp.usage)
+            total_in += usage["tokens_in"]; total_out += usage["tokens_out"]; cost += usage["cost"]
             if resp.stop_reason == "end_turn":
                 for b in resp.content:
                     if hasattr(b, "text"): final += b.text
@@ -373,7 +1352,7 @@ def ask_claude(user_message, is_photo=False, image_b64=None):
                 for b in resp.content:
                     if b.type == "tool_use":
                         logger.info(f"[TOOL] {b.name}")
-                        r = execute_tool(b.name, b.input)
+                        with span("tool", b.name): r = execute_tool(b.name, b.input)
                         results.append({"type": "tool_result", "tool_use_id": b.id, "content": str(r)[:4000]})
                 messages.append({"role": "assistant", "content": resp.content})
                 messages.append({"role": "user", "content": results})
@@ -382,7 +1361,6 @@ def ask_claude(user_message, is_photo=False, image_b64=None):
                     if hasattr(b, "text"): final += b.text
                 break
         dur = int((time.time()-start)*1000)
-        cost = (total_in*15.0+total_out*75.0)/1_000_000
         chat_history.append({"user": f"[FOTO] {user_message}" if is_photo else user_message, "assistant": final[:500]})
         if len(chat_history) > MAX_HISTORY: chat_history = chat_history[-MAX_HISTORY:]
         log_to_supabase("brain_god","chat",user_message[:300],final[:300],model,total_in,total_out,cost,dur)
@@ -414,9 +1392,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pending_deploy = None
         await update.message.reply_text("Deploy annullato."); return
     await update.message.chat.send_action("typing")
-    reply = clean_reply(ask_claude(msg))
-    for i in range(0, len(reply), 4000):
-        await update.message.reply_text(reply[i:i+4000])
+    with run_context("chat"):
+        reply = clean_reply(await asyncio.to_thread(ask_claude, msg))
+        await send_reply(update, reply)
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_authorized(update): return
@@ -426,9 +1404,9 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     img = await f.download_as_bytearray()
     b64 = base64.b64encode(bytes(img)).decode("utf-8")
     caption = update.message.caption or "Analizza questa immagine."
-    reply = clean_reply(ask_claude(caption, True, b64))
-    for i in range(0, len(reply), 4000):
-        await update.message.reply_text(reply[i:i+4000])
+    with run_context("photo"):
+        reply = clean_reply(await asyncio.to_thread(ask_claude, caption, True, b64))
+        await send_reply(update, reply)
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_authorized(update): return
@@ -441,12 +1419,17 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Non ho capito il vocale. Ripeti o scrivi?"); return
         await update.message.reply_text(f'Ho capito: "{text}"')
         await update.message.chat.send_action("typing")
-        reply = clean_reply(ask_claude(text))
-        for i in range(0, len(reply), 4000):
-            await update.message.reply_text(reply[i:i+4000])
+        with run_context("voice"):
+            reply = clean_reply(await asyncio.to_thread(ask_claude, text))
+            await send_reply(update, reply)
     except Exception as e:
         await update.message.reply_text(f"Errore vocale: {e}")
 
+async def send_reply(update, text):
+    with span("notify", "telegram_reply"):
+        for i in range(0, len(text), 4000):
+            await update.message.reply_text(text[i:i+4000])
+
 def clean_reply(text):
     text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
     text = re.sub(r'\*(.+?)\*', r'\1', text)
@@ -495,15 +1478,23 @@ async def main():
     app = web.Application()
     app.router.add_get("/", health_check)
     app.router.add_post("/", telegram_webhook)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_get("/traces", traces_endpoint)
+    app.router.add_get("/traces/{run_id}", trace_endpoint)
     runner = web.AppRunner(app)
     await runner.setup()
     await web.TCPSite(runner, "0.0.0.0", PORT).start()
     logger.info(f"Running on :{PORT}")
+    http_client.warm([GITHUB_API])
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try: loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError: pass
     try:
-        while True: await asyncio.sleep(3600)
-    except: pass
+        await stop.wait()
     finally:
-        await tg_app.stop(); await tg_app.shutdown(); await runner.cleanup()
+        await tg_app.stop(); await tg_app.shutdown(); await runner.cleanup(); await http_client.close(); log_sink.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,128 @@
+-- Rollup orari e giornalieri di agent_logs per agente, azione e modello.
+-- I report leggono qui invece di scaricare righe grezze: costo O(giorni), somme esatte.
+
+create index if not exists idx_agent_logs_created_at on agent_logs (created_at);
+
+create table if not exists agent_logs_hourly (
+    bucket          timestamptz not null,
+    agent_id        text        not null,
+    action          text        not null,
+    model_used      text        not null default '',
+    calls           integer     not null default 0,
+    errors          integer     not null default 0,
+    tokens_input    bigint      not null default 0,
+    tokens_output   bigint      not null default 0,
+    cost_usd        numeric(14, 6) not null default 0,
+    duration_ms_sum bigint      not null default 0,
+    duration_p50_ms integer,
+    duration_p95_ms integer,
+    duration_p99_ms integer,
+    duration_max_ms integer,
+    updated_at      timestamptz not null default now(),
+    primary key (bucket, agent_id, action, model_used)
+);
+
+create table if not exists agent_logs_daily (
+    day             date        not null,
+    agent_id        text        not null,
+    action          text        not null,
+    model_used      text        not null default '',
+    calls           integer     not null default 0,
+    errors          integer     not null default 0,
+    tokens_input    bigint      not null default 0,
+    tokens_output   bigint      not null default 0,
+    cost_usd        numeric(14, 6) not null default 0,
+    duration_ms_sum bigint      not null default 0,
+    duration_p50_ms integer,
+    duration_p95_ms integer,
+    duration_p99_ms integer,
+    duration_max_ms integer,
+    updated_at      timestamptz not null default now(),
+    primary key (day, agent_id, action, model_used)
+);
+
+create index if not exists idx_agent_logs_daily_day on agent_logs_daily (day);
+
+-- Ricalcola dai log grezzi le ore (e i giorni) toccate da p_since in poi.
+-- Idempotente: chiamarla due volte produce gli stessi numeri.
+create or replace function refresh_agent_logs_rollups(p_since timestamptz default now() - interval '2 hours')
+returns integer
+language plpgsql
+as $$
+declare
+    v_hour timestamptz := date_trunc('hour', p_since at time zone 'utc') at time zone 'utc';
+    v_day  timestamptz := date_trunc('day', p_since at time zone 'utc') at time zone 'utc';
+    v_rows integer;
+begin
+    insert into agent_logs_hourly as h (
+        bucket, agent_id, action, model_used, calls, errors, tokens_input, tokens_output,
+        cost_usd, duration_ms_sum, duration_p50_ms, duration_p95_ms, duration_p99_ms, duration_max_ms, updated_at
+    )
+    select
+        date_trunc('hour', created_at at time zone 'utc') at time zone 'utc',
+        coalesce(agent_id, ''), coalesce(action, ''), coalesce(model_used, ''),
+        count(*),
+        count(*) filter (where status = 'error'),
+        coalesce(sum(tokens_input), 0),
+        coalesce(sum(tokens_output), 0),
+        coalesce(sum(cost_usd), 0),
+        coalesce(sum(duration_ms), 0),
+        percentile_disc(0.50) within group (order by duration_ms),
+        percentile_disc(0.95) within group (order by duration_ms),
+        percentile_disc(0.99) within group (order by duration_ms),
+        max(duration_ms),
+        now()
+    from agent_logs
+    where created_at >= v_hour
+    group by 1, 2, 3, 4
+    on conflict (bucket, agent_id, action, model_used) do update set
+        calls = excluded.calls,
+        errors = excluded.errors,
+        tokens_input = excluded.tokens_input,
+        tokens_output = excluded.tokens_output,
+        cost_usd = excluded.cost_usd,
+        duration_ms_sum = excluded.duration_ms_sum,
+        duration_p50_ms = excluded.duration_p50_ms,
+        duration_p95_ms = excluded.duration_p95_ms,
+        duration_p99_ms = excluded.duration_p99_ms,
+        duration_max_ms = excluded.duration_max_ms,
+        updated_at = now();
+    get diagnostics v_rows = row_count;
+
+    insert into agent_logs_daily as d (
+        day, agent_id, action, model_used, calls, errors, tokens_input, tokens_output,
+        cost_usd, duration_ms_sum, duration_p50_ms, duration_p95_ms, duration_p99_ms, duration_max_ms, updated_at
+    )
+    select
+        (created_at at time zone 'utc')::date,
+        coalesce(agent_id, ''), coalesce(action, ''), coalesce(model_used, ''),
+        count(*),
+        count(*) filter (where status = 'error'),
+        coalesce(sum(tokens_input), 0),
+        coalesce(sum(tokens_output), 0),
+        coalesce(sum(cost_usd), 0),
+        coalesce(sum(duration_ms), 0),
+        percentile_disc(0.50) within group (order by duration_ms),
+        percentile_disc(0.95) within group (order by duration_ms),
+        percentile_disc(0.99) within group (order by duration_ms),
+        max(duration_ms),
+        now()
+    from agent_logs
+    where created_at >= v_day
+    group by 1, 2, 3, 4
+    on conflict (day, agent_id, action, model_used) do update set
+        calls = excluded.calls,
+        errors = excluded.errors,
+        tokens_input = excluded.tokens_input,
+        tokens_output = excluded.tokens_output,
+        cost_usd = excluded.cost_usd,
+        duration_ms_sum = excluded.duration_ms_sum,
+        duration_p50_ms = excluded.duration_p50_ms,
+        duration_p95_ms = excluded.duration_p95_ms,
+        duration_p99_ms = excluded.duration_p99_ms,
+        duration_max_ms = excluded.duration_max_ms,
+        updated_at = now();
+
+    return v_rows;
+end;
+$$;
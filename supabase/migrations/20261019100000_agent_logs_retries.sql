@@ -0,0 +1,6 @@
+-- Esito del client LLM resiliente su ogni riga di agent_logs:
+-- quanti retry sono serviti e lo stato del circuit breaker del modello a fine chiamata.
+
+alter table agent_logs
+    add column if not exists retries       integer not null default 0,
+    add column if not exists circuit_state text;
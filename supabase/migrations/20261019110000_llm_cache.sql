@@ -0,0 +1,13 @@
+-- Cache delle risposte Claude per prompt identici (chiave = sha256 di model/system/messages/max_tokens).
+-- Scritta e letta dall'agents runner; le righe scadute vengono cancellate dal runner stesso.
+
+create table if not exists llm_cache (
+    key         text primary key,
+    agent_id    text        not null,
+    model       text,
+    response    jsonb       not null,
+    created_at  timestamptz not null default now(),
+    expires_at  timestamptz not null
+);
+
+create index if not exists idx_llm_cache_expires_at on llm_cache (expires_at);
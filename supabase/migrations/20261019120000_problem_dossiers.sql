@@ -0,0 +1,51 @@
+-- Dossier competitivi della fase 1 del Solution Architect, riusabili fra problemi simili.
+-- embedding = feature hashing locale (256 dimensioni, L2) calcolato dall'agents runner.
+
+create extension if not exists vector;
+
+create table if not exists problem_dossiers (
+    id            bigserial primary key,
+    problem_id    bigint,
+    sector        text,
+    keywords      text[]      not null default '{}',
+    embedding     vector(256) not null,
+    dossier       jsonb       not null,
+    based_on      bigint references problem_dossiers (id) on delete set null,
+    reuse_count   integer     not null default 0,
+    created_at    timestamptz not null default now(),
+    last_used_at  timestamptz
+);
+
+create index if not exists idx_problem_dossiers_sector_created on problem_dossiers (sector, created_at desc);
+create index if not exists idx_problem_dossiers_embedding on problem_dossiers using hnsw (embedding vector_cosine_ops);
+
+-- Dossier piu' simili (coseno) nello stesso settore, creati entro max_age_hours.
+create or replace function match_dossiers(
+    query_embedding vector(256),
+    match_sector    text    default null,
+    min_similarity  float   default 0.6,
+    max_age_hours   integer default 336,
+    match_count     integer default 1
+)
+returns table (
+    id          bigint,
+    problem_id  bigint,
+    sector      text,
+    keywords    text[],
+    dossier     jsonb,
+    reuse_count integer,
+    created_at  timestamptz,
+    similarity  float
+)
+language sql
+stable
+as $$
+    select d.id, d.problem_id, d.sector, d.keywords, d.dossier, d.reuse_count, d.created_at,
+           1 - (d.embedding <=> query_embedding) as similarity
+    from problem_dossiers d
+    where (match_sector is null or d.sector = match_sector)
+      and d.created_at >= now() - make_interval(hours => max_age_hours)
+      and 1 - (d.embedding <=> query_embedding) >= min_similarity
+    order by d.embedding <=> query_embedding
+    limit match_count;
+$$;
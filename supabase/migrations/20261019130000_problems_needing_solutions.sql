@@ -0,0 +1,13 @@
+-- Problemi approvati ancora senza soluzioni: anti-join lato server per il Solution Architect,
+-- che ne legge una pagina alla volta invece di scaricare problems e solutions interi.
+
+create index if not exists idx_solutions_problem_id on solutions (problem_id);
+create index if not exists idx_problems_approved_score on problems (weighted_score desc, id) where status = 'approved';
+
+create or replace view problems_needing_solutions
+with (security_invoker = true)
+as
+select p.*
+from problems p
+where p.status = 'approved'
+  and not exists (select 1 from solutions s where s.problem_id = p.id);
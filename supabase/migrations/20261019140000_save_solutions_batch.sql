@@ -0,0 +1,34 @@
+-- Salvataggio atomico delle soluzioni di un problema con i loro score: una chiamata, una transazione.
+-- p_items = [{"solution": {...colonne di solutions...}, "score": {...colonne di solution_scores...}}]
+-- Ritorna l'id di ogni soluzione con la sua posizione (1-based) in p_items.
+
+create or replace function save_solutions_batch(p_problem_id bigint, p_items jsonb)
+returns table (ordinal integer, solution_id bigint)
+language plpgsql
+as $$
+declare
+    v_item jsonb;
+    v_ord  integer;
+    v_id   bigint;
+begin
+    for v_item, v_ord in
+        select e.value, e.ordinality::integer from jsonb_array_elements(p_items) with ordinality as e
+    loop
+        insert into solutions (problem_id, title, description, approach, sector, sub_sector, status, created_by)
+        select p_problem_id, s.title, s.description, s.approach, s.sector, s.sub_sector,
+               coalesce(s.status, 'proposed'), s.created_by
+        from jsonb_populate_record(null::solutions, v_item -> 'solution') s
+        returning id into v_id;
+
+        insert into solution_scores (solution_id, feasibility_score, impact_score, cost_estimate, complexity,
+                                     time_to_market, nocode_compatible, overall_score, notes, scored_by)
+        select v_id, sc.feasibility_score, sc.impact_score, sc.cost_estimate, sc.complexity,
+               sc.time_to_market, coalesce(sc.nocode_compatible, true), sc.overall_score, sc.notes, sc.scored_by
+        from jsonb_populate_record(null::solution_scores, v_item -> 'score') sc;
+
+        ordinal := v_ord;
+        solution_id := v_id;
+        return next;
+    end loop;
+end;
+$$;
@@ -0,0 +1,14 @@
+-- Output di ogni fase del Solution Architect per problema (dossier, soluzioni, valutazioni),
+-- cosi' una run fallita riparte dall'ultima fase completata.
+-- version = hash del prompt e dello schema della fase, concatenato a quello della fase precedente:
+-- cambiare un prompt invalida quella fase e le successive, non le precedenti.
+
+create table if not exists architect_artifacts (
+    problem_id  bigint      not null,
+    phase       text        not null check (phase in ('research', 'generation', 'feasibility')),
+    version     text        not null,
+    payload     jsonb       not null,
+    created_at  timestamptz not null default now(),
+    updated_at  timestamptz not null default now(),
+    primary key (problem_id, phase, version)
+);
@@ -0,0 +1,88 @@
+-- Lezioni del Knowledge Keeper senza duplicati: ogni lezione ha un embedding (feature hashing
+-- locale a 256 dimensioni, come problem_dossiers) e una lezione quasi identica a una esistente
+-- ne incrementa occurrences invece di creare una nuova riga.
+-- Le righe precedenti restano con embedding null finche' l'agents runner non le ricalcola.
+
+create extension if not exists vector;
+
+alter table org_knowledge add column if not exists embedding    vector(256);
+alter table org_knowledge add column if not exists occurrences  integer     not null default 1;
+alter table org_knowledge add column if not exists last_seen_at timestamptz not null default now();
+
+create index if not exists idx_org_knowledge_embedding on org_knowledge using hnsw (embedding vector_cosine_ops);
+create index if not exists idx_org_knowledge_frequency on org_knowledge (occurrences desc, last_seen_at desc);
+
+-- Salva una lezione o la fonde con la piu' simile della stessa categoria (similarita' >= p_min_similarity).
+-- Serializzata con un advisory lock: due run concorrenti non creano la stessa lezione due volte.
+create or replace function save_lesson(
+    p_title          text,
+    p_content        text,
+    p_category       text,
+    p_source         text,
+    p_embedding      vector(256),
+    p_min_similarity float default 0.9
+)
+returns table (id bigint, merged boolean, occurrences integer)
+language plpgsql
+as $$
+#variable_conflict use_column
+declare
+    v_id bigint;
+begin
+    perform pg_advisory_xact_lock(hashtext('org_knowledge_save_lesson'));
+
+    select k.id into v_id
+    from org_knowledge k
+    where k.category = p_category
+      and k.embedding is not null
+      and 1 - (k.embedding <=> p_embedding) >= p_min_similarity
+    order by k.embedding <=> p_embedding
+    limit 1;
+
+    if v_id is not null then
+        return query
+        update org_knowledge k
+        set occurrences = k.occurrences + 1, last_seen_at = now()
+        where k.id = v_id
+        returning k.id, true, k.occurrences;
+    else
+        return query
+        insert into org_knowledge as k (title, content, category, source, embedding)
+        values (p_title, p_content, p_category, p_source, p_embedding)
+        returning k.id, false, k.occurrences;
+    end if;
+end;
+$$;
+
+-- Lezioni per il contesto del Command Center: i candidati piu' vicini dall'indice HNSW,
+-- riordinati per similarita' + peso della frequenza. Senza domanda il chiamante legge
+-- direttamente le piu' frequenti (idx_org_knowledge_frequency).
+create or replace function relevant_lessons(
+    query_embedding vector(256),
+    match_count     integer     default 3,
+    frequency_weight float      default 0.05
+)
+returns table (
+    id           bigint,
+    title        text,
+    content      text,
+    category     text,
+    occurrences  integer,
+    last_seen_at timestamptz,
+    similarity   float
+)
+language sql
+stable
+as $$
+    select c.id, c.title, c.content, c.category, c.occurrences, c.last_seen_at, c.similarity
+    from (
+        select k.id, k.title, k.content, k.category, k.occurrences, k.last_seen_at,
+               1 - (k.embedding <=> query_embedding) as similarity
+        from org_knowledge k
+        where k.embedding is not null
+        order by k.embedding <=> query_embedding
+        limit match_count * 10
+    ) c
+    order by c.similarity + frequency_weight * ln(c.occurrences) desc
+    limit match_count;
+$$;
@@ -0,0 +1,51 @@
+-- Backfill delle lezioni precedenti alla dedupe con la stessa regola di save_lesson: una riga senza
+-- embedding quasi identica a una lezione gia' indicizzata della stessa categoria viene fusa
+-- (occorrenze sommate, last_seen_at piu' recente) e cancellata; altrimenti riceve l'embedding.
+
+create or replace function backfill_lesson(
+    p_id             bigint,
+    p_embedding      vector(256),
+    p_min_similarity float default 0.9
+)
+returns table (id bigint, merged boolean, occurrences integer)
+language plpgsql
+as $$
+#variable_conflict use_column
+declare
+    v_row    org_knowledge%rowtype;
+    v_target bigint;
+begin
+    -- Stesso lock di save_lesson: un salvataggio concorrente non duplica la lezione che si sta fondendo
+    perform pg_advisory_xact_lock(hashtext('org_knowledge_save_lesson'));
+
+    select * into v_row from org_knowledge k where k.id = p_id and k.embedding is null;
+    if not found then
+        return;
+    end if;
+
+    select k.id into v_target
+    from org_knowledge k
+    where k.category = v_row.category
+      and k.id <> p_id
+      and k.embedding is not null
+      and 1 - (k.embedding <=> p_embedding) >= p_min_similarity
+    order by k.embedding <=> p_embedding
+    limit 1;
+
+    if v_target is not null then
+        delete from org_knowledge k where k.id = p_id;
+        return query
+        update org_knowledge k
+        set occurrences = k.occurrences + v_row.occurrences,
+            last_seen_at = greatest(k.last_seen_at, v_row.last_seen_at)
+        where k.id = v_target
+        returning k.id, true, k.occurrences;
+    else
+        return query
+        update org_knowledge k
+        set embedding = p_embedding
+        where k.id = p_id
+        returning k.id, false, k.occurrences;
+    end if;
+end;
+$$;
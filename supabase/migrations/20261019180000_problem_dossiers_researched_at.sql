@@ -0,0 +1,63 @@
+-- Eta' dei dossier misurata dalla ricerca completa, non dall'ultimo aggiornamento: un dossier
+-- aggiornato da uno simile (based_on) eredita researched_at, perche' concorrenti e dimensione
+-- del mercato vengono ancora dalla ricerca originale. match_dossiers filtra su researched_at,
+-- cosi' una catena di aggiornamenti scade insieme alla sua radice.
+
+alter table problem_dossiers add column if not exists researched_at timestamptz;
+
+-- Righe esistenti: il created_at della radice della catena
+with recursive chain (id, researched_at) as (
+    select d.id, d.created_at
+    from problem_dossiers d
+    where d.based_on is null
+    union all
+    select d.id, c.researched_at
+    from problem_dossiers d
+    join chain c on d.based_on = c.id
+)
+update problem_dossiers d
+set researched_at = c.researched_at
+from chain c
+where d.id = c.id and d.researched_at is null;
+
+update problem_dossiers set researched_at = created_at where researched_at is null;
+
+alter table problem_dossiers alter column researched_at set default now();
+alter table problem_dossiers alter column researched_at set not null;
+
+create index if not exists idx_problem_dossiers_sector_researched on problem_dossiers (sector, researched_at desc);
+
+-- Il tipo di ritorno cambia (researched_at): la funzione va ricreata
+drop function if exists match_dossiers(vector, text, float, integer, integer);
+
+-- Dossier piu' simili (coseno) nello stesso settore, con ricerca completa entro max_age_hours.
+create or replace function match_dossiers(
+    query_embedding vector(256),
+    match_sector    text    default null,
+    min_similarity  float   default 0.6,
+    max_age_hours   integer default 336,
+    match_count     integer default 1
+)
+returns table (
+    id            bigint,
+    problem_id    bigint,
+    sector        text,
+    keywords      text[],
+    dossier       jsonb,
+    reuse_count   integer,
+    created_at    timestamptz,
+    researched_at timestamptz,
+    similarity    float
+)
+language sql
+stable
+as $$
+    select d.id, d.problem_id, d.sector, d.keywords, d.dossier, d.reuse_count, d.created_at, d.researched_at,
+           1 - (d.embedding <=> query_embedding) as similarity
+    from problem_dossiers d
+    where (match_sector is null or d.sector = match_sector)
+      and d.researched_at >= now() - make_interval(hours => max_age_hours)
+      and 1 - (d.embedding <=> query_embedding) >= min_similarity
+    order by d.embedding <=> query_embedding
+    limit match_count;
+$$;
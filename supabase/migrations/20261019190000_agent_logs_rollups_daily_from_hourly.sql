@@ -0,0 +1,87 @@
+-- Refresh incrementale dei rollup: i log grezzi si rileggono solo per le ore toccate da p_since;
+-- i giorni si ricompongono da agent_logs_hourly (al piu' 24 righe per agente/azione/modello)
+-- invece di riscansionare agent_logs dall'inizio del giorno a ogni chiamata.
+-- Conteggi e somme restano esatti. I percentili giornalieri non si ricavano dagli orari:
+-- p50 e' la mediana delle p50 orarie, p95/p99 le peggiori fra le ore (stima per eccesso).
+
+create or replace function refresh_agent_logs_rollups(p_since timestamptz default now() - interval '2 hours')
+returns integer
+language plpgsql
+as $$
+declare
+    v_hour timestamptz := date_trunc('hour', p_since at time zone 'utc') at time zone 'utc';
+    v_day  timestamptz := date_trunc('day', p_since at time zone 'utc') at time zone 'utc';
+    v_rows integer;
+begin
+    insert into agent_logs_hourly as h (
+        bucket, agent_id, action, model_used, calls, errors, tokens_input, tokens_output,
+        cost_usd, duration_ms_sum, duration_p50_ms, duration_p95_ms, duration_p99_ms, duration_max_ms, updated_at
+    )
+    select
+        date_trunc('hour', created_at at time zone 'utc') at time zone 'utc',
+        coalesce(agent_id, ''), coalesce(action, ''), coalesce(model_used, ''),
+        count(*),
+        count(*) filter (where status = 'error'),
+        coalesce(sum(tokens_input), 0),
+        coalesce(sum(tokens_output), 0),
+        coalesce(sum(cost_usd), 0),
+        coalesce(sum(duration_ms), 0),
+        percentile_disc(0.50) within group (order by duration_ms),
+        percentile_disc(0.95) within group (order by duration_ms),
+        percentile_disc(0.99) within group (order by duration_ms),
+        max(duration_ms),
+        now()
+    from agent_logs
+    where created_at >= v_hour
+    group by 1, 2, 3, 4
+    on conflict (bucket, agent_id, action, model_used) do update set
+        calls = excluded.calls,
+        errors = excluded.errors,
+        tokens_input = excluded.tokens_input,
+        tokens_output = excluded.tokens_output,
+        cost_usd = excluded.cost_usd,
+        duration_ms_sum = excluded.duration_ms_sum,
+        duration_p50_ms = excluded.duration_p50_ms,
+        duration_p95_ms = excluded.duration_p95_ms,
+        duration_p99_ms = excluded.duration_p99_ms,
+        duration_max_ms = excluded.duration_max_ms,
+        updated_at = now();
+    get diagnostics v_rows = row_count;
+
+    insert into agent_logs_daily as d (
+        day, agent_id, action, model_used, calls, errors, tokens_input, tokens_output,
+        cost_usd, duration_ms_sum, duration_p50_ms, duration_p95_ms, duration_p99_ms, duration_max_ms, updated_at
+    )
+    select
+        (bucket at time zone 'utc')::date,
+        agent_id, action, model_used,
+        sum(calls),
+        sum(errors),
+        sum(tokens_input),
+        sum(tokens_output),
+        sum(cost_usd),
+        sum(duration_ms_sum),
+        percentile_disc(0.50) within group (order by duration_p50_ms),
+        max(duration_p95_ms),
+        max(duration_p99_ms),
+        max(duration_max_ms),
+        now()
+    from agent_logs_hourly
+    where bucket >= v_day
+    group by 1, 2, 3, 4
+    on conflict (day, agent_id, action, model_used) do update set
+        calls = excluded.calls,
+        errors = excluded.errors,
+        tokens_input = excluded.tokens_input,
+        tokens_output = excluded.tokens_output,
+        cost_usd = excluded.cost_usd,
+        duration_ms_sum = excluded.duration_ms_sum,
+        duration_p50_ms = excluded.duration_p50_ms,
+        duration_p95_ms = excluded.duration_p95_ms,
+        duration_p99_ms = excluded.duration_p99_ms,
+        duration_max_ms = excluded.duration_max_ms,
+        updated_at = now();
+
+    return v_rows;
+end;
+$$;